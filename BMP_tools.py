@@ -8,191 +8,402 @@
 
 #-------------------------------------------------------------------------------
 
-import arcpy
+try:
+    import arcpy
+except ImportError: # field tools still work through backends.ColumnarBackend
+    arcpy = None
+import numpy
 from utilities import addMessage
+from backends import get_backend, changed, convert_values, is_null, map_values, object_array, read_columns_for_keys
+from overlay import Layer, overlapping, overlap_areas
+from proximity import GridIndex
+from expressions import parse
+from uids import UidAllocator, default_state_path
+from conditional import ConditionalUpdate
+from field_plan import FieldPlan
+from instrument import stage
+
+# fields added by add_StandardFields - specific to the BMP inventory
+standard_fields = [("UID","LONG"),
+                   ("Original_ID","TEXT",20),
+                   ("As_Built","TEXT",10),
+                   ("InstallDate","DATE"),
+                   ("MS4","SHORT"),
+                   ("Data_Source","TEXT",25),
+                   ("Original_Type","TEXT",35),
+                   ("Gen_Type","TEXT",35),
+                   ("ACWA_ID","LONG"),
+                   ("ACWA_Type","TEXT",50),
+                   ("In_Stream","LONG"),
+                   ("Nearest_Hansen","TEXT",10),
+                   ("Subwatershed","TEXT",25)]
+
+@stage
+def add_StandardFields(input, backend=None):
+
+    # adds the standard_fields set of fields in one batch
+    #addMessage("Adding standard fields to " + input)
+    get_backend(backend).add_fields(input, standard_fields)
 
-def add_StandardFields(input):
 
-    # adds a set of fields, this is specific to the BMP inventory - could be made generic by looping through a list of info
-    #addMessage("Adding standard fields to " + input)
-    arcpy.AddField_management(input,"UID","LONG")
-    arcpy.AddField_management(input,"Original_ID","TEXT","","",20)
-    arcpy.AddField_management(input,"As_Built","TEXT","","",10)
-    arcpy.AddField_management(input,"InstallDate","DATE")
-    arcpy.AddField_management(input,"MS4","SHORT")
-    arcpy.AddField_management(input,"Data_Source","TEXT","","",25)
-    arcpy.AddField_management(input,"Original_Type","TEXT","","",35)
-    arcpy.AddField_management(input,"Gen_Type","TEXT","","",35)
-    arcpy.AddField_management(input,"ACWA_ID","LONG")
-    arcpy.AddField_management(input,"ACWA_Type","TEXT","","",50)
-    arcpy.AddField_management(input,"In_Stream","LONG")
-    arcpy.AddField_management(input,"Nearest_Hansen","TEXT","","",10)
-    arcpy.AddField_management(input,"Subwatershed","TEXT","","",25)
-
-
-def incrementField(input):
-
-    # for a given field, populates the field with an incrementing (n+1) set of values starting at 1 - can be used to create a unique ID field
-    # NEED TO VERIFY - DOES THIS RESPECT EXISTING SORT OR IS IT BASICALLY THE SAME AS POPULATING USING THE OBJECTID?
+@stage
+def incrementField(input, state_path=None, key_field=None, sort_field=None, backend=None):
+
+    # gives each row without a UID the next unused UID - existing UIDs are kept, so they are stable from run to run
+    # new rows are numbered in sort_field order (ties in OID order); the high-water mark (and, with key_field,
+    # a source key -> UID map so a reloaded feature gets its old UID back) is saved at state_path - see uids.py
+    # state_path defaults to a file next to input's geodatabase (uids.default_state_path)
+    # only the rows given a UID are read and written
     addMessage("Populating unique IDs for " + input)
-    with arcpy.da.UpdateCursor(input, "UID") as rows:
-        for i, row in enumerate(rows, 1):
-            row[0] = i
-            rows.updateRow(row)
+    return UidAllocator(state_path or default_state_path(input)).allocate(input, "UID", key_field, sort_field, backend)
 
-def fillField(input,field,value):
+@stage
+def fillField(input,field,value,backend=None):
 
     # fills a specified field with a specified, individual value
     #value supplied must match data type of existing field
 
     addMessage("Populating the " + field + " field for " +  input)
-    with arcpy.da.UpdateCursor(input, field) as cursor:
-        for row in cursor:
-            row[0] = value
-            cursor.updateRow(row)
+    b = get_backend(backend)
+    data = b.read_columns(input, [field])
+    write = changed(data[field], value)
+    b.write_columns(input, data["OID@"][write], {field: value})
 
-def fillField_Conditional(input,field,new_value,criteria):
+@stage
+def fillField_Conditional(input,field,new_value,criteria,only_null=True,backend=None):
 
-    # fills a specified field with a specified, individual value where any specified field meets a specified value
+    # fills a specified field with a specified, individual value where criteria (a where clause) is met
+    # and the field is still empty - only_null=False fills every matching row
     # input value supplied must match data type of existing field
+    # the criteria and null test go to the database, so only matching rows are read (see conditional.py)
+    addMessage("Populating the " + field + " field for " +  str(input))
+    return ConditionalUpdate(input, [(criteria, field, new_value)], only_null=only_null, backend=backend).run()[0]["hits"]
 
-    addMessage("Populating the " + field + " field for " +  input)
-    select_input = arcpy.MakeFeatureLayer_management(input,"select_input",criteria)
-    with arcpy.da.UpdateCursor(select_input, field) as cursor:
-        for row in cursor:
-            if row[0] is None:
-                row[0] = value
-                cursor.updateRow(row)
+@stage
+def fillFields_Conditional(input,rules,mode="first",only_null=False,backend=None):
+
+    # applies [(where clause, field, value or expressions.parse(...)), ...] rules in one pass
+    # where several rules for a field match a row the first (mode "first") or last (mode "last") sets it
+    # returns per rule {"where", "field", "matched", "hits"} - see conditional.py
+    addMessage("Applying {0} conditional rules to {1}".format(len(rules), input))
+    return ConditionalUpdate(input, rules, mode, only_null, backend).run()
 
-def fillField_fromAnother(input,targetField,sourceField):
+@stage
+def fillField_fromAnother(input,targetField,sourceField,backend=None):
 
     #fills field from another field within the same feature class
     addMessage("Populating the " + str(targetField) + " field for " +  str(input))
-    with arcpy.da.UpdateCursor(input, [targetField, sourceField]) as cursor:
-        for row in cursor:
-            row[0] = row[1]
-            cursor.updateRow(row)
+    b = get_backend(backend)
+    data = b.read_columns(input, [targetField, sourceField])
+    write = changed(data[targetField], data[sourceField])
+    b.write_columns(input, data["OID@"][write], {targetField: data[sourceField][write]})
 
-def fillField_ifOverlap(input, overlapFC, targetField, value):
+@stage
+def fillField_ifOverlap(input, overlapFC, targetField, value, backend=None):
 
     # fills specified field with a specified, individual value where spatial overlap exists between target and another fc
     # input value supplied must match data type of existing field
-    # path,name = os.path.split(input)
+    # overlap is tested in process (see overlay.py) - no layers or in_memory datasets are created
     addMessage("Populating the " + targetField + " field for " +  str(input))
-    input_layer = "input_layer"
-    arcpy.MakeFeatureLayer_management(input, input_layer)
-    selection = arcpy.SelectLayerByLocation_management(input_layer,"INTERSECT",overlapFC)
-    arcpy.CalculateField_management(selection,targetField,value)
-    arcpy.Delete_management("in_memory")
+    b = get_backend(backend)
+    targets = Layer(input, [targetField], backend=b)
+    hits = overlapping(targets, Layer(overlapFC, backend=b))
+    selected = numpy.array([len(h) > 0 for h in hits], dtype=bool)
+    write = selected & changed(targets.data[targetField], value)
+    b.write_columns(input, targets.data["OID@"][write], {targetField: value})
 
     addMessage("Done")
 
-def calcField_fromOverlap(targetFC,targetField,ID,overlapFC,overlapField):
+@stage
+def calcField_fromOverlap(targetFC,targetField,ID,overlapFC,overlapField,backend=None):
 
     #fills field with values from another field where overlap exists
-
-    from random import randint # RANDINT USED BECAUSE IN MEMORY IS NOT CLEARING
+    # where a target overlaps several features the one sharing the most area wins (polygons),
+    # otherwise the first in OID order - targets with no overlap, or a null value, are left as they are
+    # (ID is no longer needed now the overlay is done in process - kept for existing callers)
 
     #addMessage("Populating the " + targetField + " field for " +  targetFC)
-    result = arcpy.Intersect_analysis([targetFC,overlapFC],"in_memory\sect_result" + str(randint(0,100)),"NO_FID","","INPUT")
-    values={}
-    with arcpy.da.SearchCursor(result,[ID,overlapField]) as cursor:
-        for row in cursor:
-            if row[0] != None:
-                values[row[0]] = row[1]
-
-    with arcpy.da.UpdateCursor(targetFC, [ID, targetField]) as cursor:
-        for row in cursor:
-            if row[0] in values:
-                if values[row[0]] != None:
-                    row[1] = values[row[0]]
-                cursor.updateRow(row)
-
-    # arcpy.Delete_management("in_memory")
-    # BEWARE AS THIS WILL DELETE ALL IN_MEMORY NOT JUST WITHIN FUNCTION
+    b = get_backend(backend)
+    targets = Layer(targetFC, [targetField], backend=b)
+    overlaps = Layer(overlapFC, [overlapField], backend=b)
+    if targets.polygon and overlaps.polygon:
+        picks = [max(areas, key=lambda j: (areas[j], -j)) if areas else None for areas in overlap_areas(targets, overlaps)]
+    else:
+        picks = [hits[0] if hits else None for hits in overlapping(targets, overlaps)]
+
+    new = targets.data[targetField].astype(object)
+    for i, j in enumerate(picks):
+        if j is not None and overlaps.data[overlapField][j] is not None:
+            new[i] = overlaps.data[overlapField][j]
+    write = changed(targets.data[targetField], new)
+    b.write_columns(targetFC, targets.data["OID@"][write], {targetField: new[write]})
 
     #addMessage("Done")
 
-def calcField_withinDistance(inputFC,selectFC,criteria,distance,targetField,fillValue):
-
-    addMessage("Populating the " + targetField + " field for " +  inputFC)
-    select_input = arcpy.MakeFeatureLayer_management(inputFC,"select_input",criteria)
-    #att_selection = arcpy.SelectLayerByAttribute_management(select_input,"NEW_SELECTION",criteria)
-    loc_selection = arcpy.SelectLayerByLocation_management(select_input,"INTERSECT",selectFC,distance,"SUBSET_SELECTION")
-    arcpy.CalculateField_management(loc_selection,targetField,fillValue)
-
-def fillField_fromDict(inputFC,dictionary,sourceField,targetField):
-
+@stage
+def calcField_overlapArea(targetFC,targetField,overlapFC,where=None,factor=1.0,digits=None,backend=None):
+
+    # fills targetField with the area of each target polygon covered by overlapFC polygons (matching where)
+    # area is summed over the overlapping features, multiplied by factor (e.g. 1/43560.0 for acres) and rounded to digits
+    # targets with no overlap get 0 - nothing is written to disk but the final values
+    addMessage("Populating the " + targetField + " field for " +  str(targetFC))
+    b = get_backend(backend)
+    targets = Layer(targetFC, [targetField], backend=b)
+    overlaps = Layer(overlapFC, where=where, backend=b)
+    new = numpy.zeros(len(targets), dtype=float)
+    for i, areas in enumerate(overlap_areas(targets, overlaps)):
+        total = sum(areas.values()) * factor
+        new[i] = round(total, digits) if digits is not None else total
+    write = changed(targets.data[targetField], new)
+    b.write_columns(targetFC, targets.data["OID@"][write], {targetField: new[write]})
+
+@stage
+def calcField_withinDistance(inputFC,selectFC,criteria,distance,targetField,fillValue,backend=None):
+
+    # sets targetField to fillValue for the inputFC features matching criteria that are within distance of a selectFC feature
+    # distance is in map units or text such as "50 Feet"; fillValue is a value or, as with CalculateField, an expression (see expressions.py)
+    # distances are found in process (see proximity.py) - no layers or selections are made
     addMessage("Populating the " + targetField + " field for " +  str(inputFC))
-    with arcpy.da.UpdateCursor(inputFC,[sourceField,targetField]) as rows:
-        for row in rows:
-            for key,value in dictionary.items():
-                if row[0] == key:
-                    row[1] = value
-                #elif row[0] is None:
-                    #row[1] = 9999
-                rows.updateRow(row)
+    b = get_backend(backend)
+    expression = parse(fillValue) if isinstance(fillValue, (str, type(u""))) else None
+    targets = Layer(inputFC, [targetField] + (expression.fields if expression else []), where=criteria, backend=b)
+    hits = GridIndex(Layer(selectFC, backend=b)).within(targets, distance)
+    selected = numpy.array([len(h) > 0 for h in hits], dtype=bool)
+    if expression is not None:
+        value = expression.evaluate(dict((f, targets.data[f][selected]) for f in expression.fields), int(selected.sum()))
+    else:
+        value = [fillValue] * int(selected.sum())
+    field_type = _field_types(b, inputFC).get(targetField.upper())
+    new = targets.data[targetField].astype(object)
+    new[selected] = convert_values(value, field_type)
+    write = changed(targets.data[targetField], new)
+    b.write_columns(inputFC, targets.data["OID@"][write], {targetField: new[write]})
+
+@stage
+def calcField_nearest(targetFC,targetField,nearFC,nearField,distanceField=None,max_distance=None,where=None,backend=None):
+
+    # fills targetField with nearField of the nearest nearFC feature (matching where), and distanceField with the distance to it
+    # features with nothing within max_distance (map units or text such as "500 Feet") are left as they are
+    addMessage("Populating the " + targetField + " field for " +  str(targetFC))
+    b = get_backend(backend)
+    fields = [targetField] + ([distanceField] if distanceField else [])
+    targets = Layer(targetFC, fields, backend=b)
+    near = Layer(nearFC, [nearField], where=where, backend=b)
+    positions, distances = GridIndex(near).nearest(targets, 1, max_distance)
+    found = positions[:, 0] >= 0
+    types = _field_types(b, targetFC)
+    columns = {targetField: _nearest_values(targets.data[targetField], near.data[nearField], positions[:, 0], found, types.get(targetField.upper()))}
+    if distanceField:
+        columns[distanceField] = _nearest_values(targets.data[distanceField], distances[:, 0], numpy.arange(len(targets)), found,
+                                                 types.get(distanceField.upper()))
+    write = numpy.zeros(len(targets), dtype=bool)
+    for field, new in columns.items():
+        write |= changed(targets.data[field], new)
+    b.write_columns(targetFC, targets.data["OID@"][write], dict((field, new[write]) for field, new in columns.items()))
+
+@stage
+def fill_ProximityFields(input,hansenFC,hansenField,streamFC,stream_distance,hansen_where=None,stream_where=None,backend=None):
+
+    # fills the distance based standard fields of the BMP inventory in one pass over its shapes -
+    #   Nearest_Hansen - hansenField of the nearest hansenFC feature (e.g. the nearest sewer pipe or node)
+    #   In_Stream - 1 within stream_distance (map units or text such as "25 Feet") of a streamFC feature, otherwise 0
+    addMessage("Populating the Nearest_Hansen and In_Stream fields for " + str(input))
+    b = get_backend(backend)
+    targets = Layer(input, ["Nearest_Hansen", "In_Stream"], backend=b)
+    hansen = Layer(hansenFC, [hansenField], where=hansen_where, backend=b)
+    positions, distances = GridIndex(hansen).nearest(targets)
+    found = positions[:, 0] >= 0
+    near = _nearest_values(targets.data["Nearest_Hansen"], hansen.data[hansenField], positions[:, 0], found, "TEXT")
+    hits = GridIndex(Layer(streamFC, where=stream_where, backend=b)).within(targets, stream_distance)
+    in_stream = numpy.array([1 if h else 0 for h in hits], dtype=numpy.int64)
+    write = changed(targets.data["Nearest_Hansen"], near) | changed(targets.data["In_Stream"], in_stream)
+    b.write_columns(input, targets.data["OID@"][write], {"Nearest_Hansen": near[write], "In_Stream": in_stream[write]})
+
+def _field_types(b, table):
+    return dict((f.name.upper(), f.type) for f in b.list_fields(table))
+
+def _nearest_values(old, source, positions, found, field_type):
+    # old with source[position] cast to field_type where found
+    new = old.astype(object)
+    new[found] = convert_values(source[positions[found]], field_type)
+    return new
+
+@stage
+def calcField(inputFC,targetField,expression,lookups=None,backend=None):
+
+    # fills targetField from an expression such as "round(!Shape_Area!/43560,2)" - see expressions.py for the language
+    # the fields named are read once, the expression evaluated over whole columns and only changed rows written
+    # returns the FieldPlan counts
+    return FieldPlan(inputFC, backend).calc(targetField, expression, lookups).run()
+
+@stage
+def fillField_fromDict(inputFC,dictionary,sourceField,targetField,backend=None):
+
+    # kept for existing scripts - unmatched rows are left as they are
+    return fillField_fromLookup(inputFC,dictionary,sourceField,targetField,backend=backend)
+
+@stage
+def fillField_fromLookup(inputFC,lookup,sourceField,targetField,unmatched="keep",default=None,backend=None):
+
+    # fills targetField with lookup[sourceField] - one hashed lookup per distinct value and at most one write per row
+    # unmatched: what to do with rows whose source value is not a key in lookup
+    #   "keep"    - leave the existing target value (same as the old fillField_fromDict)
+    #   "default" - write the supplied default value
+    #   "null"    - write None
+    # rows whose target already holds the new value are not rewritten
+    # returns counts of matched, unmatched, unchanged and written rows
+
+    if unmatched not in ("keep", "default", "null"):
+        raise ValueError("unmatched must be one of keep, default, null - got {0}".format(unmatched))
 
-def CopyFieldFromFeature(sourceFC,sourceID,sourceField,targetFC,targetID,targetField):
+    addMessage("Populating the " + targetField + " field for " +  str(inputFC))
+    b = get_backend(backend)
+    data = b.read_columns(inputFC, [sourceField, targetField])
+    missing = object()
+    new = map_values(data[sourceField], lookup, missing)
+    matched = numpy.array([value is not missing for value in new], dtype=bool)
+    if unmatched == "keep":
+        candidates = matched
+    else:
+        new[~matched] = default if unmatched == "default" else None
+        candidates = numpy.ones(len(new), dtype=bool)
+    write = candidates & changed(data[targetField], new)
+    written = b.write_columns(inputFC, data["OID@"][write], {targetField: new[write]})
+
+    counts = {"matched": int(matched.sum()), "unmatched": int((~matched).sum()),
+              "unchanged": int((candidates & ~write).sum()), "written": written}
+    addMessage("{0} matched, {1} unmatched, {2} unchanged, {3} written".format(
+        counts["matched"], counts["unmatched"], counts["unchanged"], counts["written"]))
+    return counts
+
+@stage
+def CopyFieldFromFeature(sourceFC,sourceID,sourceField,targetFC,targetID,targetField,backend=None):
 
 #copy value from a field in one feature class to another through an ID field link - used in place of a table join and field populate (faster)
 #credit - Arnold Engelmann (DHI)
 
-    import datetime
-    #print "Running : " + datetime.datetime.now().strftime('%x %X')
-    #addMessage("Copying field data from " + str(sourceFC) + " to " + str(targetFC) + " using the field: " + str(sourceID))
-
-    values={}
-    with arcpy.da.SearchCursor(sourceFC,[sourceID,sourceField]) as cursor:
-        for row in cursor:
-            values[row[0]] = row[1]
+    return joinFields_fromFeature(sourceFC,sourceID,[sourceField],targetFC,targetID,[targetField],backend=backend)
 
-    with arcpy.da.UpdateCursor(targetFC,[targetID,targetField]) as cursor:
-        for row in cursor:
-            if row[0] in values:
-                if values[row[0]] != None:
-                    row[1] = values[row[0]]
-                cursor.updateRow(row)
-    #print "Done: " + datetime.datetime.now().strftime('%x %X')
-
-def CopyFieldsFromFeature(sourceFC,sourceID,sourceFields,targetFC,targetID): # NOT TESTED !!!
+@stage
+def CopyFieldsFromFeature(sourceFC,sourceID,sourceFields,targetFC,targetID,backend=None):
 
     # copies fields into target fc through a join
     # sourceFields is a list but can be single item list
     # sourceFields must already exist in sourceFC but will be created in target if they do not exist
     # BEWARE - this will overwrite fields in target if they do already exist
 
-    import arcpy
-
-    for field in sourceFields:
-
-        values={}
-
-        # fill 'values' dict with ID and field value from source
-        with arcpy.da.SearchCursor(sourceFC,[sourceID,sourceField]) as cursor:
-            for row in cursor:
-                values[row[0]] = row[1]
-
-        # list all target fields
-        targetFields = arcpy.ListFields(targetFC)
-
-        # get field info from sourceFC
-        my_field = arcpy.ListFields(sourceFC, field)[0]
-
-        my_name = my_field.name
-        my_type = my_field.type
-        my_length = my_field.length
-
-        # if source field not in target fields, create it
-        if field not in targetFields:
-            arcpy.AddField_management(targetFC, my_name, my_type, "", "", my_length)
-
-        # update target field with value from source field
-        with arcpy.da.UpdateCursor(targetFC,[targetID,targetField]) as cursor:
-            for row in cursor:
-                if row[0] in values:
-                    if values[row[0]] != None:
-                        row[1] = values[row[0]]
-                    cursor.updateRow(row)
-
-
+    return joinFields_fromFeature(sourceFC,sourceID,sourceFields,targetFC,targetID,backend=backend)
+
+@stage
+def joinFields_fromFeature(sourceFC,sourceID,sourceFields,targetFC,targetID,targetFields=None,
+                           nulls="skip",fill_value=None,duplicates="last",aggregate=None,pushdown=True,backend=None):
+
+    # copies several fields from sourceFC to targetFC through an ID field link
+    # source is read once into an ID -> row index, target fields are updated together in one write pass
+    # targetFields defaults to the sourceFields names - any missing from targetFC are created (typed from the source) before the pass
+    # nulls: what to do where the matched source value is None
+    #   "skip"  - leave the target value as it is (old CopyFieldFromFeature behaviour)
+    #   "write" - write None
+    #   "fill"  - write fill_value
+    # duplicates: what to do where a source ID occurs more than once
+    #   "first" / "last" - keep that row, "error" - raise, "aggregate" - combine non-null values with aggregate (default sum)
+    # pushdown: read only the source rows whose ID is in the target, in batched IN queries (see backends.read_columns_for_keys)
+    #   - worth it when the source is much bigger than the target, e.g. collection lines vs outfalls
+    #   with pushdown, duplicates="error" only looks at IDs present in the target
+    # returns counts of matched, unmatched, unchanged and written rows
+
+    if nulls not in ("skip", "write", "fill"):
+        raise ValueError("nulls must be one of skip, write, fill - got {0}".format(nulls))
+    if duplicates not in ("first", "last", "error", "aggregate"):
+        raise ValueError("duplicates must be one of first, last, error, aggregate - got {0}".format(duplicates))
+
+    sourceFields = list(sourceFields)
+    if targetFields is None:
+        targetFields = sourceFields
+    targetFields = list(targetFields)
+    if len(targetFields) != len(sourceFields):
+        raise ValueError("sourceFields and targetFields must be the same length")
+    if aggregate is None:
+        aggregate = sum
+
+    addMessage("Copying " + str(sourceFields) + " from " + str(sourceFC) + " to " + str(targetFC))
+    b = get_backend(backend)
+
+    # source fields must exist before target ones are created from them
+    source_info = dict((f.name.upper(), f) for f in b.list_fields(sourceFC))
+    for sourceField in [sourceID] + sourceFields:
+        if sourceField.upper() not in source_info:
+            raise ValueError("Field: {0} not in {1}".format(sourceField, sourceFC))
+
+    # create missing target fields in one batch
+    existing = [f.name.upper() for f in b.list_fields(targetFC)]
+    to_add = []
+    for sourceField, targetField in zip(sourceFields, targetFields):
+        if targetField.upper() not in existing:
+            existing.append(targetField.upper())
+            to_add.append((targetField, source_info[sourceField.upper()].type, source_info[sourceField.upper()].length))
+    if to_add:
+        b.add_fields(targetFC, to_add)
+
+    target = b.read_columns(targetFC, [targetID] + targetFields)
+
+    # ID -> position of the source row holding its values
+    if pushdown:
+        source = read_columns_for_keys(b, sourceFC, sourceID, sourceFields, target[targetID].tolist())
+    else:
+        source = b.read_columns(sourceFC, [sourceID] + sourceFields)
+    records = [source[field] for field in sourceFields]
+    index = {}
+    if duplicates == "first":
+        for position, key in enumerate(source[sourceID].tolist()):
+            if key is not None and key not in index:
+                index[key] = position
+    elif duplicates == "last":
+        index = dict((key, position) for position, key in enumerate(source[sourceID].tolist()) if key is not None)
+    else:
+        groups = {}
+        for position, key in enumerate(source[sourceID].tolist()):
+            if key is not None:
+                groups.setdefault(key, []).append(position)
+        if duplicates == "error":
+            for key, positions in groups.items():
+                if len(positions) > 1:
+                    raise ValueError("Duplicate {0} value {1} in {2}".format(sourceID, key, sourceFC))
+            index = dict((key, positions[0]) for key, positions in groups.items())
+        else:
+            keys = list(groups.keys())
+            index = dict((key, i) for i, key in enumerate(keys))
+            combined = []
+            for column in records:
+                values = []
+                for key in keys:
+                    present = [v for v in column[groups[key]] if v is not None]
+                    values.append(aggregate(present) if present else None)
+                combined.append(object_array(values))
+            records = combined
+
+    positions = map_values(target[targetID], index)
+    matched = numpy.array([p is not None for p in positions], dtype=bool)
+    positions = positions[matched].astype(numpy.int64)
+
+    new_columns = {}
+    write = numpy.zeros(int(matched.sum()), dtype=bool)
+    for targetField, column in zip(targetFields, records):
+        old = target[targetField][matched]
+        new = column[positions].astype(object)
+        nulls_mask = is_null(new)
+        if nulls == "skip":
+            new[nulls_mask] = old[nulls_mask]
+        else:
+            new[nulls_mask] = fill_value if nulls == "fill" else None
+        write |= changed(old, new)
+        new_columns[targetField] = new
+
+    oids = target["OID@"][matched]
+    written = b.write_columns(targetFC, oids[write], dict((field, new[write]) for field, new in new_columns.items()))
+
+    counts = {"matched": int(matched.sum()), "unmatched": int((~matched).sum()),
+              "unchanged": int((~write).sum()), "written": written}
+    addMessage("{0} matched, {1} unmatched, {2} unchanged, {3} written".format(
+        counts["matched"], counts["unmatched"], counts["unchanged"], counts["written"]))
+    return counts
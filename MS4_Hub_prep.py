@@ -9,18 +9,38 @@
 # Prepares data which has been revised per MS4 criteria for posting to CGIS hub.
 # Runs some spatial stats and adds fields to represent these.
 # Copies data snapshot to both archive field which has a list of date stamped versions
-# and overwrites data in the "Current" directory.
+# (kept as a base plus daily changes - see archive.py) and overwrites data in the "Current" directory.
 # After running have steward check Current directory results before running
-# the associated script to push data to the hub loading location.
+# the associated script to push data to the hub loading location - the review stages write
+# hubpost_review_<chain>.csv / .html to temp_dir, listing every record added, removed or changed
+# since the last archived version (see snapshot_diff.py).
+#
+# Runs as a graph of stages (see stages.py) - each stage writes its own dataset to the temp gdb and
+# is skipped on a re-run when its inputs have not changed, so a re-run after a small edit only redoes
+# the stages downstream of that edit.
+# The OF points, OF bounds and watersheds chains are independent - each has its own temp gdb and
+# stage cache and they run in separate worker processes up to the publish / archive / review stages,
+# which the main process then runs chain by chain - publishing first, so a failed archive does not stop it.
 
-# no params
+# optional params: stage names to run (default all), --force to ignore the stage cache,
+# --workers N worker processes (1 runs the chains one after another in this process)
 #-------------------------------------------------------------------------------
 
 #import modules
 import arcpy
-from utilities import reorder_fields,rename_fields
-from BMP_tools import fillField_fromDict
+from utilities import transform_fields, addMessage
+from BMP_tools import joinFields_fromFeature,calcField_overlapArea
+from field_plan import FieldPlan
+from stages import Pipeline
+from backends import ArcpyBackend
+from refcache import ReferenceCache, CachedBackend
+from archive import ArchiveStore
+from snapshot_diff import diff_report
+import instrument
+import argparse
+import multiprocessing
 import time
+import traceback
 import os
 
 #environmental variables
@@ -30,11 +50,18 @@ arcpy.gp.overwriteOutput = True
 editors = r"\\besfile1\grp117\DAshney\Scripts\connections\ASM_Editors_on_BESDBPROD1.sde"
 egh_public = r"\\besfile1\grp117\DAshney\Scripts\connections\egh_public on gisdb1.rose.portland.local.sde"
 
-temp = r"C:\temp\hubpost_working.gdb"
-if not arcpy.Exists(temp):
-    arcpy.CreateFileGDB_management(os.path.dirname(temp), os.path.basename(temp))
+# each chain gets hubpost_working_<chain>.gdb and hubpost_stages_<chain>.json in here
+temp_dir = r"C:\temp"
+
+# local copies of the EGH_PUBLIC reference layers, reread only when they change (see refcache.py)
+reference_cache = os.path.join(temp_dir, "hubpost_refcache")
+
+# timing / message records of every run (see instrument.py) - the worker processes write here too
+instrument.configure(records_path=os.path.join(temp_dir, "hubpost_log.jsonl"))
 
-archive = r"\\besfile1\modeling\GridMaster\MS4\ARC\Archive\Archive.gdb"
+# dated versions of each dataset, stored as changes since the previous version (see archive.py)
+# the old dated copies in Archive\Archive.gdb can be loaded with "python archive.py <store> import ..."
+archive_store = r"\\besfile1\modeling\GridMaster\MS4\ARC\Archive\store"
 output = r"\\besfile1\modeling\GridMaster\MS4\ARC\CurrentAdopted\Current_MS4.gdb"
 
 #inputs
@@ -45,83 +72,8 @@ wsheds = editors + r"\ASM_EDITORS.GIS.MS4\ASM_EDITORS.GIS.MS4_Watersheds"
 zoning = egh_public + r"\EGH_PUBLIC.ARCMAP_ADMIN.zoning_pdx"
 lines = egh_public + r"\EGH_PUBLIC.ARCMAP_ADMIN.collection_lines_bes_pdx"
 
-print("Starting MS4_Hub_prep...")
-
-#copy main features to working location
-print("Copying from source to temp")
-of_points_copy = arcpy.CopyFeatures_management(of_points, temp + r"\of_points_copy", "", "0", "0", "0")
-of_bounds_copy = arcpy.CopyFeatures_management(of_bounds, temp + r"\of_bounds_copy", "", "0", "0", "0")
-wsheds_copy = arcpy.CopyFeatures_management(wsheds, temp + r"\wsheds_copy", "", "0", "0", "0")
-
-#add and calc some fields
-print("Adding fields and initializing values")
-arcpy.AddField_management(of_points_copy,"Pipe_Dia","DOUBLE")
-arcpy.AddField_management(of_bounds_copy,"Area_Acres","DOUBLE")
-arcpy.AddField_management(of_bounds_copy,"Acres_IND","DOUBLE")
-arcpy.CalculateField_management(of_bounds_copy,"Acres_IND",0,"PYTHON","#")
-arcpy.CalculateField_management(wsheds_copy,"Area_Acres","round(!Shape_Area!/43560,2)","PYTHON","#")
-arcpy.CalculateField_management(of_bounds_copy,"Area_Acres","round(!Shape_Area!/43560,2)","PYTHON","#")
-
-#calculating prelimenary IND area acres
-print("Calculating prelimenary IND area acres")
-zoningfl = "zoningfl"
 #these 'employment' codes ('EG1', 'EG2', 'EX') were explicitly included per Patrice in addition to core IND codes
-arcpy.MakeFeatureLayer_management(zoning, zoningfl, "ZONE in ( 'EG1', 'EG2', 'EX', 'IG1', 'IG2', 'IH')")
-inputs = [zoningfl,of_bounds_copy]
-bounds_zoning_sect = temp + r"\bounds_zoning_sect"
-arcpy.Intersect_analysis(inputs, bounds_zoning_sect,"NO_FID","#","INPUT")
-bounds_zoning_diss = temp + r"\bounds_zoning_diss"
-arcpy.Dissolve_management(bounds_zoning_sect,bounds_zoning_diss,"Index_ID","Shape_Area SUM","MULTI_PART")
-arcpy.AddField_management(bounds_zoning_diss,"Acres_calc","DOUBLE")
-arcpy.CalculateField_management(bounds_zoning_diss,"Acres_calc","round(!SUM_SHAPE_Area!/43560,2)","PYTHON","#")
-
-#calculating area of IND for OF bounds
-print("Calculating area of IND and total area for OF bounds")
-values={}
-with arcpy.da.SearchCursor(bounds_zoning_diss,["Index_ID","Acres_calc"]) as cursor:
-    for row in cursor:
-        if row[0] != None:
-            values[row[0]] = row[1]
-
-with arcpy.da.UpdateCursor(of_bounds_copy, ["Index_ID", "Acres_IND"]) as cursor:
-    for row in cursor:
-        if row[0] in values:
-            if values[row[0]] == None:
-                row[1] = 0
-            else:
-                row[1] = values[row[0]]
-            cursor.updateRow(row)
-
-# calculating area acres field from shape_area for OF bounds"
-arcpy.CalculateField_management(of_bounds_copy,"Area_Acres","round(!SHAPE_Area!/43560,2)","PYTHON","#")
-
-# calculating pipe diameter on OF points
-print("Calculating pipe diameter on OF points")
-values={}
-with arcpy.da.SearchCursor(lines,["TO_NODE","PIPESIZE"]) as cursor:
-    for row in cursor:
-        if row[0] != None:
-            values[row[0]] = row[1]
-
-with arcpy.da.UpdateCursor(of_points_copy, ["HANSEN_ID", "Pipe_Dia"]) as cursor:
-    for row in cursor:
-        if row[0] in values:
-            if values[row[0]] != None:
-                row[1] = values[row[0]]
-            cursor.updateRow(row)
-
-# convert Watershed field (bounds) and Watershed_ (watersheds) from integer (used in subtype) to text
-print("Adding temp Watershed fields")
-arcpy.AddField_management(of_points_copy,"Watershed_txt","TEXT","","",25)
-arcpy.AddField_management(of_bounds_copy,"Watershed_txt","TEXT","","",25)
-arcpy.AddField_management(wsheds_copy,"Watershed_txt","TEXT","","",25)
-
-# remove watershed subtypes
-print("Removing watershed subtyptes")
-subtype_list = [1,2,3,4,5,6]
-arcpy.RemoveSubtype_management(of_points_copy,subtype_list)
-arcpy.RemoveSubtype_management(of_bounds_copy,subtype_list)
-arcpy.RemoveSubtype_management(wsheds_copy,subtype_list)
+ind_zones = "ZONE in ( 'EG1', 'EG2', 'EX', 'IG1', 'IG2', 'IH')"
 
 type_dict = ({1:"COLUMBIA RIVER",
 2:"COLUMBIA SLOUGH",
@@ -130,26 +82,6 @@ type_dict = ({1:"COLUMBIA RIVER",
 5:"WILLAMETTE RIVER",
 6:"N/A"})
 
-print("Filling fields from dictionary...")
-fillField_fromDict(of_points_copy,type_dict,"Watershed","Watershed_txt")
-fillField_fromDict(of_bounds_copy,type_dict,"Watershed","Watershed_txt")
-fillField_fromDict(wsheds_copy,type_dict,"Watershed_","Watershed_txt")
-
-#re-order fields and delete those that are unnecessary
-arcpy.DeleteField_management(of_points_copy,"Watershed")
-arcpy.DeleteField_management(of_bounds_copy,"Watershed")
-arcpy.DeleteField_management(wsheds_copy,"Watershed_")
-
-print("Renaming fields")
-rename_dict = {'Watershed_txt':'Watershed'}
-wshed_dict = {'Watershed_txt':'Watershed', 'Basin_':'Basin'}
-points_rename = temp + r"\points_rename"
-bounds_rename = temp + r"\bounds_rename"
-wsheds_rename = temp + r"\wsheds_rename"
-rename_fields(of_points_copy,points_rename,rename_dict)
-rename_fields(of_bounds_copy,bounds_rename,rename_dict)
-rename_fields(wsheds_copy,wsheds_rename,wshed_dict)
-
 points_new_order = (["Index_ID","OUTFALL_ID","X_coordinates","Y_coordinates","Outfall_Type",
 "MS4_permit","CSO_permit","permittedSSO","HANSEN_ID","Ownership","Prev_TYPE_1990","Control_Date",
 "ControlMechanism","CSOCntrlRegStruc","Watershed","Basin","Subbasin","ServStat","Control_Level",
@@ -158,22 +90,234 @@ bounds_new_order = (["Index_ID","OUTFALL_ID","Boundary_Type","Jurisdiction",
 "HANSEN_ID","SOURCE","COMMENTS","Watershed","Basin","Acres_IND","Area_Acres"])
 wsheds_new_order = ["Index_ID","Area_Acres","Watershed","Basin"]
 
-print("Re-ordering fields and saving to " + archive)
-points_final = archive + r"\MS4_OFpoints_" + time.strftime("%m%d%Y")
-bounds_final= archive + r"\MS4_OFbounds_" + time.strftime("%m%d%Y")
-wsheds_final= archive + r"\MS4_watersheds_" + time.strftime("%m%d%Y")
-reorder_fields(points_rename, points_final ,points_new_order,add_missing = False)
-reorder_fields(bounds_rename, bounds_final ,bounds_new_order,add_missing = False)
-reorder_fields(wsheds_rename, wsheds_final, wsheds_new_order,add_missing = False)
+# the three dataset chains - copy -> (dataset specific stats) -> final -> publish, archive -> review
+# the final copy also turns the watershed subtype codes into text, renames and drops / reorders fields
+datasets = {
+    "points": {"source": of_points, "watershed_field": "Watershed", "rename": {},
+               "order": points_new_order, "archive": "MS4_OFpoints_", "current": "OF_points_bes_pdx"},
+    "bounds": {"source": of_bounds, "watershed_field": "Watershed", "rename": {},
+               "order": bounds_new_order, "archive": "MS4_OFbounds_", "current": "OF_drainage_bounds_bes_pdx"},
+    "wsheds": {"source": wsheds, "watershed_field": "Watershed_", "rename": {'Watershed_':'Watershed', 'Basin_':'Basin'},
+               "order": wsheds_new_order, "archive": "MS4_watersheds_", "current": "MS4_catchments_bes_pdx"},
+}
+
+
+_reference_backend = None
+
+def reference_backend():
+
+    # arcpy backend reading the EGH_PUBLIC reference layers through the local cache
+    # made once per process, so each layer's version is probed once and its cached copy opened once
+    global _reference_backend
+    if _reference_backend is None:
+        _reference_backend = CachedBackend(ArcpyBackend(), ReferenceCache(reference_cache), [zoning, lines])
+    return _reference_backend
+
+
+# --- stages ---
+
+def copy_source(source, out):
+
+    #copy main features to working location
+    arcpy.CopyFeatures_management(source, out, "", "0", "0", "0")
+
+# the stage functions take everything they read as parameters (not module globals), so editing a where clause,
+# lookup or join field changes the stage fingerprint and the stage reruns
+
+def pipe_diameter(points, out, lines, line_key, line_fields, point_key, point_fields):
+
+    # calculating pipe diameter on OF points
+    arcpy.CopyFeatures_management(points, out)
+    arcpy.AddField_management(out,"Pipe_Dia","DOUBLE")
+    joinFields_fromFeature(lines,line_key,line_fields,out,point_key,point_fields,backend=reference_backend())
+
+def ind_acreage(bounds, out, zoning, zones):
+
+    arcpy.CopyFeatures_management(bounds, out)
+
+    # calculating area acres field from shape_area for OF bounds (once - fields added in the same pass)
+    FieldPlan(out).add_fields([("Area_Acres","DOUBLE"),("Acres_IND","DOUBLE")]).calc("Area_Acres","round(!Shape_Area!/43560,2)").run()
+
+    #calculating area of IND for OF bounds
+    # overlay done in process against the cached zoning - no intersect / dissolve datasets, bounds without IND get 0
+    calcField_overlapArea(out,"Acres_IND",zoning,where=zones,factor=1/43560.0,digits=2,backend=reference_backend())
+
+def watershed_area(wsheds, out):
+
+    arcpy.CopyFeatures_management(wsheds, out)
+    FieldPlan(out).add_fields([("Area_Acres","DOUBLE")]).calc("Area_Acres","round(!Shape_Area!/43560,2)").run()
+
+def final_copy(fc, out, watershed_field, watershed_names, rename_dict, new_order):
+
+    # one copy of the final dataset - Watershed field (bounds) and Watershed_ (watersheds) converted from integer
+    # (used in subtype) to text (watershed_names), fields renamed, re-ordered and those that are unnecessary deleted
+    transform_fields(fc,out,rename=rename_dict,order=new_order,casts={watershed_field:("TEXT",25)},
+                     values={watershed_field:watershed_names},add_missing=False)
+
+def archive(fc, dataset, stamp):
+
+    # archived as the rows changed since the last version
+    ArchiveStore(archive_store).archive(fc, dataset, stamp)
+
+def review(fc, dataset, stamp, csv_path, html_path):
+
+    # what changed since the last archived version, for the steward to check before pushing to the hub
+    store = ArchiveStore(archive_store)
+    if not [v for v in store.versions(dataset) if v["stamp"] != stamp]:
+        addMessage("No earlier archived version of {0} to review against".format(dataset))
+        return
+    diff_report(fc, store, dataset, exclude=stamp, csv_path=csv_path, html_path=html_path)
+
+def publish(fc, name):
+
+    #copy result to "Current" directory - overwrite existing
+    arcpy.FeatureClassToFeatureClass_conversion(fc,output,name)
+
+
+def chain_workspace(key):
+
+    return os.path.join(temp_dir, "hubpost_working_" + key + ".gdb")
+
+
+def build_pipeline(key, scratch, stamp):
+
+    # stages for one dataset chain, writing intermediates to the scratch gdb
+    # stamp dates the final copy and the archive version - one per run, so both phases build the same stages
+    pipeline = Pipeline(os.path.join(temp_dir, "hubpost_stages_" + key + ".json"))
+    info = datasets[key]
+    copy = scratch + "\\" + key + "_copy"
+    pipeline.stage("copy_" + key, copy_source, {"source": info["source"], "out": copy},
+                   sources=[info["source"]], outputs=[copy])
+
+    if key == "points":
+        stats = scratch + r"\points_pipe"
+        pipeline.stage("pipe_diameter", pipe_diameter,
+                       {"points": copy, "out": stats, "lines": lines, "line_key": "TO_NODE", "line_fields": ["PIPESIZE"],
+                        "point_key": "HANSEN_ID", "point_fields": ["Pipe_Dia"]},
+                       depends=["copy_points"], sources=[lines], outputs=[stats])
+        stats_stage = "pipe_diameter"
+    elif key == "bounds":
+        stats = scratch + r"\bounds_ind"
+        pipeline.stage("ind_acreage", ind_acreage, {"bounds": copy, "out": stats, "zoning": zoning, "zones": ind_zones},
+                       depends=["copy_bounds"], sources=[zoning], outputs=[stats])
+        stats_stage = "ind_acreage"
+    else:
+        stats = scratch + r"\wsheds_area"
+        pipeline.stage("watershed_area", watershed_area, {"wsheds": copy, "out": stats},
+                       depends=["copy_wsheds"], outputs=[stats])
+        stats_stage = "watershed_area"
+
+    final = scratch + "\\" + info["archive"] + stamp
+    pipeline.stage("final_" + key, final_copy,
+                   {"fc": stats, "out": final, "watershed_field": info["watershed_field"], "watershed_names": type_dict,
+                    "rename_dict": info["rename"], "new_order": info["order"]},
+                   depends=[stats_stage], outputs=[final])
+
+    # publish does not depend on the archive, so a failed archive never holds back the Current copy
+    pipeline.stage("publish_" + key, publish, {"fc": final, "name": info["current"]},
+                   depends=["final_" + key], outputs=[output + "\\" + info["current"]])
+
+    pipeline.stage("archive_" + key, archive, {"fc": final, "dataset": info["archive"].rstrip("_"), "stamp": stamp},
+                   depends=["final_" + key])
+
+    review_csv = os.path.join(temp_dir, "hubpost_review_" + key + ".csv")
+    review_html = os.path.join(temp_dir, "hubpost_review_" + key + ".html")
+    pipeline.stage("review_" + key, review,
+                   {"fc": final, "dataset": info["archive"].rstrip("_"), "stamp": stamp,
+                    "csv_path": review_csv, "html_path": review_html},
+                   depends=["archive_" + key], outputs=[review_csv, review_html])
+    return pipeline
+
+
+# stages writing to the shared Archive / Current gdbs - run in the main process one chain at a time,
+# as a file gdb does not take concurrent writers
+shared_stages = ("archive_", "review_", "publish_")
+
+def run_chain(job):
+
+    # runs one dataset chain - job is (key, stage names or None, force, shared, done, stamp)
+    # shared False runs the chain up to the shared stages, shared True runs the shared stages
+    # done is the stage fingerprints the first phase handed back, so the shared phase does not run those stages again
+    # -> (key, stage status, seconds, traceback text or None, stage fingerprints) so a failed chain does not stop the others
+    key, targets, force, shared, done, stamp = job
+    start = time.time()
+    try:
+        scratch = chain_workspace(key)
+        if not arcpy.Exists(scratch):
+            arcpy.CreateFileGDB_management(os.path.dirname(scratch), os.path.basename(scratch))
+        pipeline = build_pipeline(key, scratch, stamp)
+        if targets:
+            targets = [name for name in targets if name in pipeline.stages]
+            if not targets:
+                return key, {}, 0.0, None, {}
+        if shared:
+            names = [name for name in targets if name.startswith(shared_stages)] if targets else ["publish_" + key, "archive_" + key, "review_" + key]
+        else:
+            # everything the targets need short of the shared stages
+            names = [name for name in pipeline.required(targets or None) if not name.startswith(shared_stages)]
+        if not names:
+            return key, {}, 0.0, None, dict(done or {})
+        if shared and force:
+            force = [name for name in pipeline.stages if name.startswith(shared_stages)]
+        status = pipeline.run(names, force=force, done=done)
+        return key, status, time.time() - start, None, pipeline.fingerprints
+    except Exception:
+        return key, None, time.time() - start, traceback.format_exc(), {}
+    finally:
+        # worker processes are not shut down cleanly, so write their records out now
+        instrument.flush()
+
+
+def main(argv=None):
 
-#copy result to "Current" directory - overwrite existing
-print("Copying same results to " + output)
-arcpy.FeatureClassToFeatureClass_conversion(points_final,output,"OF_points_bes_pdx")
-arcpy.FeatureClassToFeatureClass_conversion(bounds_final,output,"OF_drainage_bounds_bes_pdx")
-arcpy.FeatureClassToFeatureClass_conversion(wsheds_final,output,"MS4_catchments_bes_pdx")
+    parser = argparse.ArgumentParser(description="Prepares MS4 data for posting to the CGIS hub")
+    parser.add_argument("stages", nargs="*", help="stages to run with their dependencies (default all)")
+    parser.add_argument("--force", action="store_true", help="rerun every stage, ignoring the stage cache")
+    parser.add_argument("--workers", type=int, default=len(datasets), help="worker processes for the dataset chains")
+    args = parser.parse_args(argv)
 
-print("... MS4_Hub_prep Finished")
+    print("Starting MS4_Hub_prep...")
+    start = time.time()
+    # taken once, so a run crossing midnight still archives (and reviews) the final copies it made
+    stamp = time.strftime("%m%d%Y")
+    jobs = [(key, args.stages or None, args.force, False, None, stamp) for key in sorted(datasets)]
+    if args.workers > 1:
+        pool = multiprocessing.Pool(min(args.workers, len(jobs)))
+        try:
+            results = pool.map(run_chain, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_chain(job) for job in jobs]
 
+    # archive and publish the chains that made it, one after another - the stages the workers
+    # already ran (or reused) are passed back in, not checked again
+    shared = {}
+    for key, status, seconds, error, fingerprints in results:
+        if error is None:
+            shared[key] = run_chain((key, args.stages or None, args.force, True, fingerprints, stamp))
 
+    failed = []
+    for key, status, seconds, error, fingerprints in results:
+        if error is None:
+            key, shared_status, shared_seconds, error, fingerprints = shared[key]
+            seconds += shared_seconds
+            if error is None:
+                status = dict(status, **shared_status)
+        if error is not None:
+            failed.append(key)
+            print("{0} chain FAILED after {1:.1f}s\n{2}".format(key, seconds, error))
+        else:
+            print("{0} chain: {1:.1f}s, {2} stages run, {3} reused from cache".format(
+                key, seconds, list(status.values()).count("ran"), list(status.values()).count("cached")))
+    print("Total {0:.1f}s".format(time.time() - start))
+    for line in instrument.report():
+        print(line)
+    if failed:
+        raise RuntimeError("MS4_Hub_prep chains failed: " + ", ".join(failed))
+    print("... MS4_Hub_prep Finished")
 
 
+if __name__ == "__main__":
+    main()
@@ -7,39 +7,265 @@
 # Created:     31/03/2015
 # script copies MS4 files from 'Current' directory to CGIS loading location
 # ONLY RUN ONCE REVIEW OF MS4_Hub_prep SCRIPT RESULT IS COMPLETE
+#
+# Only feature classes that changed since the last publish are replaced on the loading dock.
+# Each feature class is fingerprinted (schema plus an order independent hash of its rows and geometry,
+# see stages.dataset_fingerprint) and compared with the manifest written by the last publish -
+# unchanged feature classes that are still on the loading dock are left alone.
+#
+# Changed feature classes are copied in parallel worker processes (each retried on failure) to
+# <name>_staging on the loading dock while the old versions stay in place. Only once every copy has
+# landed are they swapped in, all or nothing: every live layer is renamed to <name>_old, then every staging
+# copy to its live name. If any rename fails every layer is put back as it was and the staging copies removed.
+# The _old versions are only deleted once every swap succeeded. If any copy fails nothing is swapped.
 
-# no params
+# optional params: --dry-run lists what would be copied (and roughly how much data) without copying,
+# --all copies everything whether changed or not, --manifest path of the publish manifest,
+# --workers copies at once (default 4), --retries attempts per layer (default 3)
+#
+# Everything past listing the Current gdb goes through a backends.TableBackend (arcpy when none is given),
+# so publish() can run against a ColumnarBackend too.
 #-------------------------------------------------------------------------------
 
-import arcpy
+try:
+    import arcpy
+except ImportError: # publish() still works through backends.ColumnarBackend
+    arcpy = None
+import argparse
+import datetime
+import json
+import multiprocessing
 import os
+import time
+import traceback
+from backends import ArcpyBackend, get_backend
+from stages import dataset_fingerprint
 
 #environmental variables
-arcpy.gp.overwriteOutput = True
+if arcpy is not None:
+    arcpy.gp.overwriteOutput = True
 
 input = r"\\besfile1\modeling\GridMaster\MS4\ARC\CurrentAdopted\Current_MS4.gdb"
 output = r"\\besfile1\grp117\DAshney\Scripts\connections\BESDBPROD1.GIS_TRANSFER10.GIS.sde"
 
-print("Starting Process")
-
-print("Getting list of feature classes to copy")
-arcpy.env.workspace = input
-fc_list = []
-fcs = arcpy.ListFeatureClasses()
-for fc in fcs:
-    fc_list.append(fc)
-
-print("Deleting old versions from loading dock before copying the new ones")
-for fc in fc_list:
-    fc_path = os.path.join(output,fc)
-    if arcpy.Exists(fc_path):
-        print("...deleting " + fc + " from GIS_TRANSFER10")
-        arcpy.Delete_management(fc_path)
+# fingerprints of what was last published, kept next to the Current gdb
+manifest_path = os.path.join(os.path.dirname(input), "hub_publish_manifest.json")
+
+
+def load_manifest(path):
+
+    if not os.path.exists(path):
+        return {"feature_classes": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".tmp", path)
+
+
+def plan_publish(fc_list, manifest, copy_all=False, backend=None):
+
+    # -> ({fc: fingerprint} for every fc, [fcs to copy], {fc: reason})
+    b = get_backend(backend)
+    fingerprints = {}
+    to_copy = []
+    reasons = {}
+    for fc in fc_list:
+        fingerprints[fc] = dataset_fingerprint(os.path.join(input, fc), b)
+        previous = manifest["feature_classes"].get(fc)
+        if copy_all:
+            reason = "copy all requested"
+        elif previous is None:
+            reason = "not published before"
+        elif previous["schema"] != fingerprints[fc]["schema"]:
+            reason = "schema changed"
+        elif (previous["rows"], previous["content"]) != (fingerprints[fc]["rows"], fingerprints[fc]["content"]):
+            reason = "rows changed ({0} -> {1} rows)".format(previous["rows"], fingerprints[fc]["rows"])
+        elif not b.exists(os.path.join(output, fc)):
+            reason = "missing from GIS_TRANSFER10"
+        else:
+            continue
+        to_copy.append(fc)
+        reasons[fc] = reason
+    return fingerprints, to_copy, reasons
+
+
+staging_suffix = "_staging"
+old_suffix = "_old"
+
+def remove_if_exists(path, backend=None):
+    b = get_backend(backend)
+    if b.exists(path):
+        b.delete(path)
+
+
+def transfer_layer(job):
+
+    # copies one feature class to its staging name on the loading dock - job is (fc, attempts, delay, backend)
+    # -> (fc, error text or None, attempts made, seconds), so one failed layer does not stop the others
+    fc, attempts, delay, backend = job
+    start = time.time()
+    error = None
+    for attempt in range(1, attempts + 1):
+        try:
+            staging = os.path.join(output, fc + staging_suffix)
+            remove_if_exists(staging, backend)
+            backend.copy(os.path.join(input, fc), staging)
+            return fc, None, attempt, time.time() - start
+        except Exception:
+            error = traceback.format_exc()
+            if attempt < attempts:
+                time.sleep(delay * attempt)
+    return fc, error, attempts, time.time() - start
+
+
+def _rename_back(path, to, backend):
+    # one rollback step - a failure is reported and the rest of the rollback carries on
+    try:
+        if backend.exists(path):
+            backend.rename(path, to)
+    except Exception:
+        print("...COULD NOT RESTORE " + to + " from " + path + "\n" + traceback.format_exc())
+
+
+def swap_layers(fcs, backend=None):
+
+    # every live layer -> <name>_old, then every staging copy -> live name
+    # any failure renames every layer back (live -> staging, old -> live) and re-raises
+    b = get_backend(backend)
+    names = [(os.path.join(output, fc), os.path.join(output, fc + staging_suffix), os.path.join(output, fc + old_suffix)) for fc in fcs]
+    moved = []
+    placed = []
+    try:
+        for live, staging, old in names:
+            remove_if_exists(old, b)
+        for live, staging, old in names:
+            if b.exists(live):
+                b.rename(live, old)
+                moved.append((live, old))
+        for live, staging, old in names:
+            b.rename(staging, live)
+            placed.append((live, staging))
+    except Exception:
+        print("...swap failed - putting the published layers back")
+        for live, staging in reversed(placed):
+            _rename_back(live, staging, b)
+        for live, old in reversed(moved):
+            _rename_back(old, live, b)
+        raise
+
+    # only now that every layer is in place are the old versions dropped
+    for live, staging, old in names:
+        try:
+            remove_if_exists(old, b)
+        except Exception:
+            print("...could not delete " + old + "\n" + traceback.format_exc())
+
+
+def transfer(to_copy, workers=4, retries=3, delay=10, backend=None):
+
+    # staged, parallel copy then swap -> {fc: (attempts, seconds)}, raises if any layer could not be copied
+    # (the backend goes to the worker processes, so with workers > 1 it must pickle - ArcpyBackend does)
+    b = get_backend(backend)
+    jobs = [(fc, retries, delay, b) for fc in to_copy]
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            results = pool.map(transfer_layer, jobs)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        print(fc + " : ...none to delete")
+        results = [transfer_layer(job) for job in jobs]
+
+    failed = []
+    for fc, error, attempts, seconds in results:
+        if error is None:
+            print("...staged " + fc + " in {0:.1f}s ({1} attempt{2})".format(seconds, attempts, "s" if attempts > 1 else ""))
+        else:
+            failed.append(fc)
+            print("..." + fc + " FAILED after {0} attempts\n{1}".format(attempts, error))
+    if failed:
+        # leave the live layers alone - nothing is swapped unless everything landed
+        for fc in to_copy:
+            remove_if_exists(os.path.join(output, fc + staging_suffix), b)
+        raise RuntimeError("Copy to GIS_TRANSFER10 failed for: " + ", ".join(failed))
+
+    print("Swapping the new copies into place: " + ", ".join(to_copy))
+    try:
+        swap_layers(to_copy, b)
+    except Exception:
+        for fc in to_copy:
+            remove_if_exists(os.path.join(output, fc + staging_suffix), b)
+        raise
+    return dict((fc, (attempts, seconds)) for fc, error, attempts, seconds in results)
+
+
+def publish(fc_list, manifest_file=manifest_path, dry_run=False, copy_all=False, workers=4, retries=3, delay=10,
+            backend=None):
+
+    # compares fc_list (names in input) with the last publish and copies what changed -> fcs copied (or to copy)
+    b = get_backend(backend)
+    print("Comparing with the last publish")
+    manifest = load_manifest(manifest_file)
+    fingerprints, to_copy, reasons = plan_publish(fc_list, manifest, copy_all, b)
+    for fc in fc_list:
+        if fc in reasons:
+            print("..." + fc + " : " + reasons[fc] + ", about {0:,} bytes".format(fingerprints[fc]["bytes"]))
+        else:
+            print("..." + fc + " : unchanged")
+    total = sum(fingerprints[fc]["bytes"] for fc in to_copy)
+    print("{0} of {1} feature classes to copy, about {2:,} bytes of row data".format(len(to_copy), len(fc_list), total))
+
+    if dry_run:
+        print("Dry run - nothing copied")
+        return to_copy
+    if not to_copy:
+        print("Process Complete - nothing changed")
+        return to_copy
+
+    print("Copying data from " + input + " to " + output)
+    print("...copying " + str(to_copy) + " to GIS_TRANSFER10 staging names")
+    start = time.time()
+    transfer(to_copy, workers, max(retries, 1), delay, b)
+    print("Transfer took {0:.1f}s".format(time.time() - start))
+
+    # only written once the copy succeeded, so a failed publish is retried next time
+    manifest = {"published": datetime.datetime.now().isoformat(), "input": input, "output": output,
+                "feature_classes": dict((fc, fingerprints[fc]) for fc in fc_list)}
+    save_manifest(manifest_file, manifest)
+
+    print("Process Complete")
+    return to_copy
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Copies changed MS4 feature classes from Current to the CGIS loading location")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be copied without copying")
+    parser.add_argument("--all", action="store_true", help="copy every feature class whether changed or not")
+    parser.add_argument("--manifest", default=manifest_path, help="publish manifest (default next to the Current gdb)")
+    parser.add_argument("--workers", type=int, default=4, help="feature classes copied at once")
+    parser.add_argument("--retries", type=int, default=3, help="attempts per feature class")
+    args = parser.parse_args(argv)
+
+    print("Starting Process")
+
+    print("Getting list of feature classes to copy")
+    arcpy.env.workspace = input
+    fc_list = []
+    fcs = arcpy.ListFeatureClasses()
+    for fc in fcs:
+        fc_list.append(fc)
+
+    return publish(fc_list, args.manifest, args.dry_run, args.all, args.workers, args.retries, backend=ArcpyBackend())
 
-print("Copying data from " + input + " to " + output)
-print("...copying " + str(fc_list) + " to GIS_TRANSFER10")
-arcpy.FeatureClassToGeodatabase_conversion(fc_list,output)
 
-print("Process Complete")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
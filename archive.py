@@ -0,0 +1,304 @@
+#-------------------------------------------------------------------------------
+# Name:        archive
+# Purpose:     dated archive versions of the MS4 datasets stored as a base snapshot plus row level deltas
+#
+# Instead of a full dated copy per run in Archive.gdb, each dataset gets one SQLite file in the store
+# directory (ColumnarBackend format) holding
+#   - base versions - every row
+#   - delta versions - only the rows inserted or updated since the previous version (keyed on Index_ID),
+#     with the deleted keys kept in the catalog
+# and a JSON catalog listing the versions in the order they were archived. A version is rebuilt by
+# taking the latest base at or before it and applying the deltas after that base in order - the base and the
+# deltas are each read in key order a chunk at a time and merged (rows()), so they are never held whole.
+#
+# Compaction: a new base is written instead of a delta when the schema changed, when the chain since the
+# last base has max_chain deltas, or when the rows changed since the last base pass max_delta_fraction of
+# the base - so rebuilding any version applies a bounded number of deltas. compact() writes a base now.
+#
+#   store = ArchiveStore(r"\\besfile1\modeling\GridMaster\MS4\ARC\Archive\store")
+#   store.archive(fc, "MS4_OFpoints", "03312015")
+#   store.export("MS4_OFpoints", "03312015", r"C:\temp\scratch.gdb\MS4_OFpoints_03312015")
+#
+# From the command line:
+#   python archive.py <store> list [dataset]
+#   python archive.py <store> export <dataset> <stamp> <out table>
+#   python archive.py <store> import <dataset> <stamp> <table>    (load an old dated copy)
+#   python archive.py <store> compact <dataset>
+#
+# Rows with a null or repeated Index_ID cannot be matched between versions - they are stored in full with
+# every version (and a warning logged) rather than stopping the archive.
+#
+# Geometry is kept as plain x, y coordinates (see backends.geometry_coordinates) - z and m values are not archived.
+#-------------------------------------------------------------------------------
+
+import argparse, collections, datetime, heapq, json, os, sys
+import numpy
+from utilities import addMessage
+from backends import ColumnarBackend, Field, get_backend, geometry_coordinates, object_array
+from stages import row_hashes, _hash
+
+# flags the rows of a stored version that have no unique key (kept in full with every version)
+unkeyed_field = "ARCHIVE_UNKEYED"
+
+
+class ArchiveStore(object):
+
+    def __init__(self, directory, key="Index_ID", max_chain=30, max_delta_fraction=0.5):
+        self.directory = directory
+        self.key = key
+        self.max_chain = max_chain
+        self.max_delta_fraction = max_delta_fraction
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # --- files ---
+
+    def _path(self, dataset, extension):
+        return os.path.join(self.directory, dataset + extension)
+
+    def catalog(self, dataset):
+        path = self._path(dataset, ".json")
+        if not os.path.exists(path):
+            return {"dataset": dataset, "key": self.key, "versions": []}
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_catalog(self, dataset, catalog):
+        path = self._path(dataset, ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(catalog, f, indent=2, sort_keys=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+
+    def datasets(self):
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".json"))
+
+    def versions(self, dataset):
+        return self.catalog(dataset)["versions"]
+
+    # --- archiving ---
+
+    def archive(self, table, dataset, stamp, backend=None):
+
+        # stores table as the stamp version of dataset -> the catalog entry written
+        # (archiving the same stamp again adds a later entry, which is the one rebuilt for that stamp)
+        b = get_backend(backend)
+        fields = [f for f in b.list_fields(table) if f.type not in ("OID", "GEOMETRY")]
+        geometry_type = b.geometry_type(table)
+        names = [f.name for f in fields] + (["SHAPE@"] if geometry_type else [])
+        data = b.read_columns(table, names)
+        if geometry_type:
+            data["SHAPE@"] = object_array([geometry_coordinates(g) for g in data["SHAPE@"]])
+        return self._store(dataset, stamp, fields, geometry_type, b.spatial_reference(table), data, names)
+
+    def _store(self, dataset, stamp, fields, geometry_type, spatial_reference, data, names, force_base=False):
+        catalog = self.catalog(dataset)
+        versions = catalog["versions"]
+        key = self._key_name(fields, catalog["key"])
+        keys = data[key].tolist()
+        # rows without a key, or sharing one, cannot be tracked from version to version - they are stored
+        # in full with every version (flagged in unkeyed_field) rather than holding up the archive
+        counts = collections.Counter(keys)
+        keyed = numpy.array([k is not None and counts[k] == 1 for k in keys], dtype=bool)
+        unkeyed = numpy.nonzero(~keyed)[0]
+        if len(unkeyed):
+            addMessage("WARNING: {0} rows of {1} without a unique {2} - archived in full with every version".format(
+                len(unkeyed), dataset, key))
+        hashes, size = row_hashes(data, names)
+        schema = _hash([(f.name, f.type, f.length) for f in fields] + [geometry_type])
+
+        store = ColumnarBackend(self._path(dataset, ".sqlite"))
+        state = {}
+        if versions:
+            previous = store.table("state")
+            state = dict(zip(previous.columns["key"].tolist(), previous.columns["hash"].tolist()))
+
+        entry = {"stamp": stamp, "table": "v{0:04d}".format(len(versions) + 1), "archived": datetime.datetime.now().isoformat(),
+                 "schema": schema, "rows": len(keys), "bytes": size}
+        current = dict((k, h) for k, h, ok in zip(keys, hashes, keyed) if ok)
+        inserted = [k for k in current if k not in state]
+        updated = [k for k in current if k in state and state[k] != current[k]]
+        deleted = [k for k in state if k not in current]
+        entry.update(inserted=len(inserted), updated=len(updated), deleted=len(deleted), unkeyed=len(unkeyed))
+
+        since_base = self._since_base(versions)
+        changed = sum(v["inserted"] + v["updated"] + v["deleted"] for v in since_base[1:]) + len(inserted) + len(updated) + len(deleted)
+        if (force_base or not versions or versions[-1]["schema"] != schema or len(since_base) > self.max_chain
+                or changed > self.max_delta_fraction * max(since_base[0]["rows"], 1)):
+            entry["kind"] = "base"
+            rows = numpy.arange(len(keys))
+        else:
+            entry["kind"] = "delta"
+            entry["deleted_keys"] = sorted(deleted, key=lambda k: (str(type(k)), k))
+            position = dict((k, i) for i, k in enumerate(keys) if keyed[i])
+            rows = numpy.array(sorted([position[k] for k in inserted + updated] + unkeyed.tolist()), dtype=numpy.int64)
+        entry["fields"] = [list(f) for f in fields]
+        entry["geometry_type"] = geometry_type
+        entry["spatial_reference"] = spatial_reference
+
+        table_fields = list(fields) + [Field(unkeyed_field, "SHORT", None)] + ([Field("Shape", "GEOMETRY", None)] if geometry_type else [])
+        columns = dict((f.name, data[f.name][rows]) for f in fields)
+        columns[unkeyed_field] = object_array([None if keyed[i] else 1 for i in rows.tolist()])
+        if geometry_type:
+            columns["Shape"] = data["SHAPE@"][rows]
+        store.create_table(entry["table"], table_fields, columns, None, geometry_type)
+        # the state key column takes the key field's type, so keys read back compare equal to the next version's
+        key_field = [f for f in fields if f.name == key][0]
+        store.create_table("state", [("key", key_field.type, key_field.length), ("hash", "TEXT", 40)],
+                           {"key": object_array(list(current)), "hash": object_array(list(current.values()))})
+        store.save()
+        store.add_index(entry["table"], key)
+        versions.append(entry)
+        self._write_catalog(dataset, catalog)
+        addMessage("Archived {0} {1} as a {2}: {3} rows, {4} inserted, {5} updated, {6} deleted".format(
+            dataset, stamp, entry["kind"], entry["rows"], entry["inserted"], entry["updated"], entry["deleted"]))
+        return entry
+
+    def _key_name(self, fields, key):
+        for f in fields:
+            if f.name.upper() == key.upper():
+                return f.name
+        raise ValueError("Key field {0} not found".format(key))
+
+    def _since_base(self, versions):
+        # -> the versions from the latest base on
+        for i in range(len(versions) - 1, -1, -1):
+            if versions[i]["kind"] == "base":
+                return versions[i:]
+        return []
+
+    def compact(self, dataset):
+        # writes the latest version again as a base, so it (and later deltas) rebuild from there
+        versions = self.versions(dataset)
+        if not versions:
+            raise ValueError("Nothing archived for " + dataset)
+        if versions[-1]["kind"] == "base":
+            return versions[-1]
+        fields, columns, geometry_type, spatial_reference = self.rebuild(dataset)
+        fields = [Field(*f) for f in fields if f[1] != "GEOMETRY"]
+        names = [f.name for f in fields] + (["SHAPE@"] if geometry_type else [])
+        data = dict((f.name, columns[f.name]) for f in fields)
+        data["OID@"] = numpy.arange(1, len(columns[fields[0].name]) + 1)
+        if geometry_type:
+            data["SHAPE@"] = columns["Shape"]
+        return self._store(dataset, versions[-1]["stamp"], fields, geometry_type, spatial_reference, data, names, force_base=True)
+
+    # --- rebuilding ---
+
+    def _target(self, versions, stamp):
+        if stamp is None:
+            return len(versions) - 1
+        for i in range(len(versions) - 1, -1, -1):
+            if versions[i]["stamp"] == stamp:
+                return i
+        raise ValueError("No archived version {0} - have {1}".format(stamp, ", ".join(v["stamp"] for v in versions)))
+
+    def rows(self, dataset, stamp=None, chunk_size=10000, unkeyed=True):
+
+        # -> (names, rows) - rows yields the stamp version (latest if None) of dataset as lists of values in names order:
+        # the keyed rows in key order, then (unless unkeyed is False) the rows without a unique key
+        # the base and each delta since it are read from the store in key order, chunk_size rows at a time, and merged -
+        # for each key the latest version holding it wins unless a later delta deleted it
+        versions = self.versions(dataset)
+        if not versions:
+            raise ValueError("Nothing archived for " + dataset)
+        target = self._target(versions, stamp)
+        start = max(i for i in range(target + 1) if versions[i]["kind"] == "base")
+        chain = versions[start:target + 1]
+        entry = versions[target]
+        store = ColumnarBackend(self._path(dataset, ".sqlite"))
+        names = [f[0] for f in entry["fields"]] + (["Shape"] if entry["geometry_type"] else [])
+        key = self._key_name([Field(*f) for f in entry["fields"]], self.catalog(dataset)["key"])
+        position = names.index(key)
+        deleted = {} # key -> last version in the chain that deleted it
+        for n, version in enumerate(chain):
+            for k in version.get("deleted_keys", []):
+                deleted[k] = n
+        flagged = dict((v["table"], unkeyed_field in [f.name for f in store.list_fields(v["table"])]) for v in chain)
+
+        def keyed_rows(n, version):
+            where = unkeyed_field + " IS NULL" if flagged[version["table"]] else None
+            for row in store.stream_rows(version["table"], names, key, where, chunk_size):
+                yield row[position], -n, row
+
+        def merged():
+            last = object()
+            for k, newest, row in heapq.merge(*[keyed_rows(n, v) for n, v in enumerate(chain)]):
+                if k == last:
+                    continue
+                last = k
+                if deleted.get(k, -1) < -newest:
+                    yield row
+            if unkeyed and flagged[entry["table"]]:
+                for row in store.stream_rows(entry["table"], names, key, unkeyed_field + " = 1", chunk_size):
+                    yield row
+
+        return names, merged()
+
+    def rebuild(self, dataset, stamp=None):
+
+        # -> (fields, columns, geometry_type, spatial_reference) of the stamp version (latest if None), rows in key order
+        names, rows = self.rows(dataset, stamp)
+        versions = self.versions(dataset)
+        entry = versions[self._target(versions, stamp)]
+        values = [[] for name in names]
+        for row in rows:
+            for column, value in zip(values, row):
+                column.append(value)
+        fields = [tuple(f) for f in entry["fields"]]
+        columns = dict((name, object_array(column)) for name, column in zip(names, values))
+        if entry["geometry_type"]:
+            fields.append(("Shape", "GEOMETRY", None))
+        return fields, columns, entry["geometry_type"], entry["spatial_reference"]
+
+    def export(self, dataset, stamp, out_table, backend=None):
+
+        # writes the stamp version of dataset (latest if None) to out_table -> out_table
+        fields, columns, geometry_type, spatial_reference = self.rebuild(dataset, stamp)
+        return get_backend(backend).create_table(out_table, fields, columns, None, geometry_type, spatial_reference)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Archive store of the MS4 datasets")
+    parser.add_argument("store", help="archive store directory")
+    sub = parser.add_subparsers(dest="command")
+    listing = sub.add_parser("list", help="list datasets or the versions of one")
+    listing.add_argument("dataset", nargs="?")
+    export = sub.add_parser("export", help="rebuild a version into a table")
+    export.add_argument("dataset")
+    export.add_argument("stamp")
+    export.add_argument("out_table")
+    load = sub.add_parser("import", help="archive an existing table (e.g. an old dated copy in Archive.gdb)")
+    load.add_argument("dataset")
+    load.add_argument("stamp")
+    load.add_argument("table")
+    compact = sub.add_parser("compact", help="write the latest version as a new base")
+    compact.add_argument("dataset")
+    args = parser.parse_args(argv)
+
+    store = ArchiveStore(args.store)
+    if args.command == "list":
+        if args.dataset is None:
+            for dataset in store.datasets():
+                versions = store.versions(dataset)
+                print("{0}: {1} versions, {2} to {3}".format(dataset, len(versions), versions[0]["stamp"], versions[-1]["stamp"]))
+        else:
+            for v in store.versions(args.dataset):
+                print("{0} {1:<5} {2:>7} rows  +{3} ~{4} -{5}  archived {6}".format(
+                    v["stamp"], v["kind"], v["rows"], v["inserted"], v["updated"], v["deleted"], v["archived"]))
+    elif args.command == "export":
+        print(store.export(args.dataset, args.stamp, args.out_table))
+    elif args.command == "import":
+        store.archive(args.table, args.dataset, args.stamp)
+    elif args.command == "compact":
+        store.compact(args.dataset)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
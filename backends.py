@@ -0,0 +1,881 @@
+#-------------------------------------------------------------------------------
+# Name:        backends
+# Purpose:     table access used by BMP_tools and utilities
+#
+# ArcpyBackend wraps arcpy.da cursors and geoprocessing tools.
+# ColumnarBackend keeps tables in memory as numpy columns and saves them to a SQLite file,
+# so the field tools can be run (and benchmarked) without ArcGIS.
+#
+# Tables are read and written a column at a time:
+#   read_columns returns {"OID@": oids, field: array, ...}
+#   write_columns takes the oids to write and an array (or single value) per field
+#-------------------------------------------------------------------------------
+
+import collections, datetime, json, numbers, os, re, sqlite3
+import numpy
+from instrument import add_rows
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+
+Field = collections.namedtuple("Field", ["name", "type", "length"])
+
+# arcpy.ListFields type -> arcpy.AddField_management type
+# backends describe fields with the AddField names plus OID and GEOMETRY
+arcpy_field_types = {"OID": "OID", "Geometry": "GEOMETRY", "String": "TEXT", "Integer": "LONG",
+                     "SmallInteger": "SHORT", "Double": "DOUBLE", "Single": "FLOAT", "Date": "DATE",
+                     "GUID": "GUID", "GlobalID": "GUID", "Blob": "BLOB", "Raster": "RASTER"}
+
+numeric_types = ("LONG", "SHORT", "DOUBLE", "FLOAT")
+
+
+def as_field(field):
+
+    # (name, type) or (name, type, length) -> Field
+    field = tuple(field)
+    return Field(*(field + (None,) * (3 - len(field))))
+
+_default_backend = None
+
+
+def set_backend(backend):
+
+    # sets the backend used by BMP_tools / utilities when none is passed in - None goes back to arcpy
+    global _default_backend
+    _default_backend = backend
+
+
+def get_backend(backend=None):
+
+    if backend is not None:
+        return backend
+    if _default_backend is not None:
+        return _default_backend
+    if arcpy is None:
+        raise RuntimeError("arcpy is not available - pass a backend or call backends.set_backend")
+    return ArcpyBackend()
+
+
+def as_column(values):
+
+    # numbers with no nulls become a numeric array, anything else (text, dates, nulls, geometry) an object array
+    if isinstance(values, numpy.ndarray):
+        return values
+    values = list(values)
+    if values and all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in values):
+        return numpy.array(values)
+    return object_array(values)
+
+
+def object_array(values):
+
+    values = list(values)
+    column = numpy.empty(len(values), dtype=object)
+    try:
+        column[:] = values
+    except (ValueError, TypeError): # nested sequences (geometry) - numpy tries to broadcast them
+        for i, value in enumerate(values):
+            column[i] = value
+    return column
+
+
+def is_null(column):
+
+    if column.dtype == object:
+        return numpy.array([v is None for v in column], dtype=bool)
+    return numpy.zeros(len(column), dtype=bool)
+
+
+def changed(old, new):
+
+    # elementwise old != new as a bool array, new may be a single value
+    new = _broadcast(new, len(old))
+    if (old.dtype == object) != (new.dtype == object):
+        old, new = old.astype(object), new.astype(object)
+    return numpy.asarray(old != new, dtype=bool)
+
+
+def map_values(column, lookup, missing=None):
+
+    # lookup[value] for each value in column (missing where not a key) as an object array
+    # numeric columns are factorised first so the dict is only hit once per distinct value
+    if column.dtype != object and len(column):
+        distinct, inverse = numpy.unique(column, return_inverse=True)
+        mapped = object_array([lookup.get(key, missing) for key in distinct.tolist()])
+        return mapped[inverse.ravel()]
+    result = []
+    for key in column.tolist() if column.dtype != object else column:
+        try:
+            result.append(lookup.get(key, missing))
+        except TypeError: # unhashable value can never be a key
+            result.append(missing)
+    return object_array(result)
+
+
+def coordinates_geometry(coordinates, geometry_type, spatial_reference=None):
+
+    # the plain coordinates ColumnarBackend stores -> arcpy geometry (the reverse of geometry_coordinates)
+    # polygon holes come back as their own rings, which arcpy turns back into holes when it simplifies the polygon
+    if coordinates is None or arcpy is None:
+        return coordinates
+    if spatial_reference is not None and not hasattr(spatial_reference, "factoryCode"):
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(spatial_reference)
+        spatial_reference = sr
+    if geometry_type == "POINT":
+        return arcpy.PointGeometry(arcpy.Point(*coordinates), spatial_reference)
+    points = [arcpy.Point(x, y) for part in coordinates for x, y in part]
+    if geometry_type == "MULTIPOINT":
+        return arcpy.Multipoint(arcpy.Array(points), spatial_reference)
+    parts = arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in part]) for part in coordinates])
+    return (arcpy.Polygon if geometry_type == "POLYGON" else arcpy.Polyline)(parts, spatial_reference)
+
+
+def cast_value(value, field_type):
+
+    # value -> the python type stored in a field_type field (None stays None)
+    if value is None or field_type not in numeric_types + ("TEXT",):
+        return value
+    if field_type == "TEXT":
+        return value if isinstance(value, (str, type(u""))) else str(value)
+    if field_type in ("LONG", "SHORT"):
+        return int(value)
+    return float(value)
+
+
+def convert_values(values, field_type, lookup=None):
+
+    # values -> a column of field_type, optionally passed through lookup first (unmatched values become None)
+    if lookup is not None:
+        values = map_values(as_column(values), lookup, None)
+    return as_column([cast_value(v, field_type) for v in values])
+
+
+def geometry_coordinates(shape):
+
+    # arcpy geometry -> the plain coordinates ColumnarBackend stores
+    # points -> (x, y), lines / polygons -> list of parts / rings of (x, y) (interior rings become their own ring)
+    if shape is None or isinstance(shape, (tuple, list)):
+        return shape
+    if shape.type == "point":
+        return (shape.firstPoint.X, shape.firstPoint.Y)
+    if shape.type == "multipoint":
+        return [[(point.X, point.Y) for point in shape if point is not None]]
+    parts = []
+    for part in shape:
+        ring = []
+        for point in part:
+            if point is None: # next ring of the same part
+                if ring:
+                    parts.append(ring)
+                ring = []
+                continue
+            ring.append((point.X, point.Y))
+        if ring:
+            parts.append(ring)
+    return parts
+
+
+def sql_literal(value):
+
+    # value -> SQL literal for a where clause
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return repr(value.item() if isinstance(value, numpy.generic) else value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def read_columns_for_keys(backend, table, key_field, fields, keys, batch_size=999, full_scan_fraction=0.2):
+
+    # reads key_field + fields only for rows whose key_field is in keys
+    # keys go to the database in batched "key_field IN (...)" where clauses (999 stays under Oracle's 1000 item limit)
+    # if the keys are more than full_scan_fraction of the table's rows one full read is cheaper and is used instead
+    # (so the result may then hold rows for other keys too)
+    keys = sorted(set(k for k in keys if k is not None), key=lambda k: (str(type(k)), k))
+    fields = [key_field] + list(fields)
+    if not keys or len(keys) > full_scan_fraction * backend.count(table):
+        if not keys:
+            return backend.read_columns(table, fields, "1 = 0")
+        return backend.read_columns(table, fields)
+
+    batches = []
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        where = "{0} IN ({1})".format(key_field, ", ".join(sql_literal(k) for k in chunk))
+        batches.append(backend.read_columns(table, fields, where))
+    if len(batches) == 1:
+        return batches[0]
+    result = collections.OrderedDict()
+    for name in batches[0]:
+        columns = [batch[name] for batch in batches]
+        if any(column.dtype == object for column in columns):
+            columns = [column.astype(object) for column in columns]
+        result[name] = numpy.concatenate(columns)
+    return result
+
+
+def _broadcast(value, count):
+
+    if isinstance(value, numpy.ndarray):
+        return value
+    if isinstance(value, list) and len(value) == count:
+        return object_array(value)
+    return object_array([value] * count)
+
+
+class TableBackend(object):
+
+    # interface shared by the backends - table is a path for arcpy, a table name for ColumnarBackend
+
+    def list_fields(self, table):
+        raise NotImplementedError
+
+    def add_field(self, table, name, field_type, length=None):
+        raise NotImplementedError
+
+    def add_fields(self, table, fields):
+        for field in fields:
+            self.add_field(table, *as_field(field))
+
+    def read_columns(self, table, fields, where=None):
+        raise NotImplementedError
+
+    def write_columns(self, table, oids, columns):
+        raise NotImplementedError
+
+    def select(self, table, where):
+        raise NotImplementedError
+
+    def ordered_oids(self, table, field, where=None):
+        # -> the OIDs of table (rows matching where) in the database's order of field, ties in OID order
+        raise NotImplementedError
+
+    def copy_table(self, table, out_table, field_map):
+        # field_map is an ordered list of (source name, output name) - only these fields are carried over
+        # OID and geometry are always carried
+        raise NotImplementedError
+
+    def copy(self, table, out_table):
+        # whole copy of table, every field as it is
+        fields = [f.name for f in self.list_fields(table) if f.type not in ("OID", "GEOMETRY")]
+        return self.copy_table(table, out_table, [(name, name) for name in fields])
+
+    def rename(self, table, new_name):
+        # new_name must not exist yet
+        raise NotImplementedError
+
+    def transform_table(self, table, out_table, fields):
+        # one copy of table to out_table reshaping the schema on the way
+        # fields is an ordered list of (source name, output Field, lookup or None) - values are passed through
+        # lookup (if given) and cast to the output field type; OID and geometry are always carried
+        raise NotImplementedError
+
+    def create_table(self, name, fields, columns, oids=None, geometry_type=None, spatial_reference=None):
+        # new table (feature class if geometry_type) holding columns - fields as for add_fields plus one
+        # GEOMETRY field whose column holds plain coordinates (see geometry_coordinates)
+        raise NotImplementedError
+
+    def spatial_reference(self, table):
+        # spatial reference as a string create_table can take, None if unknown
+        return None
+
+    def count(self, table):
+        return len(self.read_columns(table, [])["OID@"])
+
+    def geometry_type(self, table):
+        # "POINT", "POLYLINE", "POLYGON" ... or None for a table
+        raise NotImplementedError
+
+    def max_value(self, table, field):
+        values = [v for v in self.read_columns(table, [field])[field] if v is not None]
+        return max(values) if values else None
+
+    def exists(self, table):
+        raise NotImplementedError
+
+    def delete(self, table):
+        raise NotImplementedError
+
+
+class ArcpyBackend(TableBackend):
+
+    def list_fields(self, table):
+        return [Field(f.name, arcpy_field_types.get(f.type, f.type.upper()), f.length) for f in arcpy.ListFields(table)]
+
+    def add_field(self, table, name, field_type, length=None):
+        arcpy.AddField_management(table, name, field_type, "", "", length if length else "")
+
+    def add_fields(self, table, fields):
+        fields = [as_field(field) for field in fields]
+        if fields and hasattr(arcpy.management, "AddFields"):
+            arcpy.management.AddFields(table, [[name, field_type, "", length if length else ""] for name, field_type, length in fields])
+        else:
+            TableBackend.add_fields(self, table, fields)
+
+    def read_columns(self, table, fields, where=None):
+        fields = list(fields)
+        values = [[] for field in fields]
+        oids = []
+        with arcpy.da.SearchCursor(table, ["OID@"] + fields, where) as cursor:
+            for row in cursor:
+                oids.append(row[0])
+                for column, value in zip(values, row[1:]):
+                    column.append(value)
+        add_rows(len(oids))
+        result = collections.OrderedDict()
+        result["OID@"] = numpy.array(oids, dtype=numpy.int64)
+        for field, column in zip(fields, values):
+            result[field] = object_array(column) if field.upper().startswith("SHAPE@") and field.upper() not in ("SHAPE@AREA", "SHAPE@LENGTH") else as_column(column)
+        return result
+
+    def write_columns(self, table, oids, columns):
+        oids = numpy.asarray(oids).tolist()
+        if not oids:
+            return 0
+        position = dict((oid, i) for i, oid in enumerate(oids))
+        fields = list(columns.keys())
+        values = [_broadcast(columns[field], len(oids)) for field in fields]
+        values = [column.tolist() if column.dtype != object else column for column in values]
+        written = 0
+        with arcpy.da.UpdateCursor(table, ["OID@"] + fields) as cursor:
+            for row in cursor:
+                i = position.get(row[0])
+                if i is None:
+                    continue
+                cursor.updateRow([row[0]] + [column[i] for column in values])
+                written += 1
+        return written
+
+    def select(self, table, where):
+        with arcpy.da.SearchCursor(table, ["OID@"], where) as cursor:
+            return numpy.array([row[0] for row in cursor], dtype=numpy.int64)
+
+    def ordered_oids(self, table, field, where=None):
+        oid_field = arcpy.Describe(table).OIDFieldName
+        with arcpy.da.SearchCursor(table, ["OID@"], where, sql_clause=(None, "ORDER BY {0}, {1}".format(field, oid_field))) as cursor:
+            return numpy.array([row[0] for row in cursor], dtype=numpy.int64)
+
+    def copy_table(self, table, out_table, field_map):
+        existing_mapping = arcpy.FieldMappings()
+        existing_mapping.addTable(table)
+        new_mapping = arcpy.FieldMappings()
+        for field_name, new_name in field_map:
+            mapping_index = existing_mapping.findFieldMapIndex(field_name)
+
+            # required fields (OBJECTID, etc) will not be in existing mappings
+            # they are added automatically
+            if mapping_index == -1:
+                continue
+            mapping = existing_mapping.fieldMappings[mapping_index]
+            if new_name != field_name:
+                output_field = mapping.outputField
+                output_field.name = new_name
+                output_field.aliasName = new_name
+                mapping.outputField = output_field
+            new_mapping.addFieldMap(mapping)
+
+        # use merge with single input just to use new field_mappings
+        arcpy.Merge_management(table, out_table, new_mapping)
+        return out_table
+
+    def copy(self, table, out_table):
+        workspace, name = os.path.split(out_table)
+        arcpy.FeatureClassToFeatureClass_conversion(table, workspace, name)
+        return out_table
+
+    def rename(self, table, new_name):
+        arcpy.Rename_management(table, new_name)
+
+    def transform_table(self, table, out_table, fields):
+        # empty output created up front, then one search -> insert cursor pass
+        # required fields (OBJECTID, Shape_Area, etc) are made with the output so are not carried
+        required = set(f.name.upper() for f in arcpy.ListFields(table) if f.required)
+        fields = [(source, field, lookup) for source, field, lookup in fields if source.upper() not in required]
+        description = arcpy.Describe(table)
+        workspace, name = os.path.split(out_table)
+        shape_type = getattr(description, "shapeType", None)
+        if shape_type:
+            arcpy.CreateFeatureclass_management(workspace, name, shape_type.upper(), "",
+                                                "ENABLED" if description.hasM else "DISABLED",
+                                                "ENABLED" if description.hasZ else "DISABLED",
+                                                description.spatialReference)
+        else:
+            arcpy.CreateTable_management(workspace, name)
+        self.add_fields(out_table, [field for source, field, lookup in fields])
+
+        geometry = ["SHAPE@"] if shape_type else []
+        converters = [(dict(lookup) if lookup is not None else None, field.type) for source, field, lookup in fields]
+        with arcpy.da.SearchCursor(table, [source for source, field, lookup in fields] + geometry) as rows:
+            with arcpy.da.InsertCursor(out_table, [field.name for source, field, lookup in fields] + geometry) as cursor:
+                for row in rows:
+                    values = []
+                    for value, (lookup, field_type) in zip(row, converters):
+                        if lookup is not None:
+                            try:
+                                value = lookup.get(value)
+                            except TypeError:
+                                value = None
+                        values.append(cast_value(value, field_type))
+                    cursor.insertRow(values + list(row[len(converters):]))
+        return out_table
+
+    def create_table(self, name, fields, columns, oids=None, geometry_type=None, spatial_reference=None):
+        # (oids are given out by the geodatabase)
+        workspace, table_name = os.path.split(name)
+        fields = [as_field(field) for field in fields]
+        geometry = [f for f in fields if f.type == "GEOMETRY"]
+        fields = [f for f in fields if f.type not in ("GEOMETRY", "OID")]
+        sr = None
+        if geometry_type:
+            if spatial_reference is not None:
+                sr = arcpy.SpatialReference()
+                sr.loadFromString(spatial_reference)
+            arcpy.CreateFeatureclass_management(workspace, table_name, geometry_type, "", "DISABLED", "DISABLED", sr)
+        else:
+            arcpy.CreateTable_management(workspace, table_name)
+        self.add_fields(name, fields)
+
+        shapes = columns[geometry[0].name] if geometry and geometry_type else None
+        count = len(shapes) if shapes is not None else (len(columns[fields[0].name]) if fields else 0)
+        values = [_broadcast(columns[f.name], count) for f in fields]
+        values = [column.tolist() if column.dtype != object else column for column in values]
+        with arcpy.da.InsertCursor(name, [f.name for f in fields] + (["SHAPE@"] if shapes is not None else [])) as cursor:
+            for i in range(count):
+                row = [column[i] for column in values]
+                if shapes is not None:
+                    row.append(coordinates_geometry(shapes[i], geometry_type, sr))
+                cursor.insertRow(row)
+        return name
+
+    def spatial_reference(self, table):
+        sr = getattr(arcpy.Describe(table), "spatialReference", None)
+        return sr.exportToString() if sr is not None else None
+
+    def count(self, table):
+        return int(arcpy.GetCount_management(table).getOutput(0))
+
+    def geometry_type(self, table):
+        return getattr(arcpy.Describe(table), "shapeType", "").upper() or None
+
+    def max_value(self, table, field):
+        # let the database sort rather than pulling the whole column
+        where = "{0} IS NOT NULL".format(field)
+        with arcpy.da.SearchCursor(table, [field], where, sql_clause=(None, "ORDER BY {0} DESC".format(field))) as cursor:
+            for row in cursor:
+                return row[0]
+        return None
+
+    def exists(self, table):
+        return arcpy.Exists(table)
+
+    def delete(self, table):
+        arcpy.Delete_management(table)
+
+
+class ColumnarTable(object):
+
+    # in memory table - oids is a sorted int64 array, columns holds one array per field (same order as fields)
+
+    def __init__(self, fields, columns, oids=None, geometry_type=None):
+        self.fields = [as_field(field) for field in fields]
+        count = len(columns[self.fields[0].name]) if self.fields else 0
+        self.oids = numpy.arange(1, count + 1, dtype=numpy.int64) if oids is None else numpy.asarray(oids, dtype=numpy.int64)
+        self.columns = dict((field.name, as_column(columns[field.name]) if field.type != "GEOMETRY" else object_array(columns[field.name]))
+                            for field in self.fields)
+        self.geometry_type = geometry_type
+
+    def field(self, name):
+        for field in self.fields:
+            if field.name.upper() == name.upper():
+                return field
+        raise KeyError("Field: {0} not in table".format(name))
+
+    def geometry_field(self):
+        for field in self.fields:
+            if field.type == "GEOMETRY":
+                return field
+        return None
+
+
+def _ring_area(ring):
+    area = 0.0
+    for (x1, y1), (x2, y2) in zip(ring, list(ring[1:]) + [ring[0]]):
+        area += x1 * y2 - x2 * y1
+    return area / 2.0
+
+
+def _geometry_area(geometry):
+    # points are (x, y), lines and polygons are lists of parts/rings - holes run the opposite way to the outer ring
+    if geometry is None or not geometry or isinstance(geometry[0], numbers.Real):
+        return 0.0
+    return abs(sum(_ring_area(ring) for ring in geometry))
+
+
+def _geometry_length(geometry, closed):
+    if geometry is None or not geometry or isinstance(geometry[0], numbers.Real):
+        return 0.0
+    length = 0.0
+    for part in geometry:
+        points = list(part) + ([part[0]] if closed else [])
+        for (x1, y1), (x2, y2) in zip(points[:-1], points[1:]):
+            length += ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5
+    return length
+
+
+def _geometry_centroid(geometry):
+    if geometry is None or not geometry:
+        return None
+    if isinstance(geometry[0], numbers.Real):
+        return tuple(geometry)
+    points = [point for part in geometry for point in part]
+    return (sum(p[0] for p in points) / float(len(points)), sum(p[1] for p in points) / float(len(points)))
+
+
+_sqlite_types = {"TEXT": "TEXT", "GUID": "TEXT", "DATE": "TEXT", "LONG": "INTEGER", "SHORT": "INTEGER",
+                 "DOUBLE": "REAL", "FLOAT": "REAL", "BLOB": "BLOB", "GEOMETRY": "TEXT"}
+
+
+def _encode(value, field_type):
+    if value is None:
+        return None
+    if field_type == "GEOMETRY":
+        return json.dumps(value)
+    if field_type == "DATE":
+        return value.isoformat(" ")
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def _decode(value, field_type):
+    if value is None:
+        return None
+    if field_type == "GEOMETRY":
+        geometry = json.loads(value)
+        if geometry and isinstance(geometry[0], numbers.Real):
+            return tuple(geometry)
+        return [[tuple(point) for point in part] for part in geometry]
+    if field_type == "DATE":
+        for date_format in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                return datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+    return value
+
+
+# file gdb date literals (date '2000-01-01', timestamp '2000-01-01 12:00:00') -> the text SQLite holds dates as
+_date_literal = re.compile(r"\b(?:date|timestamp)\s*('[^']*')", re.IGNORECASE)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class ColumnarBackend(TableBackend):
+
+    # numpy column store - tables live in memory and are saved to / loaded from a SQLite file (path)
+    # with no path the tables only live for the life of the backend
+    # select() hands the where clause to an in memory SQLite copy so ArcGIS style SQL works unchanged -
+    # the copy is kept until the table is written to, so repeated selects on a table build it once
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = {}
+        self.dirty = set()
+        self.queries = {}
+
+    def _changed(self, name):
+        self.dirty.add(name)
+        connection = self.queries.pop(name, None)
+        if connection is not None:
+            connection.close()
+
+    # --- table management ---
+
+    def create_table(self, name, fields, columns, oids=None, geometry_type=None, spatial_reference=None):
+        # (spatial_reference is not kept - coordinates are stored as they are)
+        self.tables[name] = ColumnarTable(fields, columns, oids, geometry_type)
+        self._changed(name)
+        return name
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = self._load(name)
+        return self.tables[name]
+
+    def list_tables(self):
+        names = set(self.tables)
+        if self.path and os.path.exists(self.path):
+            connection = sqlite3.connect(self.path)
+            try:
+                self._ensure_metadata(connection)
+                names.update(row[0] for row in connection.execute("SELECT table_name FROM columnar_tables"))
+            finally:
+                connection.close()
+        return sorted(names)
+
+    def exists(self, table):
+        return table in self.list_tables()
+
+    def delete(self, table):
+        self.tables.pop(table, None)
+        self._changed(table)
+        self.dirty.discard(table)
+        if self.path and os.path.exists(self.path):
+            connection = sqlite3.connect(self.path)
+            try:
+                self._ensure_metadata(connection)
+                connection.execute("DROP TABLE IF EXISTS " + _quote(table))
+                connection.execute("DELETE FROM columnar_tables WHERE table_name = ?", (table,))
+                connection.execute("DELETE FROM columnar_fields WHERE table_name = ?", (table,))
+                connection.commit()
+            finally:
+                connection.close()
+
+    def rename(self, table, new_name):
+        if self.exists(new_name):
+            raise KeyError("Table: {0} already exists".format(new_name))
+        t = self.table(table)
+        self.delete(table)
+        self.tables[new_name] = t
+        self._changed(new_name)
+
+    def save(self, names=None):
+
+        # writes changed tables to the SQLite file
+        if not self.path:
+            return
+        names = sorted(self.dirty) if names is None else names
+        connection = sqlite3.connect(self.path)
+        try:
+            self._ensure_metadata(connection)
+            for name in names:
+                self._save(connection, name, self.tables[name])
+                self.dirty.discard(name)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _ensure_metadata(self, connection):
+        connection.execute("CREATE TABLE IF NOT EXISTS columnar_tables (table_name TEXT PRIMARY KEY, geometry_type TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS columnar_fields (table_name TEXT, position INTEGER, name TEXT, type TEXT, length INTEGER)")
+
+    def _save(self, connection, name, table):
+        connection.execute("DROP TABLE IF EXISTS " + _quote(name))
+        columns = ", ".join("{0} {1}".format(_quote(f.name), _sqlite_types.get(f.type, "")) for f in table.fields)
+        connection.execute("CREATE TABLE {0} (OBJECTID INTEGER PRIMARY KEY{1})".format(_quote(name), ", " + columns if columns else ""))
+        encoded = [[_encode(v, f.type) for v in table.columns[f.name]] for f in table.fields]
+        placeholders = ", ".join(["?"] * (len(table.fields) + 1))
+        connection.executemany("INSERT INTO {0} VALUES ({1})".format(_quote(name), placeholders), zip(table.oids.tolist(), *encoded))
+        connection.execute("DELETE FROM columnar_tables WHERE table_name = ?", (name,))
+        connection.execute("DELETE FROM columnar_fields WHERE table_name = ?", (name,))
+        connection.execute("INSERT INTO columnar_tables VALUES (?, ?)", (name, table.geometry_type))
+        connection.executemany("INSERT INTO columnar_fields VALUES (?, ?, ?, ?, ?)",
+                               [(name, i, f.name, f.type, f.length) for i, f in enumerate(table.fields)])
+
+    def _load(self, name):
+        if not self.path or not os.path.exists(self.path):
+            raise KeyError("Table: {0} does not exist".format(name))
+        connection = sqlite3.connect(self.path)
+        try:
+            geometry_type, fields = self._metadata(connection, name)
+            names = ", ".join(["OBJECTID"] + [_quote(f.name) for f in fields])
+            rows = connection.execute("SELECT {0} FROM {1} ORDER BY OBJECTID".format(names, _quote(name))).fetchall()
+        finally:
+            connection.close()
+        values = list(zip(*rows)) if rows else [[] for i in range(len(fields) + 1)]
+        columns = dict((f.name, [_decode(v, f.type) for v in values[i + 1]]) for i, f in enumerate(fields))
+        return ColumnarTable(fields, columns, values[0], geometry_type)
+
+    def _metadata(self, connection, name):
+        # -> (geometry_type, fields) of a saved table, from the metadata tables only
+        self._ensure_metadata(connection)
+        info = connection.execute("SELECT geometry_type FROM columnar_tables WHERE table_name = ?", (name,)).fetchone()
+        if info is None:
+            raise KeyError("Table: {0} does not exist".format(name))
+        fields = [Field(*row) for row in connection.execute(
+            "SELECT name, type, length FROM columnar_fields WHERE table_name = ? ORDER BY position", (name,))]
+        return info[0], fields
+
+    def add_index(self, name, field):
+        # indexes field of a saved table in the SQLite file (for stream_rows ordered on it)
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+                _quote(name + "_" + field + "_index"), _quote(name), _quote(field)))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def stream_rows(self, name, fields, order_by, where=None, chunk_size=10000):
+
+        # yields the rows of a saved table as lists of fields values, in order_by order, read from the SQLite
+        # file chunk_size rows at a time - the table is never loaded whole (where is SQLite SQL)
+        if name in self.dirty:
+            self.save([name])
+        connection = sqlite3.connect(self.path)
+        try:
+            types = dict((row[0].upper(), row[1]) for row in connection.execute(
+                "SELECT name, type FROM columnar_fields WHERE table_name = ?", (name,)))
+            cursor = connection.execute("SELECT {0} FROM {1}{2} ORDER BY {3}, OBJECTID".format(
+                ", ".join(_quote(f) for f in fields), _quote(name), " WHERE " + where if where else "", _quote(order_by)))
+            field_types = [types[f.upper()] for f in fields]
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                add_rows(len(rows))
+                for row in rows:
+                    yield [_decode(v, t) for v, t in zip(row, field_types)]
+        finally:
+            connection.close()
+
+    # --- TableBackend ---
+
+    def list_fields(self, table):
+        # a saved table not yet loaded is described from the metadata, without reading its rows
+        if table in self.tables or not self.path or not os.path.exists(self.path):
+            fields = self.table(table).fields
+        else:
+            connection = sqlite3.connect(self.path)
+            try:
+                fields = self._metadata(connection, table)[1]
+            finally:
+                connection.close()
+        return [Field("OBJECTID", "OID", 4)] + list(fields)
+
+    def add_field(self, table, name, field_type, length=None):
+        t = self.table(table)
+        if any(f.name.upper() == name.upper() for f in t.fields):
+            return
+        t.fields.append(Field(name, field_type, length))
+        t.columns[name] = object_array([None] * len(t.oids))
+        self._changed(table)
+
+    def _positions(self, t, oids):
+        oids = numpy.asarray(oids, dtype=numpy.int64)
+        positions = numpy.searchsorted(t.oids, oids)
+        if len(oids) and (positions.max() >= len(t.oids) or (t.oids[positions] != oids).any()):
+            raise KeyError("Unknown OID in write")
+        return positions
+
+    def _column(self, t, name, positions):
+        upper = name.upper()
+        if upper in ("OID@", "OBJECTID"):
+            return t.oids[positions]
+        if upper.startswith("SHAPE@"):
+            geometry = t.geometry_field()
+            shapes = t.columns[geometry.name][positions] if geometry else object_array([None] * len(positions))
+            if upper in ("SHAPE@", "SHAPE@JSON"):
+                return shapes
+            if upper == "SHAPE@AREA":
+                return numpy.array([_geometry_area(g) for g in shapes], dtype=float)
+            if upper == "SHAPE@LENGTH":
+                closed = t.geometry_type == "POLYGON"
+                return numpy.array([_geometry_length(g, closed) for g in shapes], dtype=float)
+            if upper == "SHAPE@XY":
+                return object_array([_geometry_centroid(g) for g in shapes])
+            raise KeyError("Token: {0} not supported".format(name))
+        return t.columns[t.field(name).name][positions]
+
+    def read_columns(self, table, fields, where=None):
+        t = self.table(table)
+        positions = numpy.arange(len(t.oids)) if where is None else self._positions(t, self.select(table, where))
+        add_rows(len(positions))
+        result = collections.OrderedDict()
+        result["OID@"] = t.oids[positions]
+        for field in fields:
+            result[field] = self._column(t, field, positions)
+        return result
+
+    def write_columns(self, table, oids, columns):
+        t = self.table(table)
+        positions = self._positions(t, oids)
+        for field, values in columns.items():
+            if field.upper().startswith("SHAPE@"):
+                field = t.geometry_field().name
+            name = t.field(field).name
+            column = t.columns[name]
+            values = _broadcast(values, len(positions))
+            if column.dtype != object and (values.dtype == object or values.dtype.kind not in "biuf"):
+                column = column.astype(object)
+            elif column.dtype != object and column.dtype.kind in "iu" and values.dtype.kind == "f":
+                column = column.astype(float)
+            column[positions] = values
+            t.columns[name] = column
+        self._changed(table)
+        return len(positions)
+
+    def select(self, table, where):
+        t = self.table(table)
+        if where is None or not str(where).strip():
+            return t.oids.copy()
+        where = _date_literal.sub(r"\1", where)
+        oids = [row[0] for row in self._query(table, t).execute("SELECT OBJECTID FROM t WHERE " + where + " ORDER BY OBJECTID")]
+        return numpy.array(oids, dtype=numpy.int64)
+
+    def ordered_oids(self, table, field, where=None):
+        t = self.table(table)
+        where = " WHERE " + _date_literal.sub(r"\1", where) if where else ""
+        query = "SELECT OBJECTID FROM t{0} ORDER BY {1}, OBJECTID".format(where, _quote(t.field(field).name))
+        return numpy.array([row[0] for row in self._query(table, t).execute(query)], dtype=numpy.int64)
+
+    def _query(self, name, t):
+        # in memory SQLite copy of the table's attributes (not the geometry) for select
+        if name not in self.queries:
+            fields = [f for f in t.fields if f.type != "GEOMETRY"]
+            connection = sqlite3.connect(":memory:", check_same_thread=False)
+            columns = ", ".join(["OBJECTID INTEGER PRIMARY KEY"] + [_quote(f.name) + " " + _sqlite_types.get(f.type, "") for f in fields])
+            connection.execute("CREATE TABLE t ({0})".format(columns))
+            encoded = [[_encode(v, f.type) for v in t.columns[f.name]] for f in fields]
+            placeholders = ", ".join(["?"] * (len(fields) + 1))
+            connection.executemany("INSERT INTO t VALUES ({0})".format(placeholders), zip(t.oids.tolist(), *encoded))
+            self.queries[name] = connection
+        return self.queries[name]
+
+    def copy_table(self, table, out_table, field_map):
+        t = self.table(table)
+        fields = []
+        columns = {}
+        for field_name, new_name in field_map:
+            if field_name.upper() == "OBJECTID":
+                continue
+            field = t.field(field_name)
+            if field.type in ("OID", "GEOMETRY"):
+                continue
+            fields.append(Field(new_name, field.type, field.length))
+            columns[new_name] = t.columns[field.name].copy()
+        geometry = t.geometry_field()
+        if geometry is not None:
+            fields.append(geometry)
+            columns[geometry.name] = t.columns[geometry.name].copy()
+        self.create_table(out_table, fields, columns, None, t.geometry_type)
+        return out_table
+
+    def transform_table(self, table, out_table, fields):
+        t = self.table(table)
+        out_fields = []
+        columns = {}
+        for source, field, lookup in fields:
+            column = t.columns[t.field(source).name]
+            if lookup is not None or field.type != t.field(source).type:
+                column = convert_values(column, field.type, lookup)
+            else:
+                column = column.copy()
+            out_fields.append(field)
+            columns[field.name] = column
+        geometry = t.geometry_field()
+        if geometry is not None:
+            out_fields.append(geometry)
+            columns[geometry.name] = t.columns[geometry.name].copy()
+        self.create_table(out_table, out_fields, columns, None, t.geometry_type)
+        return out_table
+
+    def count(self, table):
+        return len(self.table(table).oids)
+
+    def geometry_type(self, table):
+        return self.table(table).geometry_type
@@ -0,0 +1,300 @@
+#-------------------------------------------------------------------------------
+# Name:        benchmark
+# Purpose:     times the BMP_tools / utilities field tools on synthetic tables
+#
+# Builds synthetic point / polygon tables in a ColumnarBackend at each requested size and key cardinality,
+# runs each tool in its own process and writes wall time, memory and rows per second to a JSON results file.
+# Memory is measured around the tool call only: setup_rss_kb is the RSS once the tables are built, and (on Linux,
+# where the peak can be reset after setup) peak_rss_kb is the peak while the tool ran and tool_rss_kb what the
+# tool added on top of setup. Elsewhere peak_rss_kb is the process peak, setup included, and tool_rss_kb is null.
+# If a baseline results file is given, any tool that is slower than the baseline by more than the tolerance
+# is flagged and the exit code is 1.
+#
+#   python benchmark.py --sizes 10000 100000 1000000 --cardinality 6 1000
+#   python benchmark.py --baseline bench_baseline.json
+#   python benchmark.py --save-baseline bench_baseline.json
+#-------------------------------------------------------------------------------
+
+import argparse, datetime, gc, json, os, platform, subprocess, sys, tempfile, time
+import numpy
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+import backends
+
+
+def peak_rss_kb():
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak # bytes on mac, KB on linux
+
+
+def rss_kb():
+
+    # current resident memory, None where /proc is not available
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+
+    # starts the peak RSS over from the current RSS (Linux only) -> True if it was reset
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def make_points(backend, name, rows, cardinality, seed=0):
+
+    # points with an integer key (Watershed, 1..cardinality), a text key (HANSEN_ID) and the standard UID field
+    random = numpy.random.RandomState(seed)
+    watershed = random.randint(1, cardinality + 1, rows)
+    fields = [("Index_ID", "LONG"), ("Watershed", "SHORT"), ("HANSEN_ID", "TEXT", 10),
+              ("Watershed_txt", "TEXT", 25), ("Pipe_Dia", "DOUBLE"), ("UID", "LONG"), ("Shape", "GEOMETRY")]
+    columns = {"Index_ID": numpy.arange(1, rows + 1),
+               "Watershed": watershed,
+               "HANSEN_ID": backends.object_array(["N{0}".format(k) for k in random.randint(0, cardinality, rows)]),
+               "Watershed_txt": backends.object_array([None] * rows),
+               "Pipe_Dia": backends.object_array([None] * rows),
+               "UID": backends.object_array([None] * rows),
+               "Shape": backends.object_array(list(zip(random.uniform(0, 1000, rows).tolist(), random.uniform(0, 1000, rows).tolist())))}
+    return backend.create_table(name, fields, columns, geometry_type="POINT")
+
+
+def make_polygons(backend, name, rows, cardinality, seed=0, offset=0.0):
+
+    # square polygons on a grid (shifted by offset), each tagged with one of cardinality zone codes (Acres left empty)
+    random = numpy.random.RandomState(seed)
+    side = int(numpy.ceil(numpy.sqrt(rows)))
+    shapes = []
+    for i in range(rows):
+        x, y = (i % side) * 10.0 + offset, (i // side) * 10.0 + offset
+        shapes.append([[(x, y), (x, y + 10.0), (x + 10.0, y + 10.0), (x + 10.0, y), (x, y)]])
+    fields = [("Index_ID", "LONG"), ("ZONE", "TEXT", 10), ("Acres", "DOUBLE"), ("Shape", "GEOMETRY")]
+    columns = {"Index_ID": numpy.arange(1, rows + 1),
+               "ZONE": backends.object_array(["Z{0}".format(k) for k in random.randint(0, cardinality, rows)]),
+               "Acres": backends.object_array([None] * rows),
+               "Shape": backends.object_array(shapes)}
+    return backend.create_table(name, fields, columns, geometry_type="POLYGON")
+
+
+def make_lines(backend, name, cardinality, seed=0):
+
+    # one source row per key - TO_NODE matches the points HANSEN_ID values
+    random = numpy.random.RandomState(seed)
+    fields = [("TO_NODE", "TEXT", 10), ("PIPESIZE", "DOUBLE")]
+    columns = {"TO_NODE": backends.object_array(["N{0}".format(k) for k in range(cardinality)]),
+               "PIPESIZE": random.choice([6.0, 8.0, 12.0, 24.0, 36.0], cardinality)}
+    return backend.create_table(name, fields, columns)
+
+
+def make_pipes(backend, name, rows, seed=0):
+
+    # short random walk polylines over the same area as make_points, each with a pipe size
+    random = numpy.random.RandomState(seed)
+    starts = random.uniform(0, 1000, (rows, 2))
+    steps = random.uniform(-10, 10, (rows, 4, 2)).cumsum(axis=1)
+    shapes = [[[tuple(start)] + [tuple(p) for p in (start + walk).tolist()]] for start, walk in zip(starts.tolist(), steps)]
+    fields = [("PIPESIZE", "DOUBLE"), ("Shape", "GEOMETRY")]
+    columns = {"PIPESIZE": random.choice([6.0, 8.0, 12.0, 24.0, 36.0], rows),
+               "Shape": backends.object_array(shapes)}
+    return backend.create_table(name, fields, columns, geometry_type="POLYLINE")
+
+
+# tool name -> (setup(backend, rows, cardinality) -> args, run(backend, *args))
+# setup is not timed
+
+def _setup_points(backend, rows, cardinality):
+    return (make_points(backend, "points", rows, cardinality),)
+
+def _setup_lookup(backend, rows, cardinality):
+    return (make_points(backend, "points", rows, cardinality), dict((k, "WS {0}".format(k)) for k in range(1, cardinality + 1)))
+
+def _setup_join(backend, rows, cardinality):
+    return (make_lines(backend, "lines", cardinality), make_points(backend, "points", rows, cardinality))
+
+def _setup_overlap(backend, rows, cardinality):
+    return (make_polygons(backend, "bounds", rows, cardinality, 1), make_polygons(backend, "zoning", rows, cardinality, 2, 3.0))
+
+def _setup_proximity(backend, rows, cardinality):
+    return (make_points(backend, "points", rows, cardinality), make_pipes(backend, "pipes", max(rows // 10, 1), 3))
+
+def _run_fillField_fromDict(backend, points, lookup):
+    from BMP_tools import fillField_fromDict
+    fillField_fromDict(points, lookup, "Watershed", "Watershed_txt", backend=backend)
+
+def _run_CopyFieldFromFeature(backend, lines, points):
+    from BMP_tools import CopyFieldFromFeature
+    CopyFieldFromFeature(lines, "TO_NODE", "PIPESIZE", points, "HANSEN_ID", "Pipe_Dia", backend=backend)
+
+def _run_calcField_fromOverlap(backend, bounds, zoning):
+    from BMP_tools import calcField_fromOverlap
+    calcField_fromOverlap(bounds, "ZONE", "Index_ID", zoning, "ZONE", backend=backend)
+
+def _run_calcField_overlapArea(backend, bounds, zoning):
+    from BMP_tools import calcField_overlapArea
+    calcField_overlapArea(bounds, "Acres", zoning, where="ZONE <> 'Z0'", factor=1 / 43560.0, backend=backend)
+
+def _run_incrementField(backend, points):
+    from BMP_tools import incrementField
+    # a fresh state file each case - the default one would carry the high-water mark over between cases
+    state = os.path.join(tempfile.gettempdir(), "bench_uids_{0}.json".format(os.getpid()))
+    if os.path.exists(state):
+        os.remove(state)
+    try:
+        incrementField(points, state_path=state, backend=backend)
+    finally:
+        if os.path.exists(state):
+            os.remove(state)
+
+def _run_reorder_fields(backend, points):
+    from utilities import reorder_fields
+    reorder_fields(points, "points_reorder", ["UID", "Index_ID", "HANSEN_ID", "Watershed"], add_missing=True, backend=backend)
+
+def _run_rename_fields(backend, points):
+    from utilities import rename_fields
+    rename_fields(points, "points_rename", {"Watershed_txt": "Watershed_name", "HANSEN_ID": "Hansen"}, backend=backend)
+
+def _run_transform_fields(backend, points, lookup):
+    from utilities import transform_fields
+    transform_fields(points, "points_transform", drop=["Watershed_txt"], rename={"HANSEN_ID": "Hansen"},
+                     order=["UID", "Index_ID", "Hansen", "Watershed"], casts={"Watershed": ("TEXT", 25)},
+                     values={"Watershed": lookup}, backend=backend)
+
+def _run_calcField(backend, points):
+    from BMP_tools import calcField
+    calcField(points, "Pipe_Dia", "round(coalesce(!Index_ID!, 0) * 1.5 / 7, 2)", backend=backend)
+
+def _run_calcField_nearest(backend, points, pipes):
+    from BMP_tools import calcField_nearest
+    calcField_nearest(points, "Pipe_Dia", pipes, "PIPESIZE", backend=backend)
+
+def _run_calcField_withinDistance(backend, points, pipes):
+    from BMP_tools import calcField_withinDistance
+    calcField_withinDistance(points, pipes, None, 5, "UID", 1, backend=backend)
+
+def _run_fillFields_Conditional(backend, points):
+    from BMP_tools import fillFields_Conditional
+    fillFields_Conditional(points, [("Watershed = 1", "Watershed_txt", "first"), ("Watershed < 4", "Watershed_txt", "low"),
+                                    (None, "Watershed_txt", "other"), ("Index_ID > 100", "UID", 1)], backend=backend)
+
+tools = {"fillField_fromDict": (_setup_lookup, _run_fillField_fromDict),
+         "CopyFieldFromFeature": (_setup_join, _run_CopyFieldFromFeature),
+         "calcField_fromOverlap": (_setup_overlap, _run_calcField_fromOverlap),
+         "calcField_overlapArea": (_setup_overlap, _run_calcField_overlapArea),
+         "incrementField": (_setup_points, _run_incrementField),
+         "reorder_fields": (_setup_points, _run_reorder_fields),
+         "rename_fields": (_setup_points, _run_rename_fields),
+         "transform_fields": (_setup_lookup, _run_transform_fields),
+         "calcField": (_setup_points, _run_calcField),
+         "calcField_nearest": (_setup_proximity, _run_calcField_nearest),
+         "calcField_withinDistance": (_setup_proximity, _run_calcField_withinDistance),
+         "fillFields_Conditional": (_setup_points, _run_fillFields_Conditional)}
+
+
+def run_case(tool, rows, cardinality):
+
+    # runs one tool in this process and returns its result record
+    backend = backends.ColumnarBackend()
+    setup, run = tools[tool]
+    args = setup(backend, rows, cardinality)
+    gc.collect()
+    setup_rss = rss_kb()
+    reset = reset_peak_rss() and setup_rss is not None
+    start = time.time()
+    run(backend, *args)
+    wall = time.time() - start
+    peak = peak_rss_kb()
+    return {"tool": tool, "rows": rows, "cardinality": cardinality, "wall_s": round(wall, 4),
+            "setup_rss_kb": setup_rss, "peak_rss_kb": peak,
+            "tool_rss_kb": max(peak - setup_rss, 0) if reset and peak is not None else None,
+            "rows_per_s": round(rows / wall, 1) if wall > 0 else None}
+
+
+def run_isolated(tool, rows, cardinality):
+
+    # runs one tool in a child process so no other tool's tables or peak count towards it
+    # (run from the temp directory so the tools' Script_Log.log does not land in the repo)
+    command = [sys.executable, os.path.abspath(__file__), "--case", tool, str(rows), str(cardinality)]
+    output = subprocess.check_output(command, cwd=tempfile.gettempdir())
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+
+    # -> list of (result, baseline result) where the wall time went up by more than tolerance
+    previous = dict(((r["tool"], r["rows"], r["cardinality"]), r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        old = previous.get((result["tool"], result["rows"], result["cardinality"]))
+        if old is not None and result["wall_s"] > old["wall_s"] * (1 + tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the BMP_tools / utilities field tools on synthetic tables")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="row counts to run (up to 10000000)")
+    parser.add_argument("--cardinality", type=int, nargs="+", default=[6, 1000], help="distinct key counts to run")
+    parser.add_argument("--tools", nargs="+", default=sorted(tools), choices=sorted(tools))
+    parser.add_argument("--output", default="bench_results.json", help="results file")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline (0.2 = 20%%)")
+    parser.add_argument("--save-baseline", help="also write the results to this baseline file")
+    parser.add_argument("--case", nargs=3, metavar=("TOOL", "ROWS", "CARDINALITY"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        with open(os.devnull, "w") as devnull: # keep tool messages off the result line
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                result = run_case(args.case[0], int(args.case[1]), int(args.case[2]))
+            finally:
+                sys.stdout = stdout
+        print(json.dumps(result))
+        return 0
+
+    results = []
+    for tool in args.tools:
+        for rows in args.sizes:
+            for cardinality in args.cardinality:
+                result = run_isolated(tool, rows, cardinality)
+                results.append(result)
+                print("{tool}: {rows} rows, {cardinality} keys - {wall_s}s, {rows_per_s} rows/s, "
+                      "tool {tool_rss_kb} KB (setup {setup_rss_kb} KB, peak {peak_rss_kb} KB)".format(**result))
+
+    report = {"generated": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+              "machine": platform.node(), "results": results}
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, old in regressions:
+            print("REGRESSION {0}: {1} rows, {2} keys - {3}s (baseline {4}s)".format(
+                result["tool"], result["rows"], result["cardinality"], result["wall_s"], old["wall_s"]))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
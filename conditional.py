@@ -0,0 +1,104 @@
+#-------------------------------------------------------------------------------
+# Name:        conditional
+# Purpose:     rule based field updates - (where clause, field, value) rules applied to a table in one pass
+#
+#   rules = [("Gen_Type = 'Swale'", "MS4", 1),
+#            ("Data_Source IS NULL", "Data_Source", "unknown"),
+#            ("InstallDate < date '2000-01-01'", "As_Built", parse("coalesce(!As_Built!, 'pre 2000')")),
+#            (None, "MS4", 0)]                       # everything else
+#   hits = ConditionalUpdate(bmps, rules).run()
+#
+# Each rule's where clause goes to the database (an OID only query), so only matching rows are found and
+# only those rows read. Values are constants, or expressions (expressions.parse) evaluated on the rows the
+# rule sets. Rules see the table as stored, not what earlier rules set, and every change is written in one pass.
+#
+# When several rules for the same field match a row:
+#   mode "first" - the first of them sets it (like CASE WHEN ... in SQL)
+#   mode "last"  - the last of them sets it (as if the rules ran one after another)
+# only_null limits every rule to rows where its field is still null.
+# run() returns, per rule, the rows its where clause matched and the rows it set ("hits").
+#-------------------------------------------------------------------------------
+
+import collections
+import numpy
+from utilities import addMessage
+from backends import get_backend, changed, convert_values, read_columns_for_keys
+from expressions import Expression
+from instrument import stage
+
+
+class ConditionalUpdate(object):
+
+    def __init__(self, table, rules, mode="first", only_null=False, backend=None):
+        if mode not in ("first", "last"):
+            raise ValueError("mode must be first or last - got {0}".format(mode))
+        self.table = table
+        self.rules = [tuple(rule) for rule in rules]
+        for rule in self.rules:
+            if len(rule) != 3:
+                raise ValueError("rules are (where clause, field, value) - got {0}".format(rule))
+        self.mode = mode
+        self.only_null = only_null
+        self.backend = backend
+
+    def _where(self, where, field):
+        # the rule's where clause plus the null test pushed down with it
+        if not self.only_null:
+            return where
+        return "({0}) AND {1} IS NULL".format(where, field) if where else "{0} IS NULL".format(field)
+
+    @stage("ConditionalUpdate.run")
+    def run(self):
+
+        # -> [{"where", "field", "matched", "hits"}] in rule order
+        b = get_backend(self.backend)
+        types = dict((f.name.upper(), f) for f in b.list_fields(self.table))
+        for where, field, value in self.rules:
+            if field.upper() not in types:
+                raise ValueError("Field: {0} not in {1}".format(field, self.table))
+        oid_field = [f.name for f in types.values() if f.type == "OID"]
+        selected = [b.select(self.table, self._where(where, field)) for where, field, value in self.rules]
+
+        fields = []
+        for where, field, value in self.rules:
+            for name in [field] + (value.fields if isinstance(value, Expression) else []):
+                if name.upper() not in [f.upper() for f in fields]:
+                    fields.append(name)
+        matching = numpy.unique(numpy.concatenate(selected)) if selected else numpy.zeros(0, dtype=numpy.int64)
+        if oid_field:
+            data = read_columns_for_keys(b, self.table, oid_field[0], fields, matching.tolist())
+        else:
+            data = b.read_columns(self.table, fields)
+        keep = numpy.isin(data["OID@"], matching)
+        oids = data["OID@"][keep]
+        columns = dict((name.upper(), data[name][keep]) for name in fields)
+        order = numpy.argsort(oids)
+        oids = oids[order]
+        columns = dict((name, column[order]) for name, column in columns.items())
+
+        new = dict((field.upper(), columns[field.upper()].astype(object)) for where, field, value in self.rules)
+        set_by = dict((field, numpy.zeros(len(oids), dtype=bool)) for field in new)
+        hits = []
+        rules = list(enumerate(self.rules))
+        for i, (where, field, value) in (rules if self.mode == "first" else reversed(rules)):
+            name = field.upper()
+            rows = numpy.isin(oids, selected[i]) & ~set_by[name]
+            count = int(rows.sum())
+            if count:
+                if isinstance(value, Expression):
+                    values = value.evaluate(dict((f, columns[f.upper()][rows]) for f in value.fields), count)
+                else:
+                    values = [value] * count
+                new[name][rows] = convert_values(values, types[name].type)
+                set_by[name] |= rows
+            hits.append((i, {"where": where, "field": field, "matched": len(selected[i]), "hits": count}))
+        hits = [hit for i, hit in sorted(hits, key=lambda pair: pair[0])]
+
+        # one write of every rule field for the rows where any of them changed
+        write = numpy.zeros(len(oids), dtype=bool)
+        for name in new:
+            write |= changed(columns[name], new[name])
+        names = collections.OrderedDict((field.upper(), types[field.upper()].name) for where, field, value in self.rules)
+        written = b.write_columns(self.table, oids[write], dict((names[name], new[name][write]) for name in new))
+        addMessage("{0} rules on {1}: {2} rows matched, {3} written".format(len(self.rules), self.table, len(oids), written))
+        return hits
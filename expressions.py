@@ -0,0 +1,251 @@
+#-------------------------------------------------------------------------------
+# Name:        expressions
+# Purpose:     derived field expressions evaluated a whole column at a time
+#
+# Replaces per row CalculateField_management python expressions such as
+#   "round(!Shape_Area!/43560,2)"
+# with the same text evaluated over numpy columns - the fields it names are read once and
+# the result written back in bulk (see FieldPlan.calc / BMP_tools.calcField).
+#
+# The language is a restricted python expression:
+#   fields         !Field! or Field (Shape_Area / Shape_Length read the geometry, so work on any backend)
+#   numbers, text, None, True, False
+#   + - * / // % **, comparisons, and / or / not
+#   round(x, digits), abs(x), min(a, b, ...), max(a, b, ...) (these two skip nulls)
+#   where(condition, a, b), coalesce(a, b, ...), isnull(x)
+#   lookup(name, x) - name is one of the dicts passed in as lookups
+# Null (None) values carry through arithmetic, and any comparison with a null (!= too) is False.
+# Anything else is refused when parsed.
+#-------------------------------------------------------------------------------
+
+from __future__ import division
+import ast, re
+import numpy
+from backends import map_values, object_array
+
+# field names standing in for the geometry tokens, as in a file gdb feature class
+shape_fields = {"SHAPE_AREA": "SHAPE@AREA", "SHAPE_LENGTH": "SHAPE@LENGTH"}
+
+_functions = ("round", "abs", "min", "max", "where", "coalesce", "isnull", "lookup")
+
+_operators = {ast.Add: numpy.add, ast.Sub: numpy.subtract, ast.Mult: numpy.multiply, ast.Div: numpy.true_divide,
+              ast.FloorDiv: numpy.floor_divide, ast.Mod: numpy.mod, ast.Pow: numpy.power}
+
+_comparisons = {ast.Eq: numpy.equal, ast.NotEq: numpy.not_equal, ast.Lt: numpy.less, ast.LtE: numpy.less_equal,
+                ast.Gt: numpy.greater, ast.GtE: numpy.greater_equal}
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class Expression(object):
+
+    # parsed expression - fields lists the table fields (or SHAPE@ tokens) it reads, in order of first use
+
+    def __init__(self, text, lookups=None):
+        self.text = text
+        self.lookups = dict(lookups or {})
+        source = re.sub(r"!([^!]+)!", lambda m: m.group(1).strip(), text)
+        try:
+            self.tree = ast.parse(source.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise ExpressionError("Cannot parse expression {0}: {1}".format(text, e))
+        self.fields = []
+        self._check(self.tree)
+
+    def _field(self, name):
+        return shape_fields.get(name.upper(), name)
+
+    def _check(self, node):
+        # walks the tree once, refusing anything outside the language and collecting field names
+        if _constant(node) is not _none:
+            return
+        if isinstance(node, ast.Name):
+            if node.id in _functions:
+                raise ExpressionError("{0} is a function - in {1}".format(node.id, self.text))
+            if node.id in self.lookups:
+                raise ExpressionError("lookup {0} can only be used as lookup({0}, value) - in {1}".format(node.id, self.text))
+            field = self._field(node.id)
+            if field.upper() not in [f.upper() for f in self.fields]:
+                self.fields.append(field)
+        elif isinstance(node, ast.BinOp) and type(node.op) in _operators:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+            self._check(node.operand)
+        elif isinstance(node, ast.BoolOp):
+            for value in node.values:
+                self._check(value)
+        elif isinstance(node, ast.Compare) and all(type(op) in _comparisons for op in node.ops):
+            for value in [node.left] + node.comparators:
+                self._check(value)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _functions and not node.keywords:
+            if node.func.id == "lookup":
+                if len(node.args) != 2 or not isinstance(node.args[0], ast.Name) or node.args[0].id not in self.lookups:
+                    raise ExpressionError("lookup needs one of {0} and a value - in {1}".format(sorted(self.lookups), self.text))
+                self._check(node.args[1])
+            else:
+                for arg in node.args:
+                    self._check(arg)
+        else:
+            raise ExpressionError("{0} is not allowed in a field expression - in {1}".format(type(node).__name__, self.text))
+
+    def evaluate(self, columns, count):
+
+        # columns holds an array per name in self.fields -> result column of count values
+        columns = dict((name.upper(), column) for name, column in columns.items())
+        return _finish(self._evaluate(self.tree, columns, count), count)
+
+    def _evaluate(self, node, columns, count):
+        value = _constant(node)
+        if value is not _none:
+            return value
+        if isinstance(node, ast.Name):
+            return _prepare(columns[self._field(node.id).upper()])
+        if isinstance(node, ast.BinOp):
+            left, right = self._evaluate(node.left, columns, count), self._evaluate(node.right, columns, count)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                return _null_safe(_operators[type(node.op)], [left, right], count)
+        if isinstance(node, ast.UnaryOp):
+            operand = self._evaluate(node.operand, columns, count)
+            if isinstance(node.op, ast.Not):
+                return ~_truth(operand, count)
+            return numpy.negative(operand) if isinstance(node.op, ast.USub) else operand
+        if isinstance(node, ast.BoolOp):
+            values = [_truth(self._evaluate(v, columns, count), count) for v in node.values]
+            combine = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+            result = values[0]
+            for value in values[1:]:
+                result = combine(result, value)
+            return result
+        if isinstance(node, ast.Compare):
+            result = numpy.ones(count, dtype=bool)
+            left = self._evaluate(node.left, columns, count)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._evaluate(comparator, columns, count)
+                # a null on either side is False whatever the operator (NaN != x would otherwise be True)
+                known = ~(_nulls(left, count) | _nulls(right, count))
+                result = result & known & _truth(_null_safe(_comparisons[type(op)], [left, right], count), count)
+                left = right
+            return result
+        name = node.func.id
+        if name == "lookup":
+            return map_values(_column(self._evaluate(node.args[1], columns, count), count), self.lookups[node.args[0].id], None)
+        args = [self._evaluate(arg, columns, count) for arg in node.args]
+        if name == "round":
+            digits = int(args[1]) if len(args) > 1 else 0
+            return _null_safe(lambda x: numpy.round(x, digits), args[:1], count)
+        if name == "abs":
+            return _null_safe(numpy.absolute, args, count)
+        if name in ("min", "max"):
+            combine = numpy.fmin if name == "min" else numpy.fmax
+            result = args[0]
+            for arg in args[1:]:
+                result = _null_safe(combine, [result, arg], count)
+            return result
+        if name == "isnull":
+            return _nulls(args[0], count)
+        if name == "coalesce":
+            result = _column(args[0], count)
+            for arg in args[1:]:
+                result = _where(_nulls(result, count), arg, result, count)
+            return result
+        return _where(_truth(args[0], count), args[1], args[2], count)
+
+
+def parse(text, lookups=None):
+    return Expression(text, lookups)
+
+
+# --- helpers ---
+
+_none = object()
+
+def _constant(node):
+    # literal value of node, or _none if it is not a literal
+    # (checked by class name - python 2 has Num / Str / Name, python 3.8+ Constant)
+    kind = type(node).__name__
+    if kind in ("Constant", "NameConstant"):
+        return node.value
+    if kind == "Num":
+        return node.n
+    if kind == "Str":
+        return node.s
+    if kind == "Name" and node.id in ("None", "True", "False"):
+        return {"None": None, "True": True, "False": False}[node.id]
+    return _none
+
+
+def _prepare(column):
+    # object columns of numbers (with nulls) become float with NaN for null so arithmetic stays vectorized
+    if column.dtype == object and len(column):
+        try:
+            return numpy.array([numpy.nan if v is None else v for v in column], dtype=float)
+        except (TypeError, ValueError):
+            return column
+    return column
+
+
+def _column(value, count):
+    if isinstance(value, numpy.ndarray):
+        return value
+    if value is None:
+        return object_array([None] * count)
+    return numpy.array([value] * count) if count else numpy.array([value])[:0]
+
+
+def _nulls(value, count):
+    value = _column(value, count)
+    if value.dtype.kind == "f":
+        return numpy.isnan(value)
+    if value.dtype == object:
+        return numpy.array([v is None or (isinstance(v, float) and v != v) for v in value], dtype=bool)
+    return numpy.zeros(len(value), dtype=bool)
+
+
+def _null_safe(func, args, count):
+    # func(*args) with a null in any argument giving null (NaN for numbers, None otherwise)
+    if any(a is None for a in args):
+        return object_array([None] * count)
+    if all(not isinstance(a, numpy.ndarray) or a.dtype != object for a in args):
+        return func(*args)
+    arrays = [_column(a, count) for a in args]
+    nulls = numpy.zeros(count, dtype=bool)
+    for a in arrays:
+        nulls |= _nulls(a, count)
+    result = object_array([None] * count)
+    valid = ~nulls
+    if valid.any():
+        result[valid] = object_array(func(*[a[valid].astype(object) for a in arrays]))
+    return result
+
+
+def _truth(value, count):
+    value = _column(value, count)
+    if value.dtype == object:
+        return numpy.array([bool(v) and not (isinstance(v, float) and v != v) for v in value], dtype=bool)
+    if value.dtype.kind == "f":
+        return numpy.nan_to_num(value) != 0
+    return value.astype(bool)
+
+
+def _where(condition, a, b, count):
+    a, b = _column(a, count), _column(b, count)
+    if (a.dtype == object) != (b.dtype == object) or a.dtype.kind in "SU" or b.dtype.kind in "SU":
+        a, b = a.astype(object), b.astype(object)
+    return numpy.where(condition, a, b)
+
+
+def _finish(value, count):
+    # -> result column, NaN (null arithmetic) back to None
+    value = _column(value, count)
+    if value.shape != (count,):
+        value = numpy.resize(value, count)
+    if value.dtype.kind == "f" and numpy.isnan(value).any():
+        result = value.astype(object)
+        result[numpy.isnan(value)] = None
+        return result
+    if value.dtype.kind in "SU":
+        return value.astype(object)
+    return value
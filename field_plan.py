@@ -0,0 +1,206 @@
+#-------------------------------------------------------------------------------
+# Name:        field_plan
+# Purpose:     queue several field updates on one table and run them in a single read / write pass
+#
+# Instead of calling add_StandardFields, incrementField, fillField, fillField_fromAnother and
+# fillField_fromDict one after another (each a full UpdateCursor rewrite), queue the same work on a FieldPlan:
+#
+#   plan = FieldPlan(bmps)
+#   plan.add_fields(standard_fields)
+#   plan.sequence("UID")
+#   plan.fill("MS4", 1)
+#   plan.copy("Original_ID", "HANSEN_ID")
+#   plan.lookup("Subwatershed", "Watershed", type_dict)
+#   plan.fill_where("In_Stream", 0, only_null=True)
+#   plan.calc("Area_Acres", "round(!Shape_Area!/43560,2)")
+#   plan.run()
+#
+# Steps behave as if run one after another in the order queued - a step reading a field sees what
+# earlier steps wrote to it. Writes that a later step completely overwrites (with nothing reading them
+# in between) are dropped before the run, and only rows whose values changed are written, once.
+#-------------------------------------------------------------------------------
+
+import re
+import numpy
+from utilities import addMessage
+from backends import get_backend, as_field, changed, convert_values, is_null, map_values
+from expressions import parse
+from instrument import stage
+
+
+class FieldPlan(object):
+
+    def __init__(self, table, backend=None):
+        self.table = table
+        self.backend = backend
+        self.new_fields = []
+        self.steps = []
+
+    # --- steps ---
+
+    def add_fields(self, fields):
+        # [(name, type), (name, type, length), ...] - created in one batch before the pass if missing
+        self.new_fields.extend(as_field(field) for field in fields)
+        return self
+
+    def fill(self, field, value):
+        # constant fill (fillField)
+        return self._add("fill", field, value=value)
+
+    def copy(self, field, source):
+        # copy from another field of the same table (fillField_fromAnother)
+        return self._add("copy", field, reads=[source], source=source)
+
+    def lookup(self, field, source, lookup, unmatched="keep", default=None):
+        # field = lookup[source] (fillField_fromLookup) - unmatched is "keep", "default" or "null"
+        if unmatched not in ("keep", "default", "null"):
+            raise ValueError("unmatched must be one of keep, default, null - got {0}".format(unmatched))
+        reads = [source] + ([field] if unmatched == "keep" else [])
+        return self._add("lookup", field, reads=reads, source=source, lookup=lookup, unmatched=unmatched, default=default)
+
+    def sequence(self, field, start=1, sort_field=None):
+        # incrementing numbers (incrementField) in OID order, or by sort_field (ties in OID order)
+        return self._add("sequence", field, reads=[sort_field] if sort_field else [], start=start, sort_field=sort_field)
+
+    def fill_where(self, field, value, where=None, only_null=False):
+        # fills rows matching the where clause and / or where field is still null (fillField_Conditional)
+        # where clauses are evaluated on the table as stored, so may not name fields written earlier in the plan
+        reads = [field] if only_null else []
+        return self._add("fill_where", field, reads=reads, value=value, where=where, only_null=only_null)
+
+    def calc(self, field, expression, lookups=None):
+        # derived field (CalculateField) - expression is evaluated over whole columns, see expressions.py
+        # lookups are the dicts the expression can use as lookup(name, value)
+        expression = parse(expression, lookups)
+        return self._add("calc", field, reads=expression.fields, expression=expression)
+
+    def _add(self, kind, field, reads=(), **options):
+        step = dict(options)
+        step.update(kind=kind, field=field, reads=list(reads))
+        self.steps.append(step)
+        return self
+
+    # --- planning ---
+
+    def optimize(self):
+
+        # -> steps still needed, in run order
+        # a step is dead if a later step overwrites every row of its field before anything reads it
+        live = []
+        overwritten = set()
+        for step in reversed(self.steps):
+            field = step["field"].upper()
+            if field in overwritten:
+                continue
+            live.append(step)
+            if self._writes_all_rows(step):
+                overwritten.add(field)
+            for read in step["reads"]:
+                overwritten.discard(read.upper())
+        live.reverse()
+
+        # where clauses see the stored table, so they cannot depend on a field an earlier step writes
+        written = set()
+        for step in live:
+            if step["kind"] == "fill_where" and step["where"]:
+                names = set(name.upper() for name in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", step["where"]))
+                clash = names & written
+                if clash:
+                    raise ValueError("where clause {0} reads {1} which an earlier step writes - split the plan".format(
+                        step["where"], ", ".join(sorted(clash))))
+            written.add(step["field"].upper())
+        return live
+
+    def _writes_all_rows(self, step):
+        if step["kind"] in ("fill", "copy", "sequence", "calc"):
+            return True
+        if step["kind"] == "lookup":
+            return step["unmatched"] != "keep"
+        return False
+
+    # --- run ---
+
+    @stage("FieldPlan.run")
+    def run(self):
+
+        # runs the plan in one read and one write pass
+        # -> counts of rows, rows written, steps run and steps dropped as dead writes
+        b = get_backend(self.backend)
+        steps = self.optimize()
+        addMessage("Running {0} field steps on {1} ({2} dropped)".format(len(steps), self.table, len(self.steps) - len(steps)))
+
+        if self.new_fields:
+            existing = set(f.name.upper() for f in b.list_fields(self.table))
+            missing = []
+            for field in self.new_fields:
+                if field.name.upper() not in existing:
+                    existing.add(field.name.upper())
+                    missing.append(field)
+            if missing:
+                b.add_fields(self.table, missing)
+        types = dict((f.name.upper(), f.type) for f in b.list_fields(self.table))
+
+        fields = []
+        for step in steps:
+            for name in [step["field"]] + step["reads"]:
+                if name.upper() not in [f.upper() for f in fields]:
+                    fields.append(name)
+        data = b.read_columns(self.table, fields)
+        oids = data["OID@"]
+
+        # where clauses are resolved up front - an OID-only query each
+        masks = {}
+        for i, step in enumerate(steps):
+            if step["kind"] == "fill_where" and step["where"]:
+                selected = set(b.select(self.table, step["where"]).tolist())
+                masks[i] = numpy.array([oid in selected for oid in oids.tolist()], dtype=bool)
+
+        columns = dict((name.upper(), data[name]) for name in fields)
+        original = dict(columns)
+        for i, step in enumerate(steps):
+            field = step["field"].upper()
+            kind = step["kind"]
+            if kind == "fill":
+                new = numpy.empty(len(oids), dtype=object)
+                new[:] = [step["value"]] * len(oids)
+            elif kind == "copy":
+                new = columns[step["source"].upper()].copy()
+            elif kind == "lookup":
+                missing = object()
+                new = map_values(columns[step["source"].upper()], step["lookup"], missing)
+                unmatched = numpy.array([value is missing for value in new], dtype=bool)
+                if step["unmatched"] == "keep":
+                    new[unmatched] = columns[field].astype(object)[unmatched]
+                else:
+                    new[unmatched] = step["default"] if step["unmatched"] == "default" else None
+            elif kind == "sequence":
+                order = numpy.arange(len(oids))
+                if step["sort_field"]:
+                    order = numpy.array(sorted(order, key=lambda j, keys=columns[step["sort_field"].upper()]: (keys[j] is None, keys[j])), dtype=numpy.int64)
+                new = numpy.empty(len(oids), dtype=numpy.int64)
+                new[order] = numpy.arange(step["start"], step["start"] + len(oids))
+            elif kind == "calc":
+                expression = step["expression"]
+                new = expression.evaluate(dict((name, columns[name.upper()]) for name in expression.fields), len(oids))
+                new = convert_values(new, types.get(field))
+            else:
+                new = columns[field].astype(object)
+                mask = masks.get(i, numpy.ones(len(oids), dtype=bool))
+                if step["only_null"]:
+                    mask = mask & is_null(columns[field])
+                new[mask] = step["value"]
+            columns[field] = new
+
+        # one write of every target field for rows where any of them changed
+        targets = []
+        for step in steps:
+            if step["field"].upper() not in [t.upper() for t in targets]:
+                targets.append(step["field"])
+        write = numpy.zeros(len(oids), dtype=bool)
+        for target in targets:
+            write |= changed(original[target.upper()], columns[target.upper()])
+        written = b.write_columns(self.table, oids[write], dict((t, columns[t.upper()][write]) for t in targets))
+
+        counts = {"rows": len(oids), "written": written, "steps": len(steps), "dropped": len(self.steps) - len(steps)}
+        addMessage("{0} of {1} rows written".format(written, len(oids)))
+        return counts
@@ -0,0 +1,309 @@
+#-------------------------------------------------------------------------------
+# Name:        instrument
+# Purpose:     buffered log writing and per stage timing for a run
+#
+# Log files are written by a background thread in batches (LogWriter) rather than opened,
+# appended to and closed for every message. A script that asks for them (configure(records_path=...))
+# also gets JSON lines records alongside the text log - one per message and one per timed stage.
+# Without a records path nothing is recorded, so library callers write no files of their own.
+# Stages are timed with:
+#
+#   @stage
+#   def fillField(...): ...
+#
+#   with stage("ind_acreage") as s:
+#       ...
+#       s.rows = 123      # optional - otherwise the rows read through backends in the stage itself
+#
+# A stage record holds wall time, CPU time, the process peak memory at its end (and how much it
+# grew during the stage) and rows read. Stages nest - self time is the stage's own time less its
+# children's, and rows are counted only by the innermost stage reading them. report() ranks the
+# stages of the run (all processes sharing the run id) by self time.
+#-------------------------------------------------------------------------------
+
+import atexit, collections, datetime, functools, itertools, json, os, sys, threading, time
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# worker processes inherit the run id through the environment, so their records join the same run
+run_id_variable = "MS4_RUN_ID"
+if run_id_variable not in os.environ:
+    os.environ[run_id_variable] = "{0}-{1}".format(datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid())
+
+_settings = {"records_path": None}
+
+
+def configure(records_path=None, run_id=None):
+
+    # records_path - JSON lines file for the run records (no records are written until one is given)
+    # run_id - groups the records of one run (default set once per top level process)
+    if records_path is not None:
+        _settings["records_path"] = records_path
+    if run_id is not None:
+        os.environ[run_id_variable] = run_id
+
+
+def run_id():
+    return os.environ[run_id_variable]
+
+
+def records_path():
+    # -> the configured records file, None when records are off
+    return _settings["records_path"]
+
+
+# --- buffered writing ---
+
+class LogWriter(object):
+
+    # appends text to one file from a background thread - a batch per interval, or on flush()
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.pid = None
+        self._start()
+
+    def _start(self):
+        # (again in a forked child, which has the queue but not the thread)
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="LogWriter " + self.path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, text):
+        if self.pid != os.getpid():
+            self._start()
+        self.queue.put(text)
+
+    def flush(self, timeout=30):
+        # blocks until everything written so far is on disk
+        if self.pid != os.getpid():
+            self._start()
+        done = threading.Event()
+        self.queue.put(done)
+        self.wake.set()
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self._drain()
+
+    def _drain(self):
+        lines = []
+        waiting = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, str) or isinstance(item, type(u"")):
+                lines.append(item)
+            else:
+                waiting.append(item)
+        if lines:
+            try:
+                with open(self.path, "a") as f:
+                    f.write("".join(lines))
+            except (IOError, OSError) as e:
+                sys.stderr.write("Could not write {0}: {1}\n".format(self.path, e))
+        for done in waiting:
+            done.set()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def writer(path):
+    path = os.path.abspath(path)
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = LogWriter(path)
+        return _writers[path]
+
+
+def flush():
+    # writes out every buffered log - call before a worker process hands back its result
+    for w in list(_writers.values()):
+        w.flush()
+
+atexit.register(flush)
+
+
+def record(kind, **fields):
+
+    # one JSON lines record for this run (returned, and written only when a records path is configured)
+    entry = {"time": datetime.datetime.now().isoformat(), "run": run_id(), "pid": os.getpid(), "kind": kind}
+    current = _stack()
+    if current and kind != "stage":
+        entry["stage_id"] = current[-1].id
+    entry.update(fields)
+    if records_path():
+        writer(records_path()).write(json.dumps(entry, default=str) + "\n")
+    return entry
+
+
+# --- stages ---
+
+_local = threading.local()
+_ids = itertools.count(1)
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _cpu():
+    return time.process_time() if hasattr(time, "process_time") else time.clock()
+
+
+def peak_memory_kb():
+    # peak resident memory of this process so far, None where it cannot be read
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) // 1024
+    return None
+
+
+def add_rows(count):
+    # counts rows read towards the innermost stage running in this thread (called by the backends) -
+    # an outer stage's total is its own rows plus its children's, so summing the records counts each row once
+    stack = _stack()
+    if stack:
+        stack[-1].read += count
+
+
+def stage(name=None, **fields):
+
+    # times a block (with stage("name"):) or every call of a function (@stage or @stage("name"))
+    if callable(name):
+        return _timed(name, name.__name__, fields)
+    return Stage(name, fields)
+
+
+class Stage(object):
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.rows = None
+        self.read = 0
+        self.id = None
+        self.parent = None
+
+    def __call__(self, func):
+        return _timed(func, self.name or func.__name__, self.fields)
+
+    def __enter__(self):
+        stack = _stack()
+        self.id = "{0}-{1}".format(os.getpid(), next(_ids))
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.started = time.time()
+        self.cpu_started = _cpu()
+        self.peak_started = peak_memory_kb()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+        peak = peak_memory_kb()
+        record("stage", name=self.name, id=self.id, parent=self.parent,
+               wall=round(time.time() - self.started, 4), cpu=round(_cpu() - self.cpu_started, 4),
+               peak_kb=peak, grew_kb=peak - self.peak_started if peak is not None else None,
+               rows=self.rows if self.rows is not None else self.read,
+               error=exc_type.__name__ if exc_type is not None else None, **self.fields)
+        return False
+
+
+def _timed(func, name, fields):
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        with Stage(name, fields):
+            return func(*args, **kwargs)
+    return timed
+
+
+# --- report ---
+
+def stage_records(run=None, path=None):
+    # -> the stage records of a run (this run by default) from the records file
+    run = run or run_id()
+    path = path or records_path()
+    flush()
+    result = []
+    if not path or not os.path.exists(path):
+        return result
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError: # a line cut short by a killed process
+                continue
+            if entry.get("run") == run and entry.get("kind") == "stage":
+                result.append(entry)
+    return result
+
+
+def summary(records=None):
+
+    # -> one row per stage name, hottest (most self time) first:
+    #    {"name", "calls", "wall", "self", "cpu", "rows", "peak_kb", "errors"}
+    records = stage_records() if records is None else records
+    children = collections.defaultdict(float)
+    for entry in records:
+        if entry.get("parent"):
+            children[entry["parent"]] += entry["wall"]
+    rows = collections.OrderedDict()
+    for entry in records:
+        row = rows.setdefault(entry["name"], {"name": entry["name"], "calls": 0, "wall": 0.0, "self": 0.0,
+                                              "cpu": 0.0, "rows": 0, "peak_kb": None, "errors": 0})
+        row["calls"] += 1
+        row["wall"] += entry["wall"]
+        row["self"] += max(entry["wall"] - children.get(entry["id"], 0.0), 0.0)
+        row["cpu"] += entry["cpu"]
+        row["rows"] += entry.get("rows") or 0
+        if entry.get("peak_kb") is not None:
+            row["peak_kb"] = max(row["peak_kb"] or 0, entry["peak_kb"])
+        if entry.get("error"):
+            row["errors"] += 1
+    return sorted(rows.values(), key=lambda row: row["self"], reverse=True)
+
+
+def report(records=None, top=15):
+
+    # -> lines of text ranking the hot stages of the run
+    rows = summary(records)
+    if not rows:
+        return ["No timed stages recorded for run " + run_id()]
+    total = sum(row["self"] for row in rows) or 1.0
+    lines = ["Hot stages for run {0} (self time = time not spent in nested stages)".format(run_id()),
+             "{0:<32} {1:>6} {2:>10} {3:>10} {4:>6} {5:>10} {6:>11} {7:>12}".format(
+                 "stage", "calls", "self s", "wall s", "%", "cpu s", "rows", "peak MB")]
+    for row in rows[:top]:
+        lines.append("{0:<32} {1:>6} {2:>10.2f} {3:>10.2f} {4:>5.1f}% {5:>10.2f} {6:>11} {7:>12}".format(
+            row["name"][:32], row["calls"], row["self"], row["wall"], 100.0 * row["self"] / total, row["cpu"], row["rows"],
+            "{0:.1f}".format(row["peak_kb"] / 1024.0) if row["peak_kb"] is not None else "-",
+        ) + (" ({0} failed)".format(row["errors"]) if row["errors"] else ""))
+    if len(rows) > top:
+        lines.append("... {0} more stages".format(len(rows) - top))
+    return lines
@@ -0,0 +1,392 @@
+#-------------------------------------------------------------------------------
+# Name:        overlay
+# Purpose:     in process spatial overlay - STR tree index plus exact intersection tests and areas
+#
+# Used in place of Intersect / SelectLayerByLocation + Dissolve where only a per feature answer is needed
+# (does it overlap? how much area overlaps?), so no intermediate datasets are written.
+#
+# Geometry comes from TableBackend.read_columns(..., ["SHAPE@"]):
+#   - arcpy geometries (ArcpyBackend) - tested with their own disjoint / intersect methods
+#   - plain coordinates (ColumnarBackend, refcache) - point (x, y), or a list of parts / rings of (x, y)
+# Mixing the two (an ArcpyBackend layer against a cached one) converts the coordinate side to arcpy geometries,
+# so the pair is still tested by arcpy. Layers in different coordinate systems are projected to the target
+# layer's (arcpy geometries), or refused with a ValueError when there is no arcpy to project them.
+# Polygons in coordinates are filled even-odd, so holes may be in either ring order.
+#
+# Candidates are found by bounding box from an STR tree, so each feature is only tested
+# against the few features near it rather than the whole layer.
+#-------------------------------------------------------------------------------
+
+import math, numbers
+try:
+    import arcpy
+except ImportError: # coordinates only (backends.ColumnarBackend)
+    arcpy = None
+from backends import get_backend, geometry_coordinates, coordinates_geometry
+
+
+# --- bounding boxes and the STR tree ---
+
+def _is_point(geometry):
+    return isinstance(geometry[0], numbers.Real)
+
+
+def bbox(geometry):
+
+    # -> (xmin, ymin, xmax, ymax) or None for an empty geometry
+    if geometry is None:
+        return None
+    if hasattr(geometry, "extent"):
+        e = geometry.extent
+        return (e.XMin, e.YMin, e.XMax, e.YMax)
+    if not geometry:
+        return None
+    if _is_point(geometry):
+        return (geometry[0], geometry[1], geometry[0], geometry[1])
+    xs = [p[0] for part in geometry for p in part]
+    ys = [p[1] for part in geometry for p in part]
+    if not xs:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _boxes_overlap(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+class STRtree(object):
+
+    # sort-tile-recursive packed R tree over bounding boxes (built once, read only)
+    # query(box) -> indices of the boxes overlapping box
+
+    def __init__(self, boxes, capacity=16):
+        self.capacity = capacity
+        level = [(box, i) for i, box in enumerate(boxes) if box is not None]
+        leaf = True
+        while len(level) > capacity or (leaf and level):
+            level = self._pack(level, leaf)
+            leaf = False
+        self.root = (_union([entry[0] for entry in level]), level, leaf) if level else None
+
+    def _pack(self, entries, leaf):
+        # entries are (box, payload) - groups them into nodes of up to capacity entries
+        capacity = self.capacity
+        pages = int(math.ceil(len(entries) / float(capacity)))
+        slices = int(math.ceil(math.sqrt(pages)))
+        per_slice = slices * capacity
+        entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+        nodes = []
+        for start in range(0, len(entries), per_slice):
+            column = sorted(entries[start:start + per_slice], key=lambda e: e[0][1] + e[0][3])
+            for i in range(0, len(column), capacity):
+                group = column[i:i + capacity]
+                nodes.append((_union([e[0] for e in group]), (group, leaf)))
+        return nodes
+
+    def query(self, box):
+        if self.root is None or box is None:
+            return []
+        found = []
+        stack = [(self.root[1], self.root[2])]
+        while stack:
+            entries, leaf = stack.pop()
+            for entry_box, payload in entries:
+                if _boxes_overlap(entry_box, box):
+                    if leaf:
+                        found.append(payload)
+                    else:
+                        stack.append(payload)
+        return sorted(found)
+
+
+# --- exact tests on coordinates ---
+
+def _ring_signed_area(ring):
+    area = 0.0
+    for i in range(len(ring) - 1):
+        area += ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1]
+    return area / 2.0
+
+
+def _closed(ring):
+    ring = list(ring)
+    return ring if ring and ring[0] == ring[-1] else ring + ring[:1]
+
+
+def polygon_area(geometry):
+    return abs(sum(_ring_signed_area(_closed(ring)) for ring in geometry))
+
+
+def _edges(rings):
+    # non vertical ring edges as (xmin, y at xmin, xmax, y at xmax), sorted by xmin
+    edges = []
+    for ring in rings:
+        ring = _closed(ring)
+        for i in range(len(ring) - 1):
+            (x1, y1), (x2, y2) = ring[i], ring[i + 1]
+            if x1 != x2:
+                edges.append((x1, y1, x2, y2) if x1 < x2 else (x2, y2, x1, y1))
+    edges.sort()
+    return edges
+
+
+def _crossing_x(e, f):
+    # x where edges e and f cross, or None (parallel edges only meet at vertices, which are breaks already)
+    dx1, dy1, dx2, dy2 = e[2] - e[0], e[3] - e[1], f[2] - f[0], f[3] - f[1]
+    denominator = dx1 * dy2 - dy1 * dx2
+    if denominator == 0:
+        return None
+    t = ((f[0] - e[0]) * dy2 - (f[1] - e[1]) * dx2) / float(denominator)
+    u = ((f[0] - e[0]) * dy1 - (f[1] - e[1]) * dx1) / float(denominator)
+    if 0 < t < 1 and 0 < u < 1:
+        return e[0] + t * dx1
+    return None
+
+
+def _cross_section(edges, x):
+    # -> inside intervals [(y0, y1)] of a polygon along the vertical line at x (even-odd, so holes are outside)
+    ys = sorted(y1 + (y2 - y1) * (x - x1) / (x2 - x1) for x1, y1, x2, y2 in edges)
+    return [(ys[i], ys[i + 1]) for i in range(0, len(ys) - 1, 2)]
+
+
+def _shared_length(a, b):
+    # total length of overlap of two sorted, disjoint interval lists
+    total, i, j = 0.0, 0, 0
+    while i < len(a) and j < len(b):
+        low, high = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if high > low:
+            total += high - low
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+def intersection_area(a, b):
+
+    # area of overlap of two polygons given as lists of rings
+    # the x axis is cut at every vertex and every crossing of an a edge with a b edge - no edge starts, ends or
+    # crosses another inside one of the slabs this leaves, so the length of overlap along a vertical line is linear
+    # across each slab and the slab's area is its width times that length at its middle
+    a_edges, b_edges = _edges(a), _edges(b)
+    if not a_edges or not b_edges:
+        return 0.0
+    low = max(a_edges[0][0], b_edges[0][0])
+    high = min(max(e[2] for e in a_edges), max(e[2] for e in b_edges))
+    if high <= low:
+        return 0.0
+    breaks = set(e[0] for e in a_edges + b_edges) | set(e[2] for e in a_edges + b_edges)
+    tree = STRtree([(e[0], min(e[1], e[3]), e[2], max(e[1], e[3])) for e in b_edges])
+    for e in a_edges:
+        for j in tree.query((e[0], min(e[1], e[3]), e[2], max(e[1], e[3]))):
+            x = _crossing_x(e, b_edges[j])
+            if x is not None:
+                breaks.add(x)
+    breaks = sorted(x for x in breaks if low <= x <= high)
+
+    # sweep the slabs, keeping the edges that span the current one
+    total = 0.0
+    active = [[], []]
+    start = [0, 0]
+    for x0, x1 in zip(breaks, breaks[1:]):
+        middle = (x0 + x1) / 2.0
+        sections = []
+        for side, edges in enumerate((a_edges, b_edges)):
+            while start[side] < len(edges) and edges[start[side]][0] < middle:
+                active[side].append(edges[start[side]])
+                start[side] += 1
+            active[side] = [e for e in active[side] if e[2] > middle]
+            sections.append(_cross_section(active[side], middle))
+        total += _shared_length(sections[0], sections[1]) * (x1 - x0)
+    return total
+
+
+def point_in_polygon(point, rings):
+
+    # even-odd rule over all rings, so holes are outside - points on an edge count as inside
+    x, y = point
+    inside = False
+    for ring in rings:
+        ring = _closed(ring)
+        for i in range(len(ring) - 1):
+            (x1, y1), (x2, y2) = ring[i], ring[i + 1]
+            if _on_segment(point, ring[i], ring[i + 1]):
+                return True
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / float(y2 - y1) + x1:
+                inside = not inside
+    return inside
+
+
+def _orientation(p, q, r):
+    value = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+    return 0 if value == 0 else (1 if value > 0 else 2)
+
+
+def _on_segment(p, a, b):
+    return (_orientation(a, b, p) == 0 and min(a[0], b[0]) <= p[0] <= max(a[0], b[0])
+            and min(a[1], b[1]) <= p[1] <= max(a[1], b[1]))
+
+
+def _segments_cross(p1, p2, q1, q2):
+    o1, o2, o3, o4 = _orientation(p1, p2, q1), _orientation(p1, p2, q2), _orientation(q1, q2, p1), _orientation(q1, q2, p2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return _on_segment(q1, p1, p2) or _on_segment(q2, p1, p2) or _on_segment(p1, q1, q2) or _on_segment(p2, q1, q2)
+
+
+def _segments(parts, closed):
+    for part in parts:
+        points = _closed(part) if closed else list(part)
+        for i in range(len(points) - 1):
+            yield points[i], points[i + 1]
+
+
+def intersects(a, b, a_polygon, b_polygon):
+
+    # True where geometries a and b share any point - a_polygon / b_polygon say whether parts are rings
+    if a is None or b is None or not a or not b:
+        return False
+    if _is_point(a) and _is_point(b):
+        return tuple(a) == tuple(b)
+    if _is_point(b):
+        a, b, a_polygon, b_polygon = b, a, b_polygon, a_polygon
+    if _is_point(a):
+        if b_polygon:
+            return point_in_polygon(a, b)
+        return any(_on_segment(a, p, q) for p, q in _segments(b, False))
+    if b_polygon and point_in_polygon(a[0][0], b):
+        return True
+    if a_polygon and point_in_polygon(b[0][0], a):
+        return True
+    b_segments = [(p, q, (min(p[0], q[0]), min(p[1], q[1]), max(p[0], q[0]), max(p[1], q[1]))) for p, q in _segments(b, b_polygon)]
+    for p, q in _segments(a, a_polygon):
+        box = (min(p[0], q[0]), min(p[1], q[1]), max(p[0], q[0]), max(p[1], q[1]))
+        for r, s, other_box in b_segments:
+            if _boxes_overlap(box, other_box) and _segments_cross(p, q, r, s):
+                return True
+    return False
+
+
+# --- layers ---
+
+class Layer(object):
+
+    # features of one table read for overlay - shapes, their boxes and an STR tree over them
+
+    def __init__(self, table, fields=(), where=None, backend=None):
+        b = get_backend(backend)
+        self.table = table
+        self.data = b.read_columns(table, list(fields) + ["SHAPE@"], where)
+        self.shapes = list(self.data["SHAPE@"])
+        self.geometry_type = (b.geometry_type(table) or "").upper()
+        self.polygon = self.geometry_type == "POLYGON"
+        self.spatial_reference = b.spatial_reference(table)
+        self.native = bool(self.shapes) and all(s is None or hasattr(s, "disjoint") for s in self.shapes)
+        self.boxes = [bbox(s) for s in self.shapes]
+        self._tree = None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def tree(self):
+        if self._tree is None:
+            self._tree = STRtree(self.boxes)
+        return self._tree
+
+    def coordinates(self, i):
+        shape = self.shapes[i]
+        if hasattr(shape, "disjoint"):
+            shape = geometry_coordinates(shape)
+            self.shapes[i] = shape
+        return shape
+
+    def geometry(self, i):
+        # shape i as an arcpy geometry in the layer's coordinate system
+        shape = self.shapes[i]
+        if shape is not None and not hasattr(shape, "disjoint"):
+            shape = coordinates_geometry(shape, self.geometry_type, self.spatial_reference)
+            self.shapes[i] = shape
+        return shape
+
+    def candidates(self, box):
+        return self.tree().query(box)
+
+    def project(self, spatial_reference):
+
+        # moves every shape to spatial_reference (as arcpy geometries) and rebuilds the boxes
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(spatial_reference)
+        self.shapes = [s.projectAs(sr) if s is not None else None for s in (self.geometry(i) for i in range(len(self)))]
+        self.spatial_reference = spatial_reference
+        self.native = bool(self.shapes)
+        self.boxes = [bbox(s) for s in self.shapes]
+        self._tree = None
+
+
+def same_spatial_reference(a, b):
+
+    # True unless both are known and name different coordinate systems (compared by factory code or name,
+    # so the same system written with other tolerances still matches)
+    if a is None or b is None or a == b:
+        return True
+    if arcpy is None:
+        return False
+    srs = []
+    for text in (a, b):
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(text)
+        srs.append(sr)
+    if srs[0].factoryCode and srs[1].factoryCode:
+        return srs[0].factoryCode == srs[1].factoryCode
+    return srs[0].name == srs[1].name
+
+
+def _pair_native(targets, overlaps):
+
+    # -> True to test the pair with arcpy - whenever either side came from arcpy (the other side is converted)
+    if not same_spatial_reference(targets.spatial_reference, overlaps.spatial_reference):
+        if arcpy is None:
+            raise ValueError("{0} and {1} are in different coordinate systems".format(targets.table, overlaps.table))
+        overlaps.project(targets.spatial_reference)
+    return arcpy is not None and (targets.native or overlaps.native)
+
+
+def overlapping(targets, overlaps):
+
+    # -> for each target feature, the (sorted) positions of the overlap features it intersects
+    native = _pair_native(targets, overlaps)
+    result = []
+    for i in range(len(targets)):
+        hits = []
+        for j in overlaps.candidates(targets.boxes[i]):
+            if native:
+                hit = not targets.geometry(i).disjoint(overlaps.geometry(j))
+            else:
+                hit = intersects(targets.coordinates(i), overlaps.coordinates(j), targets.polygon, overlaps.polygon)
+            if hit:
+                hits.append(j)
+        result.append(hits)
+    return result
+
+
+def overlap_areas(targets, overlaps):
+
+    # -> for each target polygon, {overlap position: area of overlap} for the overlap polygons it shares area with
+    native = _pair_native(targets, overlaps)
+    result = []
+    for i in range(len(targets)):
+        areas = {}
+        for j in overlaps.candidates(targets.boxes[i]):
+            if native:
+                area = targets.geometry(i).intersect(overlaps.geometry(j), 4).area
+            else:
+                area = intersection_area(targets.coordinates(i), overlaps.coordinates(j))
+            if area > 0:
+                areas[j] = area
+        result.append(areas)
+    return result
@@ -0,0 +1,267 @@
+#-------------------------------------------------------------------------------
+# Name:        proximity
+# Purpose:     in process distance queries - uniform grid index over line segments, batched numpy distances
+#
+# Used in place of SelectLayerByLocation with a search distance / Near_analysis where a per feature
+# answer is enough (is it within 50 ft of a stream? which pipe is nearest?), so no layers or
+# intermediate datasets are made.
+#
+# The selector layer (see overlay.Layer) is broken into segments - a point is a segment of zero length,
+# polygon rings are closed - and each segment is hashed into the cells of a uniform grid its box covers.
+# The index is built once; queries are answered for a whole layer at a time: the query features are
+# broken into segments the same way, paired with the segments in the grid cells near them and every
+# pair's distance worked out at once with numpy, a chunk of query segments at a time.
+#
+#   index = GridIndex(Layer(streams))
+#   hits = index.within(Layer(bmps), 50)           # per bmp, sorted positions of streams within 50
+#   nearest, distance = index.nearest(Layer(bmps))  # per bmp, position of (and distance to) the nearest
+#
+# Distances are in the layers' map units (both layers in the same coordinate system). Where either layer
+# is polygons a feature inside a polygon is at distance 0 from it, as with arcpy.
+#-------------------------------------------------------------------------------
+
+import math
+import numpy
+from overlay import point_in_polygon
+
+# linear units for distances given as text ("50 Feet") - in map units, taken to be feet as in
+# Oregon State Plane North
+units = {"FEET": 1.0, "FOOT": 1.0, "INCHES": 1.0 / 12, "YARDS": 3.0, "MILES": 5280.0,
+         "METERS": 1 / 0.3048, "KILOMETERS": 1000 / 0.3048}
+
+
+def map_distance(distance):
+
+    # 50, "50" or "50 Feet" -> 50.0 map units
+    if not isinstance(distance, (str, type(u""))):
+        return float(distance)
+    parts = distance.split()
+    factor = 1.0
+    if len(parts) > 1:
+        unit = parts[1].upper().replace("DECIMAL", "").replace("US", "").strip("_ ")
+        if unit not in units and unit + "S" not in units:
+            raise ValueError("Unknown distance unit in {0}".format(distance))
+        factor = units.get(unit, units.get(unit + "S"))
+    return float(parts[0]) * factor
+
+
+def segments(layer, positions=None):
+
+    # -> (x1, y1, x2, y2, feature) arrays of every segment of the features of layer (all, or those at positions)
+    # empty features have no segments
+    x1, y1, x2, y2, owner = [], [], [], [], []
+    for i in (range(len(layer)) if positions is None else positions):
+        shape = layer.coordinates(i)
+        if not shape:
+            continue
+        parts = shape if isinstance(shape[0], (list, tuple)) else [[tuple(shape)]]
+        for part in parts:
+            points = list(part)
+            if layer.polygon and len(points) > 1 and points[0] != points[-1]:
+                points.append(points[0])
+            if len(points) == 1:
+                points = points * 2
+            for a, b in zip(points[:-1], points[1:]):
+                x1.append(a[0])
+                y1.append(a[1])
+                x2.append(b[0])
+                y2.append(b[1])
+                owner.append(i)
+    return (numpy.array(x1, dtype=float), numpy.array(y1, dtype=float), numpy.array(x2, dtype=float),
+            numpy.array(y2, dtype=float), numpy.array(owner, dtype=numpy.int64))
+
+
+def _point_segment(px, py, ax, ay, bx, by):
+    # distance from points p to segments a-b, all arrays
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t = numpy.where(length > 0, ((px - ax) * dx + (py - ay) * dy) / length, 0.0)
+    t = numpy.clip(t, 0.0, 1.0)
+    return numpy.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def _side(ax, ay, bx, by, px, py):
+    return numpy.sign((bx - ax) * (py - ay) - (by - ay) * (px - ax))
+
+
+def segment_distances(p, q):
+
+    # distance between segments p[k] and q[k] - p and q are (x1, y1, x2, y2) tuples of arrays
+    px1, py1, px2, py2 = p
+    qx1, qy1, qx2, qy2 = q
+    distance = numpy.minimum(numpy.minimum(_point_segment(px1, py1, qx1, qy1, qx2, qy2), _point_segment(px2, py2, qx1, qy1, qx2, qy2)),
+                             numpy.minimum(_point_segment(qx1, qy1, px1, py1, px2, py2), _point_segment(qx2, qy2, px1, py1, px2, py2)))
+    crossing = ((_side(px1, py1, px2, py2, qx1, qy1) * _side(px1, py1, px2, py2, qx2, qy2) < 0) &
+                (_side(qx1, qy1, qx2, qy2, px1, py1) * _side(qx1, qy1, qx2, qy2, px2, py2) < 0))
+    distance[crossing] = 0.0
+    return distance
+
+
+def _expand(starts, counts):
+    # -> (which, offset) - for each i, counts[i] entries of i numbered from 0
+    which = numpy.repeat(numpy.arange(len(counts)), counts)
+    offset = numpy.arange(len(which)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return which, offset + (starts[which] if starts is not None else 0)
+
+
+class GridIndex(object):
+
+    # segments of a layer hashed into a uniform grid (built once, read only)
+    # cell_size defaults to about one segment per cell
+
+    def __init__(self, layer, cell_size=None, chunk_size=20000):
+        self.layer = layer
+        self.chunk_size = chunk_size
+        self.x1, self.y1, self.x2, self.y2, self.owner = segments(layer)
+        self.features = len(layer)
+        if not len(self.owner):
+            self.cell = 1.0
+            self.keys = self.starts = self.counts = self.order = numpy.zeros(0, dtype=numpy.int64)
+            return
+        xmin, ymin = min(self.x1.min(), self.x2.min()), min(self.y1.min(), self.y2.min())
+        xmax, ymax = max(self.x1.max(), self.x2.max()), max(self.y1.max(), self.y2.max())
+        self.origin = (xmin, ymin)
+        self.extent = math.hypot(xmax - xmin, ymax - ymin)
+        if cell_size is None:
+            spread = numpy.maximum(numpy.abs(self.x2 - self.x1), numpy.abs(self.y2 - self.y1))
+            cell_size = max(float(numpy.median(spread)), math.sqrt((xmax - xmin) * (ymax - ymin) / len(self.owner)))
+        self.cell = cell_size if cell_size > 0 else max(self.extent, 1.0)
+        self.columns = int((xmax - xmin) // self.cell) + 1
+        self.rows = int((ymax - ymin) // self.cell) + 1
+
+        cells, which = self._cells(numpy.minimum(self.x1, self.x2), numpy.minimum(self.y1, self.y2),
+                                   numpy.maximum(self.x1, self.x2), numpy.maximum(self.y1, self.y2))
+        order = numpy.argsort(cells, kind="mergesort")
+        cells, self.order = cells[order], which[order]
+        self.keys, self.starts, self.counts = numpy.unique(cells, return_index=True, return_counts=True)
+
+    def _cells(self, xmin, ymin, xmax, ymax):
+        # -> (cell key, box position) for every grid cell each box covers (boxes clipped to the grid)
+        clip = lambda v, top: numpy.clip(v, 0, top).astype(numpy.int64)
+        ix0 = clip((xmin - self.origin[0]) // self.cell, self.columns - 1)
+        ix1 = clip((xmax - self.origin[0]) // self.cell, self.columns - 1)
+        iy0 = clip((ymin - self.origin[1]) // self.cell, self.rows - 1)
+        iy1 = clip((ymax - self.origin[1]) // self.cell, self.rows - 1)
+        outside = (xmax < self.origin[0]) | (ymax < self.origin[1]) | \
+                  (xmin > self.origin[0] + self.columns * self.cell) | (ymin > self.origin[1] + self.rows * self.cell)
+        width = ix1 - ix0 + 1
+        counts = numpy.where(outside, 0, width * (iy1 - iy0 + 1))
+        which, offset = _expand(None, counts)
+        return (ix0[which] + offset % width[which]) * self.rows + iy0[which] + offset // width[which], which
+
+    def _pairs(self, x1, y1, x2, y2, radius):
+        # -> (query segment, index segment) pairs whose boxes are within radius of each other, no repeats
+        cells, which = self._cells(numpy.minimum(x1, x2) - radius, numpy.minimum(y1, y2) - radius,
+                                   numpy.maximum(x1, x2) + radius, numpy.maximum(y1, y2) + radius)
+        found = numpy.searchsorted(self.keys, cells)
+        found = numpy.minimum(found, max(len(self.keys) - 1, 0))
+        hit = self.keys[found] == cells if len(self.keys) else numpy.zeros(len(cells), dtype=bool)
+        which, found = which[hit], found[hit]
+        pair, position = _expand(self.starts[found], self.counts[found])
+        query, segment = which[pair], self.order[position]
+        unique = numpy.unique(query * len(self.owner) + segment)
+        return unique // len(self.owner), unique % len(self.owner)
+
+    def _near(self, layer, positions, radius):
+
+        # -> (query feature, index feature, distance) for the segment pairs within radius
+        qx1, qy1, qx2, qy2, qowner = segments(layer, positions)
+        results = []
+        for start in range(0, len(qowner), self.chunk_size):
+            part = slice(start, start + self.chunk_size)
+            query, segment = self._pairs(qx1[part], qy1[part], qx2[part], qy2[part], radius)
+            query = query + start
+            distance = segment_distances((qx1[query], qy1[query], qx2[query], qy2[query]),
+                                         (self.x1[segment], self.y1[segment], self.x2[segment], self.y2[segment]))
+            keep = distance <= radius
+            results.append((qowner[query][keep], self.owner[segment][keep], distance[keep]))
+        if not results:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+        return tuple(numpy.concatenate(r) for r in zip(*results))
+
+    def _contained(self, layer):
+
+        # -> (query feature, index feature) where one lies inside a polygon of the other - such a feature can be
+        #    far from every segment of the polygon, so these are found through the layers' STR trees
+        pairs = []
+        if self.layer.polygon:
+            for i in range(len(layer)):
+                point = _first_point(layer.coordinates(i))
+                for j in self.layer.candidates(point and (point[0], point[1], point[0], point[1])):
+                    if point_in_polygon(point, self.layer.coordinates(j)):
+                        pairs.append((i, j))
+        if layer.polygon:
+            for j in range(self.features):
+                point = _first_point(self.layer.coordinates(j))
+                for i in layer.candidates(point and (point[0], point[1], point[0], point[1])):
+                    if point_in_polygon(point, layer.coordinates(i)):
+                        pairs.append((i, j))
+        pairs = numpy.array(sorted(set(pairs)), dtype=numpy.int64).reshape(-1, 2)
+        return pairs[:, 0], pairs[:, 1]
+
+    def _distances(self, layer, positions, radius, contained):
+
+        # -> (query feature, index feature, distance) arrays, one row per feature pair within radius
+        #    (distance between the nearest segments, 0 for contained pairs)
+        queries, features, distance = self._near(layer, positions, radius)
+        inside = numpy.isin(contained[0], positions)
+        queries = numpy.concatenate([queries, contained[0][inside]])
+        features = numpy.concatenate([features, contained[1][inside]])
+        distance = numpy.concatenate([distance, numpy.zeros(inside.sum())])
+        order = numpy.lexsort((distance, features, queries))
+        queries, features, distance = queries[order], features[order], distance[order]
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = (queries[1:] != queries[:-1]) | (features[1:] != features[:-1])
+        return queries[first], features[first], distance[first]
+
+    def within(self, layer, distance):
+
+        # -> for each feature of layer, the (sorted) positions of the index features within distance of it
+        result = [[] for i in range(len(layer))]
+        if not len(self.owner):
+            return result
+        queries, features, distances = self._distances(layer, numpy.arange(len(layer)), map_distance(distance), self._contained(layer))
+        for i, j in zip(queries.tolist(), features.tolist()):
+            result[i].append(j)
+        return result
+
+    def nearest(self, layer, k=1, max_distance=None):
+
+        # -> (positions, distances) - len(layer) x k arrays of the nearest index features to each feature of layer,
+        #    nearest first, -1 / inf where there are fewer than k (within max_distance)
+        # the search radius starts at one cell and doubles for the features still short of k - every index
+        # feature within the radius has been seen, so a feature is done once k of them are
+        positions = numpy.full((len(layer), k), -1, dtype=numpy.int64)
+        distances = numpy.full((len(layer), k), numpy.inf)
+        if not len(self.owner) or not len(layer):
+            return positions, distances
+        limit = map_distance(max_distance) if max_distance is not None else None
+        boxes = [b for b in layer.boxes if b is not None] + [(self.origin[0], self.origin[1],
+                 self.origin[0] + self.columns * self.cell, self.origin[1] + self.rows * self.cell)]
+        furthest = math.hypot(max(b[2] for b in boxes) - min(b[0] for b in boxes), max(b[3] for b in boxes) - min(b[1] for b in boxes))
+        contained = self._contained(layer)
+        radius = self.cell
+        todo = numpy.arange(len(layer))
+        while len(todo):
+            if limit is not None:
+                radius = min(radius, limit)
+            queries, features, distance = self._distances(layer, todo, radius, contained)
+            order = numpy.lexsort((features, distance, queries))
+            queries, features, distance = queries[order], features[order], distance[order]
+            rank = numpy.arange(len(queries)) - numpy.searchsorted(queries, queries)
+            keep = rank < k
+            positions[queries[keep], rank[keep]] = features[keep]
+            distances[queries[keep], rank[keep]] = distance[keep]
+            if radius >= (limit if limit is not None else furthest):
+                break
+            found = numpy.bincount(queries, minlength=len(layer))[todo]
+            todo = todo[found < min(k, self.features)]
+            radius *= 2
+        return positions, distances
+
+
+def _first_point(shape):
+    if not shape:
+        return None
+    return tuple(shape) if not isinstance(shape[0], (list, tuple)) else tuple(shape[0][0])
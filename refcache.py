@@ -0,0 +1,277 @@
+#-------------------------------------------------------------------------------
+# Name:        refcache
+# Purpose:     local on-disk cache of reference layers (zoning, collection lines) read over the network
+#
+# The columns (and geometry) read from a reference layer are kept in a SQLite file per layer
+# (ColumnarBackend format) next to a small JSON entry recording the layer's version
+# (row count, latest edit date, schema - see stages.dataset_version). A read checks the version
+# first and only goes back to the source when it changed, or when more fields are asked for than are cached.
+# Layers with no edit date field are trusted for max_age_hours.
+# Least recently used layers are dropped once the cache grows past max_bytes. The JSON entry is only rewritten
+# when a layer is fetched - a read served from the cache just touches the entry file (once per cache object),
+# and its modified time counts as the last use.
+#
+# CachedBackend puts the cache in front of another backend for a list of source layers:
+#
+#   backend = CachedBackend(ArcpyBackend(), ReferenceCache(r"C:\temp\refcache"), [lines, zoning])
+#   joinFields_fromFeature(lines,"TO_NODE",["PIPESIZE"],points,"HANSEN_ID",["Pipe_Dia"],backend=backend)
+#
+# Inspect or clear from the command line:
+#   python refcache.py C:\temp\refcache list
+#   python refcache.py C:\temp\refcache clear [source ...]
+#-------------------------------------------------------------------------------
+
+import argparse, datetime, glob, hashlib, json, os, re, sys, time
+from utilities import addMessage
+from backends import TableBackend, ColumnarBackend, Field, get_backend, geometry_coordinates, object_array
+from stages import dataset_version
+
+
+def _cache_time(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+class ReferenceCache(object):
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3, max_age_hours=24, backend=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_hours = max_age_hours
+        self.backend = backend
+        self.checked = {} # source -> version
+        self.loaded = {}  # source -> ColumnarBackend
+        self.used = set() # sources whose entry has been touched
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # --- entries ---
+
+    def _path(self, source, extension):
+        return os.path.join(self.directory, hashlib.sha1(source.encode("utf-8")).hexdigest() + extension)
+
+    def entry(self, source):
+        path = self._path(source, ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def entries(self):
+        # -> cache entries, most recently used first
+        result = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            with open(path) as f:
+                entry = json.load(f)
+            entry["last_used"] = max(entry["last_used"], os.path.getmtime(path))
+            result.append(entry)
+        return sorted(result, key=lambda e: e["last_used"], reverse=True)
+
+    def _write_entry(self, entry):
+        path = self._path(entry["source"], ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+
+    def clear(self, source=None):
+        # drops one source, or everything
+        sources = [source] if source is not None else [e["source"] for e in self.entries()]
+        for name in sources:
+            self.loaded.pop(name, None)
+            self.checked.pop(name, None)
+            self.used.discard(name)
+            for extension in (".json", ".sqlite"):
+                path = self._path(name, extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _evict(self, keep):
+        total = 0
+        for entry in self.entries():
+            if entry["source"] != keep and total + entry["bytes"] > self.max_bytes:
+                addMessage("Reference cache full - dropping " + entry["source"])
+                self.clear(entry["source"])
+            else:
+                total += entry["bytes"]
+
+    # --- reading ---
+
+    def _fresh(self, entry, version, fields):
+        if entry is None or entry["version"] != version:
+            return False
+        if version["edited"] is None:
+            age = time.time() - entry["fetched_at"]
+            if age > self.max_age_hours * 3600:
+                return False
+        cached = set(f.upper() for f in entry["fields"])
+        return all(f.upper() in cached for f in fields)
+
+    def _fetch(self, source, fields):
+        b = get_backend(self.backend)
+        addMessage("Reference cache: reading " + source)
+        data = b.read_columns(source, fields)
+        types = dict((f.name.upper(), f) for f in b.list_fields(source))
+        table_fields = []
+        columns = {}
+        for field in fields:
+            if field.upper() == "SHAPE@":
+                table_fields.append(Field("Shape", "GEOMETRY", None))
+                columns["Shape"] = object_array([geometry_coordinates(g) for g in data[field]])
+            else:
+                info = types[field.upper()]
+                table_fields.append(Field(info.name, info.type, info.length))
+                columns[info.name] = data[field]
+        geometry_type = b.geometry_type(source) if "Shape" in columns else None
+
+        path = self._path(source, ".sqlite")
+        if os.path.exists(path):
+            os.remove(path)
+        local = ColumnarBackend(path)
+        local.create_table("data", table_fields, columns, data["OID@"], geometry_type)
+        local.save()
+        self.loaded[source] = local
+        return path
+
+    def read_columns(self, source, fields, where=None):
+
+        # same as TableBackend.read_columns, served from the cache
+        fields = list(fields)
+        wanted = ["SHAPE@" if f.upper().startswith("SHAPE@") else f for f in fields]
+        if where:
+            # the where clause runs on the cached copy, so the fields it names must be cached too
+            names = dict((f.name.upper(), f.name) for f in get_backend(self.backend).list_fields(source) if f.type not in ("OID", "GEOMETRY"))
+            wanted += [names[n.upper()] for n in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", where) if n.upper() in names]
+        entry = self.entry(source)
+        version = self.version(source)
+
+        if not self._fresh(entry, version, wanted):
+            if entry is not None and entry["version"] == version:
+                wanted = entry["fields"] + [f for f in wanted if f.upper() not in [c.upper() for c in entry["fields"]]]
+            wanted = [f for i, f in enumerate(wanted) if f.upper() not in [w.upper() for w in wanted[:i]]]
+            path = self._fetch(source, wanted)
+            entry = {"source": source, "fields": wanted, "version": version, "fetched_at": time.time(),
+                     "fetched": datetime.datetime.now().isoformat(), "bytes": os.path.getsize(path)}
+            entry["last_used"] = entry["fetched_at"]
+            self._write_entry(entry)
+            self.used.add(source)
+            self._evict(source)
+        else:
+            if source not in self.loaded:
+                self.loaded[source] = ColumnarBackend(self._path(source, ".sqlite"))
+            if source not in self.used:
+                os.utime(self._path(source, ".json"), None)
+                self.used.add(source)
+        return self.loaded[source].read_columns("data", fields, where)
+
+    def version(self, source):
+        # probed once per cache object
+        if source not in self.checked:
+            self.checked[source] = json.loads(json.dumps(dataset_version(source, self.backend), default=_cache_time))
+        return self.checked[source]
+
+    def count(self, source):
+        return self.version(source)["rows"]
+
+
+class CachedBackend(TableBackend):
+
+    # backend reading the listed sources through a ReferenceCache and everything else through backend
+
+    def __init__(self, backend, cache, sources):
+        self.backend = get_backend(backend)
+        self.cache = cache
+        self.sources = set(sources)
+        if cache.backend is None:
+            cache.backend = self.backend
+
+    def read_columns(self, table, fields, where=None):
+        if table in self.sources:
+            return self.cache.read_columns(table, fields, where)
+        return self.backend.read_columns(table, fields, where)
+
+    def count(self, table):
+        if table in self.sources:
+            return self.cache.count(table)
+        return self.backend.count(table)
+
+    def select(self, table, where):
+        if table in self.sources:
+            return self.cache.read_columns(table, [], where)["OID@"]
+        return self.backend.select(table, where)
+
+    def ordered_oids(self, table, field, where=None):
+        return self.backend.ordered_oids(table, field, where)
+
+    def list_fields(self, table):
+        return self.backend.list_fields(table)
+
+    def add_field(self, table, name, field_type, length=None):
+        self.backend.add_field(table, name, field_type, length)
+
+    def add_fields(self, table, fields):
+        self.backend.add_fields(table, fields)
+
+    def write_columns(self, table, oids, columns):
+        return self.backend.write_columns(table, oids, columns)
+
+    def copy_table(self, table, out_table, field_map):
+        return self.backend.copy_table(table, out_table, field_map)
+
+    def copy(self, table, out_table):
+        return self.backend.copy(table, out_table)
+
+    def rename(self, table, new_name):
+        self.backend.rename(table, new_name)
+
+    def transform_table(self, table, out_table, fields):
+        return self.backend.transform_table(table, out_table, fields)
+
+    def create_table(self, name, fields, columns, oids=None, geometry_type=None, spatial_reference=None):
+        return self.backend.create_table(name, fields, columns, oids, geometry_type, spatial_reference)
+
+    def spatial_reference(self, table):
+        return self.backend.spatial_reference(table)
+
+    def max_value(self, table, field):
+        return self.backend.max_value(table, field)
+
+    def geometry_type(self, table):
+        return self.backend.geometry_type(table)
+
+    def exists(self, table):
+        return self.backend.exists(table)
+
+    def delete(self, table):
+        self.backend.delete(table)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Inspect or clear the reference layer cache")
+    parser.add_argument("directory", help="cache directory")
+    parser.add_argument("command", choices=["list", "clear"])
+    parser.add_argument("sources", nargs="*", help="sources to clear (default all)")
+    args = parser.parse_args(argv)
+
+    cache = ReferenceCache(args.directory)
+    if args.command == "list":
+        total = 0
+        for entry in cache.entries():
+            total += entry["bytes"]
+            print("{0}\n    fields: {1}\n    rows: {2}, edited: {3}, fetched: {4}, last used: {5}, {6:.1f} MB".format(
+                entry["source"], ", ".join(entry["fields"]), entry["version"]["rows"], entry["version"]["edited"],
+                entry["fetched"], datetime.datetime.fromtimestamp(entry["last_used"]).isoformat(), entry["bytes"] / 1048576.0))
+        print("{0} layers, {1:.1f} MB".format(len(cache.entries()), total / 1048576.0))
+    else:
+        if args.sources:
+            for source in args.sources:
+                cache.clear(source)
+        else:
+            cache.clear()
+        print("Cleared")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
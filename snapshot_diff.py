@@ -0,0 +1,228 @@
+#-------------------------------------------------------------------------------
+# Name:        snapshot_diff
+# Purpose:     row level diff of a new MS4 output against its last archived version, for steward review
+#
+# Both sides are walked in Index_ID order and merged - the new table in the database's key order (ORDER BY
+# Index_ID), read chunk_size rows at a time fetched by OID; the archived version streamed from the archive
+# store's base and deltas in key order (ArchiveStore.rows). The report is written as it goes, so memory stays
+# bounded by the chunks, the new table's keys and the deleted keys of the archive. A database that collates
+# text keys differently from the archive's SQLite (binary) order is refused rather than merged out of order.
+# Each row's attributes and geometry are hashed - rows whose hashes match are skipped, the rest are
+# compared field by field. Results are written out as they are found:
+#   - a CSV with one line per added / removed record and per changed field
+#   - an HTML page with the summary and the first max_html_rows of those lines
+# and a summary (counts of added, removed, changed and unchanged records, changes per field, fields
+# added to or dropped from the schema) is returned.
+#
+#   python snapshot_diff.py <table> <archive store> <dataset> [--stamp S] [--csv out.csv] [--html out.html]
+#
+# The archived side is rebuilt from the archive store (see archive.py) - the version compared against is
+# the latest one not stamped with --exclude (today's stamp, when the new output has already been archived).
+# Rows without a unique key are not compared - they are counted in the summary as "unkeyed".
+#-------------------------------------------------------------------------------
+
+import argparse, collections, csv, hashlib, json, sys
+from utilities import addMessage
+from backends import get_backend, geometry_coordinates, read_columns_for_keys
+from stages import _normal
+
+try:
+    from html import escape
+except ImportError: # python 2
+    from cgi import escape
+
+
+def _value(value, digits):
+    if hasattr(value, "item"):
+        value = value.item()
+    return _normal(value, digits)
+
+
+def table_rows(table, key, fields, backend=None, chunk_size=10000, digits=6, skipped=None):
+
+    # yields (key, [values]) in key order - fields may include SHAPE@ (geometry as plain coordinates)
+    # the order comes from the database (ORDER BY key) and each chunk is read by OID, so no row is read twice
+    # rows with a null or repeated key are skipped and counted in skipped["unkeyed"]
+    b = get_backend(backend)
+    oid_field = [f.name for f in b.list_fields(table) if f.type == "OID"][0]
+    data = b.read_columns(table, [key])
+    key_of = dict(zip(data["OID@"].tolist(), data[key].tolist()))
+    counts = collections.Counter(key_of.values())
+    if skipped is not None:
+        skipped["unkeyed"] = sum(n for k, n in counts.items() if k is None or n > 1)
+    ordered = [oid for oid in b.ordered_oids(table, key).tolist() if key_of[oid] is not None and counts[key_of[oid]] == 1]
+    names = [key] + [f for f in fields if f.upper() != key.upper()]
+    previous = None
+    for start in range(0, len(ordered), chunk_size):
+        chunk = ordered[start:start + chunk_size]
+        data = read_columns_for_keys(b, table, oid_field, names, chunk)
+        position = dict((oid, i) for i, oid in enumerate(data["OID@"].tolist()))
+        columns = [data[key] if f.upper() == key.upper() else data[f] for f in fields]
+        for oid in chunk:
+            i = position[oid]
+            row_key = key_of[oid]
+            # the archive side is in SQLite (binary) order - a database collating keys otherwise cannot be merged with it
+            if previous is not None and not previous < row_key:
+                raise ValueError("{0} orders {1} differently from the archive ({2!r} before {3!r})".format(table, key, previous, row_key))
+            previous = row_key
+            values = []
+            for name, column in zip(fields, columns):
+                value = column[i]
+                if name == "SHAPE@":
+                    value = geometry_coordinates(value)
+                values.append(_value(value, digits))
+            yield row_key, values
+
+
+def archive_rows(store, dataset, stamp, key, fields, chunk_size=10000, digits=6):
+
+    # yields (key, [values]) of an archived version in key order, streamed from the store (rows without a unique key left out)
+    names, rows = store.rows(dataset, stamp, chunk_size, unkeyed=False)
+    upper = dict((name.upper(), i) for i, name in enumerate(names))
+    upper["SHAPE@"] = upper.get("SHAPE")
+    positions = [upper[f.upper()] for f in fields]
+    key_position = upper[key.upper()]
+    for row in rows:
+        yield row[key_position], [_value(row[i], digits) for i in positions]
+
+
+def _row_hash(values):
+    return hashlib.sha1(json.dumps(values, default=str).encode("utf-8")).digest()
+
+
+def compare(old_rows, new_rows, fields):
+
+    # merges two key ordered row streams -> yields (change, key, [(field, old, new)])
+    # change is "added", "removed" or "changed" - unchanged rows are counted by the caller from "unchanged"
+    old_rows, new_rows = iter(old_rows), iter(new_rows)
+    end = object()
+    old, new = next(old_rows, end), next(new_rows, end)
+    while old is not end or new is not end:
+        if new is end or (old is not end and old[0] < new[0]):
+            yield "removed", old[0], []
+            old = next(old_rows, end)
+        elif old is end or new[0] < old[0]:
+            yield "added", new[0], []
+            new = next(new_rows, end)
+        else:
+            if _row_hash(old[1]) == _row_hash(new[1]):
+                yield "unchanged", new[0], []
+            else:
+                yield "changed", new[0], [(f, a, b) for f, a, b in zip(fields, old[1], new[1]) if a != b]
+            old, new = next(old_rows, end), next(new_rows, end)
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return "geometry ({0} parts)".format(len(value)) if value and isinstance(value[0], (list, tuple)) else str(tuple(value))
+    return value
+
+
+def diff_report(table, store, dataset, stamp=None, exclude=None, key="Index_ID", csv_path=None, html_path=None,
+                backend=None, chunk_size=10000, max_html_rows=2000):
+
+    # compares table with the stamp version of dataset (default the latest not stamped exclude) -> summary dict
+    b = get_backend(backend)
+    versions = [v for v in store.versions(dataset) if v["stamp"] != exclude]
+    if stamp is None:
+        if not versions:
+            raise ValueError("No archived version of {0} to compare with".format(dataset))
+        stamp = versions[-1]["stamp"]
+    entry = [v for v in store.versions(dataset) if v["stamp"] == stamp][-1]
+
+    new_fields = [f.name for f in b.list_fields(table) if f.type not in ("OID", "GEOMETRY")]
+    old_fields = [f[0] for f in entry["fields"]]
+    new_upper, old_upper = [f.upper() for f in new_fields], [f.upper() for f in old_fields]
+    common = [f for f in new_fields if f.upper() in old_upper and f.upper() not in ("SHAPE_AREA", "SHAPE_LENGTH")]
+    if key.upper() not in [f.upper() for f in common]:
+        raise ValueError("{0} must be in both versions to compare them".format(key))
+    key = [f for f in common if f.upper() == key.upper()][0]
+    if b.geometry_type(table) and entry["geometry_type"]:
+        common.append("SHAPE@")
+
+    summary = collections.OrderedDict([("table", table), ("dataset", dataset), ("compared_with", stamp),
+                                       ("added", 0), ("removed", 0), ("changed", 0), ("unchanged", 0), ("unkeyed", 0),
+                                       ("fields_added", [f for f in new_fields if f.upper() not in old_upper]),
+                                       ("fields_removed", [f for f in old_fields if f.upper() not in new_upper]),
+                                       ("field_changes", collections.OrderedDict())])
+    csv_file = None
+    if csv_path:
+        csv_file = open(csv_path, "wb") if sys.version_info[0] == 2 else open(csv_path, "w", newline="")
+    html_lines = []
+    try:
+        writer = csv.writer(csv_file) if csv_file else None
+        if writer:
+            writer.writerow(["change", key, "field", "old", "new"])
+        changes = compare(archive_rows(store, dataset, stamp, key, common, chunk_size),
+                          table_rows(table, key, common, b, chunk_size, skipped=summary), common)
+        for change, row_key, fields in changes:
+            summary[change] += 1
+            if change == "unchanged":
+                continue
+            lines = [(change, row_key, "", "", "")] if change != "changed" else \
+                    [(change, row_key, "Shape" if f == "SHAPE@" else f, _cell(old), _cell(new)) for f, old, new in fields]
+            for f, old, new in fields:
+                name = "Shape" if f == "SHAPE@" else f
+                summary["field_changes"][name] = summary["field_changes"].get(name, 0) + 1
+            for line in lines:
+                if writer:
+                    writer.writerow(line)
+                if html_path and len(html_lines) < max_html_rows:
+                    html_lines.append(line)
+    finally:
+        if csv_file:
+            csv_file.close()
+
+    if html_path:
+        _write_html(html_path, summary, html_lines, key, max_html_rows)
+    addMessage("{0} vs archive {1}: {2} added, {3} removed, {4} changed, {5} unchanged".format(
+        dataset, stamp, summary["added"], summary["removed"], summary["changed"], summary["unchanged"]))
+    return summary
+
+
+def _write_html(path, summary, lines, key, max_html_rows):
+    with open(path, "w") as f:
+        f.write("<html><head><meta charset='utf-8'><title>{0} review</title>".format(escape(summary["dataset"])))
+        f.write("<style>body{font-family:sans-serif} table{border-collapse:collapse} td,th{border:1px solid #ccc;padding:2px 6px}"
+                " .added{background:#e6ffe6} .removed{background:#ffe6e6} .changed{background:#fff8e0}</style></head><body>")
+        f.write("<h2>{0} compared with archive {1}</h2>".format(escape(str(summary["table"])), escape(str(summary["compared_with"]))))
+        f.write("<table>")
+        for name in ("added", "removed", "changed", "unchanged", "unkeyed"):
+            f.write("<tr><th>{0}</th><td>{1}</td></tr>".format(name, summary[name]))
+        for name in ("fields_added", "fields_removed"):
+            f.write("<tr><th>{0}</th><td>{1}</td></tr>".format(name.replace("_", " "), escape(", ".join(summary[name])) or "-"))
+        f.write("</table><h3>Changes by field</h3><table>")
+        for name, count in summary["field_changes"].items():
+            f.write("<tr><td>{0}</td><td>{1}</td></tr>".format(escape(name), count))
+        f.write("</table><h3>Records</h3><table><tr><th>change</th><th>{0}</th><th>field</th><th>old</th><th>new</th></tr>".format(escape(key)))
+        for line in lines:
+            f.write("<tr class='{0}'>{1}</tr>".format(line[0], "".join("<td>{0}</td>".format(escape(str(v))) for v in line)))
+        f.write("</table>")
+        if len(lines) >= max_html_rows:
+            f.write("<p>First {0} lines only - see the CSV for the rest.</p>".format(max_html_rows))
+        f.write("</body></html>")
+
+
+def main(argv=None):
+
+    from archive import ArchiveStore
+    parser = argparse.ArgumentParser(description="Diff a dataset against its last archived version")
+    parser.add_argument("table", help="new dataset, e.g. a Current_MS4.gdb feature class")
+    parser.add_argument("store", help="archive store directory")
+    parser.add_argument("dataset", help="archived dataset name, e.g. MS4_OFpoints")
+    parser.add_argument("--stamp", help="archived version to compare with (default the latest)")
+    parser.add_argument("--exclude", help="skip versions with this stamp when picking the latest")
+    parser.add_argument("--csv", help="CSV report path")
+    parser.add_argument("--html", help="HTML report path")
+    args = parser.parse_args(argv)
+
+    summary = diff_report(args.table, ArchiveStore(args.store), args.dataset, args.stamp, args.exclude,
+                          csv_path=args.csv, html_path=args.html)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
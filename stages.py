@@ -0,0 +1,203 @@
+#-------------------------------------------------------------------------------
+# Name:        stages
+# Purpose:     runs a script as a graph of named stages, skipping stages whose inputs have not changed
+#
+# Each stage is a function writing one or more output datasets. Its fingerprint covers
+#   - its parameters (so anything the function reads - where clauses, lookups, field names - belongs in them)
+#   - each source dataset it reads (row count, latest edit date, schema)
+#   - the fingerprints of the stages it depends on
+# and is kept in a JSON cache file after the stage succeeds. On the next run a stage whose
+# fingerprint is unchanged and whose outputs still exist is skipped and its outputs reused.
+#
+# Sources with no edit date field cannot be versioned cheaply - stages reading them always run.
+#-------------------------------------------------------------------------------
+
+import datetime, hashlib, json, os, time
+from utilities import addMessage
+import instrument
+from backends import get_backend, geometry_coordinates
+
+# editor tracking fields checked (in order) for the latest edit date of a source
+edit_date_fields = ("last_edited_date", "EditDate", "edit_date", "LAST_EDITED_DATE")
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def dataset_version(table, backend=None, edit_fields=edit_date_fields):
+
+    # cheap probe of a source dataset -> {"rows", "edited", "schema"}, edited is None without an edit date field
+    b = get_backend(backend)
+    fields = b.list_fields(table)
+    version = {"rows": b.count(table), "edited": None,
+               "schema": _hash([(f.name, f.type, f.length) for f in fields])}
+    names = dict((f.name.upper(), f.name) for f in fields)
+    for edit_field in edit_fields:
+        if edit_field.upper() in names:
+            version["edited"] = b.max_value(table, names[edit_field.upper()])
+            break
+    return version
+
+
+def _normal(value, digits):
+    # value -> something json can write the same way every time (coordinates rounded to digits)
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, (list, tuple)):
+        return [_normal(v, digits) for v in value]
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def row_hashes(data, names, digits=6):
+
+    # -> (sha1 hex of each row's values in names, total bytes hashed) - data as from read_columns,
+    # SHAPE@ geometry hashed as plain coordinates rounded to digits
+    columns = [data[name] for name in names]
+    hashes = []
+    size = 0
+    for i in range(len(data["OID@"])):
+        row = []
+        for name, column in zip(names, columns):
+            value = column[i]
+            if name == "SHAPE@":
+                value = geometry_coordinates(value)
+            row.append(_normal(value.item() if hasattr(value, "item") else value, digits))
+        text = json.dumps(row, default=str).encode("utf-8")
+        size += len(text)
+        hashes.append(hashlib.sha1(text).hexdigest())
+    return hashes, size
+
+
+def dataset_fingerprint(table, backend=None, digits=6):
+
+    # full content fingerprint of a dataset -> {"schema", "rows", "content", "bytes"}
+    # content is an order independent hash of every row's values and geometry (OIDs are ignored,
+    # so a re-copied but unchanged dataset has the same fingerprint), bytes the size of the row data hashed
+    b = get_backend(backend)
+    fields = [f for f in b.list_fields(table) if f.type not in ("OID", "GEOMETRY")]
+    geometry = [f for f in b.list_fields(table) if f.type == "GEOMETRY"]
+    names = [f.name for f in fields] + (["SHAPE@"] if geometry else [])
+    hashes, size = row_hashes(b.read_columns(table, names), names, digits)
+    # rows hashed separately and summed, so the row order does not matter (and duplicate rows still count)
+    total = sum(int(h[:32], 16) for h in hashes) % (1 << 128)
+    return {"schema": _hash([(f.name, f.type, f.length) for f in fields] + [f.type for f in geometry]),
+            "rows": len(hashes), "content": "{0:032x}".format(total), "bytes": size}
+
+
+class Stage(object):
+
+    def __init__(self, name, func, params, depends, sources, outputs):
+        self.name = name
+        self.func = func
+        self.params = params
+        self.depends = depends
+        self.sources = sources
+        self.outputs = outputs
+
+
+class Pipeline(object):
+
+    def __init__(self, cache_path, backend=None, edit_fields=edit_date_fields):
+        self.cache_path = cache_path
+        self.backend = backend
+        self.edit_fields = edit_fields
+        self.stages = {}
+        self.order = []
+        self.cache = {}
+        self.fingerprints = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+
+    def stage(self, name, func, params=None, depends=(), sources=(), outputs=()):
+
+        # func(**params) writes outputs - depends names earlier stages, sources are datasets not made by any stage
+        if name in self.stages:
+            raise ValueError("Stage: {0} already defined".format(name))
+        for depend in depends:
+            if depend not in self.stages:
+                raise ValueError("Stage: {0} depends on unknown stage {1}".format(name, depend))
+        self.stages[name] = Stage(name, func, params or {}, list(depends), list(sources), list(outputs))
+        self.order.append(name)
+        return name
+
+    def required(self, targets=None):
+
+        # -> stage names needed for targets (all stages if None), dependencies first
+        if targets is None:
+            return list(self.order)
+        needed = []
+        def visit(name):
+            if name not in self.stages:
+                raise ValueError("Stage: {0} not defined".format(name))
+            if name in needed:
+                return
+            for depend in self.stages[name].depends:
+                visit(depend)
+            needed.append(name)
+        for target in targets:
+            visit(target)
+        return needed
+
+    def fingerprint(self, name, fingerprints, versions):
+
+        # fingerprints holds the already computed fingerprints of upstream stages
+        # -> fingerprint, or None if a source cannot be versioned
+        stage = self.stages[name]
+        inputs = {}
+        for source in stage.sources:
+            if source not in versions:
+                versions[source] = dataset_version(source, self.backend, self.edit_fields)
+            if versions[source]["edited"] is None:
+                return None
+            inputs[source] = versions[source]
+        upstream = dict((depend, fingerprints[depend]) for depend in stage.depends)
+        return _hash({"func": stage.func.__name__, "params": stage.params, "sources": inputs,
+                      "upstream": upstream, "outputs": stage.outputs})
+
+    def run(self, targets=None, force=False, done=None):
+
+        # runs the needed stages in order - force=True (or a list of stage names) ignores the cache for those stages
+        # done is {stage name: fingerprint} of stages already run earlier in this run (e.g. by a worker process,
+        # see self.fingerprints) - they are taken as they are, not checked or run again
+        # -> {stage name: "ran" / "cached"}
+        b = get_backend(self.backend)
+        fingerprints = dict(done or {})
+        self.fingerprints = fingerprints
+        versions = {}
+        status = {}
+        for name in self.required(targets):
+            if name in fingerprints:
+                continue
+            stage = self.stages[name]
+            fingerprint = self.fingerprint(name, fingerprints, versions)
+            forced = force is True or (force and name in force)
+            cached = self.cache.get(name, {})
+            if (not forced and fingerprint is not None and cached.get("fingerprint") == fingerprint
+                    and all(b.exists(output) for output in stage.outputs)):
+                addMessage("Stage {0}: unchanged, reusing {1}".format(name, ", ".join(stage.outputs)))
+                fingerprints[name] = fingerprint
+                status[name] = "cached"
+                continue
+
+            addMessage("Stage {0}: running".format(name))
+            start = time.time()
+            with instrument.stage(name):
+                stage.func(**stage.params)
+            seconds = time.time() - start
+
+            # a stage with unversioned sources gets a new fingerprint every run, so its downstream stages rerun too
+            fingerprint = fingerprint or _hash({"ran": datetime.datetime.now().isoformat(), "stage": name})
+            fingerprints[name] = fingerprint
+            self.cache[name] = {"fingerprint": fingerprint, "outputs": stage.outputs,
+                                "finished": datetime.datetime.now().isoformat(), "seconds": round(seconds, 2)}
+            self._save()
+            status[name] = "ran"
+        return status
+
+    def _save(self):
+        with open(self.cache_path, "w") as f:
+            json.dump(self.cache, f, indent=2, sort_keys=True)
@@ -0,0 +1,19 @@
+#-------------------------------------------------------------------------------
+# Name:        conftest
+# Purpose:     shared pytest setup - the repo modules on the path and logs kept out of the working tree
+#
+# The tests run on backends.ColumnarBackend, so they need numpy but not arcpy:
+#   python -m pytest -q
+#-------------------------------------------------------------------------------
+
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # addMessage writes Script_Log.log to the current directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
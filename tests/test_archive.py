@@ -0,0 +1,88 @@
+import pytest
+from backends import ColumnarBackend, object_array
+from archive import ArchiveStore
+
+
+def make_table(backend, rows, name="t"):
+    # rows are (Index_ID, Name, x)
+    columns = {"Index_ID": object_array([r[0] for r in rows]), "Name": object_array([r[1] for r in rows]),
+               "Shape": object_array([(float(r[2]), 0.0) for r in rows])}
+    return backend.create_table(name, [("Index_ID", "LONG"), ("Name", "TEXT", 20), ("Shape", "GEOMETRY")], columns,
+                                geometry_type="POINT")
+
+
+def rebuilt(store, stamp=None):
+    fields, columns, geometry_type, spatial_reference = store.rebuild("DS", stamp)
+    return list(zip(columns["Index_ID"].tolist(), columns["Name"].tolist(), [s[0] for s in columns["Shape"].tolist()]))
+
+
+def keyed_order(rows):
+    # how rebuild returns them - keyed rows by key, then the unkeyed rows as archived
+    counts = {}
+    for r in rows:
+        counts[r[0]] = counts.get(r[0], 0) + 1
+    keyed = [r for r in rows if r[0] is not None and counts[r[0]] == 1]
+    return sorted(keyed) + [r for r in rows if r not in keyed]
+
+
+@pytest.fixture
+def versions(tmp_path):
+    # five versions with updates, deletes, a delete then re-insert, and rows without a unique key
+    first = [(k, "n{0}".format(k), k) for k in range(1, 41)]
+    second = [r for r in first if r[0] not in (3, 4)] + [(41, "n41", 41), (None, "no key", 0)]
+    third = [(k, "changed" if k == 10 else n, x) for k, n, x in second] + [(50, "dup a", 1), (50, "dup b", 2)]
+    fourth = [r for r in third if r[0] != 10] + [(3, "back", 3)]
+    fifth = [(k, n, x + 0.5 if k == 20 else x) for k, n, x in fourth]
+    return [("s1", first), ("s2", second), ("s3", third), ("s4", fourth), ("s5", fifth)]
+
+
+def archive_all(tmp_path, versions, **options):
+    b = ColumnarBackend()
+    store = ArchiveStore(str(tmp_path / "store"), **options)
+    for stamp, rows in versions:
+        make_table(b, rows)
+        store.archive("t", "DS", stamp, backend=b)
+    return b, store
+
+
+def test_deltas_rebuild_every_version(tmp_path, versions):
+    b, store = archive_all(tmp_path, versions, max_delta_fraction=1.0)
+    assert [v["kind"] for v in store.versions("DS")] == ["base", "delta", "delta", "delta", "delta"]
+    assert [(v["inserted"], v["updated"], v["deleted"], v["unkeyed"]) for v in store.versions("DS")][1:] == \
+        [(1, 0, 2, 1), (0, 1, 0, 3), (1, 0, 1, 3), (0, 1, 0, 3)]
+    for stamp, rows in versions:
+        assert rebuilt(store, stamp) == keyed_order(rows)
+
+
+def test_compact_and_base_chain(tmp_path, versions):
+    b, store = archive_all(tmp_path, versions, max_chain=2, max_delta_fraction=1.0)
+    assert [v["kind"] for v in store.versions("DS")] == ["base", "delta", "delta", "base", "delta"]
+    for stamp, rows in versions:
+        assert rebuilt(store, stamp) == keyed_order(rows)
+    store.compact("DS")
+    assert store.versions("DS")[-1]["kind"] == "base"
+    assert rebuilt(store) == keyed_order(versions[-1][1])
+
+
+def test_export_round_trip(tmp_path, versions):
+    b, store = archive_all(tmp_path, versions)
+    store.export("DS", "s3", "out", backend=b)
+    data = b.read_columns("out", ["Index_ID", "Name"])
+    assert sorted(zip(data["Index_ID"].tolist(), data["Name"].tolist()), key=str) == \
+        sorted(((k, n) for k, n, x in versions[2][1]), key=str)
+
+
+@pytest.mark.parametrize("key_type, keys", [("DOUBLE", [1.0, 2.0, 3.5, 4.0]), ("TEXT", ["1", "2", "10", "x"])])
+def test_state_keys_keep_the_key_type(tmp_path, key_type, keys):
+    # float (and text) Index_IDs must still match their previous version once read back from the state table
+    store = ArchiveStore(str(tmp_path / "store"), max_delta_fraction=1.0)
+    b = ColumnarBackend()
+    for stamp, names in [("s1", ["a", "b", "c", "d"]), ("s2", ["a", "B", "c", "d"])]:
+        b.create_table("t", [("Index_ID", key_type), ("Name", "TEXT", 20)],
+                       {"Index_ID": object_array(keys), "Name": object_array(names)})
+        store.archive("t", "DS", stamp, backend=b)
+    last = store.versions("DS")[-1]
+    assert (last["kind"], last["inserted"], last["updated"], last["deleted"]) == ("delta", 0, 1, 0)
+    fields, columns, geometry_type, spatial_reference = store.rebuild("DS")
+    assert sorted(zip(columns["Index_ID"].tolist(), columns["Name"].tolist()), key=str) == \
+        sorted(zip(keys, ["a", "B", "c", "d"]), key=str)
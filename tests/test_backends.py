@@ -0,0 +1,174 @@
+import datetime
+import numpy
+import pytest
+from backends import ColumnarBackend, Field, object_array, read_columns_for_keys
+
+
+# the TableBackend interface as the tools use it - run on an in memory ColumnarBackend and on one
+# saved to SQLite and opened again, so nothing depends on the tables having stayed in memory
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    b = ColumnarBackend(str(tmp_path / "tables.sqlite") if request.param == "sqlite" else None)
+    fields = [("Index_ID", "LONG"), ("Name", "TEXT", 20), ("Size", "DOUBLE"), ("Installed", "DATE"), ("Shape", "GEOMETRY")]
+    columns = {"Index_ID": numpy.array([1, 2, 3]),
+               "Name": object_array(["a", None, "c"]),
+               "Size": object_array([1.5, 2.5, None]),
+               "Installed": object_array([datetime.datetime(2001, 1, 2), None, datetime.datetime(2010, 5, 6)]),
+               "Shape": object_array([[[(0.0, 0.0), (0.0, 2.0), (2.0, 2.0), (2.0, 0.0), (0.0, 0.0)]], None,
+                                      [[(0.0, 0.0), (0.0, 1.0), (3.0, 1.0), (3.0, 0.0), (0.0, 0.0)]]])}
+    b.create_table("bmps", fields, columns, geometry_type="POLYGON")
+    if request.param == "sqlite":
+        b.save()
+        b = ColumnarBackend(b.path)
+    return b
+
+
+def test_list_fields(backend):
+    assert [(f.name, f.type) for f in backend.list_fields("bmps")] == [
+        ("OBJECTID", "OID"), ("Index_ID", "LONG"), ("Name", "TEXT"), ("Size", "DOUBLE"), ("Installed", "DATE"), ("Shape", "GEOMETRY")]
+    assert backend.geometry_type("bmps") == "POLYGON"
+    assert backend.count("bmps") == 3
+
+
+def test_read_columns(backend):
+    data = backend.read_columns("bmps", ["Name", "index_id", "SHAPE@AREA"])
+    assert list(data) == ["OID@", "Name", "index_id", "SHAPE@AREA"]
+    assert data["OID@"].tolist() == [1, 2, 3]
+    assert data["Name"].tolist() == ["a", None, "c"]
+    assert data["index_id"].tolist() == [1, 2, 3]
+    assert data["SHAPE@AREA"].tolist() == [4.0, 0.0, 3.0]
+    assert backend.read_columns("bmps", ["Installed"])["Installed"].tolist()[0] == datetime.datetime(2001, 1, 2)
+
+
+def test_read_columns_where(backend):
+    assert backend.read_columns("bmps", ["Index_ID"], "Size > 2 OR Name IS NULL")["Index_ID"].tolist() == [2]
+    assert backend.read_columns("bmps", ["Index_ID"], "Installed < date '2005-01-01'")["Index_ID"].tolist() == [1]
+    assert backend.select("bmps", "Name IN ('a', 'c')").tolist() == [1, 3]
+    assert backend.read_columns("bmps", ["Index_ID"], "1 = 0")["Index_ID"].tolist() == []
+
+
+def test_write_columns_updates_only_the_given_rows(backend):
+    written = backend.write_columns("bmps", numpy.array([3, 1]), {"Name": object_array(["C", "A"]), "Size": 9.0})
+    assert written == 2
+    data = backend.read_columns("bmps", ["Name", "Size"])
+    assert data["Name"].tolist() == ["A", None, "C"]
+    assert data["Size"].tolist() == [9.0, 2.5, 9.0]
+    # the where clause sees what was written
+    assert backend.select("bmps", "Size = 9").tolist() == [1, 3]
+    with pytest.raises(KeyError):
+        backend.write_columns("bmps", numpy.array([7]), {"Name": "x"})
+
+
+def test_add_field(backend):
+    backend.add_field("bmps", "Notes", "TEXT", 50)
+    backend.add_field("bmps", "NOTES", "TEXT", 50) # already there - left alone
+    assert [f for f in backend.list_fields("bmps") if f.name.upper() == "NOTES"] == [Field("Notes", "TEXT", 50)]
+    assert backend.read_columns("bmps", ["Notes"])["Notes"].tolist() == [None, None, None]
+    backend.add_fields("bmps", [("Count", "LONG")])
+    backend.write_columns("bmps", numpy.array([2]), {"Count": 4})
+    assert backend.read_columns("bmps", ["Count"])["Count"].tolist() == [None, 4, None]
+
+
+def test_copy_table(backend):
+    backend.copy_table("bmps", "copy", [("Index_ID", "ID"), ("Name", "Name"), ("OBJECTID", "OBJECTID")])
+    assert [f.name for f in backend.list_fields("copy")] == ["OBJECTID", "ID", "Name", "Shape"]
+    data = backend.read_columns("copy", ["ID", "Name", "SHAPE@AREA"])
+    assert data["ID"].tolist() == [1, 2, 3]
+    assert data["SHAPE@AREA"].tolist() == [4.0, 0.0, 3.0]
+    # the copy is independent of the source
+    backend.write_columns("copy", numpy.array([1]), {"Name": "changed"})
+    assert backend.read_columns("bmps", ["Name"])["Name"].tolist()[0] == "a"
+
+
+def test_transform_table(backend):
+    backend.transform_table("bmps", "out", [("Name", Field("Label", "TEXT", 10), {"a": "Alpha"}),
+                                            ("Index_ID", Field("ID_text", "TEXT", 5), None),
+                                            ("Size", Field("Size", "LONG", None), None)])
+    assert [(f.name, f.type) for f in backend.list_fields("out")] == [
+        ("OBJECTID", "OID"), ("Label", "TEXT"), ("ID_text", "TEXT"), ("Size", "LONG"), ("Shape", "GEOMETRY")]
+    data = backend.read_columns("out", ["Label", "ID_text", "Size"])
+    assert data["Label"].tolist() == ["Alpha", None, None] # unmatched lookups become null
+    assert data["ID_text"].tolist() == ["1", "2", "3"]
+    assert data["Size"].tolist() == [1, 2, None]
+
+
+def test_copy_and_rename(backend):
+    backend.copy("bmps", "copy")
+    assert [f.name for f in backend.list_fields("copy")] == [f.name for f in backend.list_fields("bmps")]
+    assert backend.read_columns("copy", ["Name", "SHAPE@"])["SHAPE@"].tolist()[1] is None
+    backend.rename("copy", "renamed")
+    assert not backend.exists("copy") and backend.exists("renamed")
+    assert backend.read_columns("renamed", ["Name"])["Name"].tolist() == ["a", None, "c"]
+    with pytest.raises(KeyError):
+        backend.rename("renamed", "bmps")
+
+
+def test_saved_tables_round_trip(tmp_path):
+    path = str(tmp_path / "round.sqlite")
+    b = ColumnarBackend(path)
+    b.create_table("t", [("Name", "TEXT", 5), ("Shape", "GEOMETRY")],
+                   {"Name": object_array(["x", None]), "Shape": object_array([(1.0, 2.0), None])}, geometry_type="POINT")
+    b.save()
+    again = ColumnarBackend(path)
+    assert again.list_tables() == ["t"]
+    assert again.read_columns("t", ["Name", "SHAPE@"])["SHAPE@"].tolist() == [(1.0, 2.0), None]
+    again.delete("t")
+    assert not ColumnarBackend(path).exists("t")
+
+
+class WhereSpy(ColumnarBackend):
+    # records the where clause of each read
+
+    def __init__(self):
+        ColumnarBackend.__init__(self)
+        self.wheres = []
+
+    def read_columns(self, table, fields, where=None):
+        self.wheres.append(where)
+        return ColumnarBackend.read_columns(self, table, fields, where)
+
+
+def keyed_table(rows):
+    b = WhereSpy()
+    b.create_table("t", [("Key", "LONG"), ("Value", "TEXT", 10)],
+                   {"Key": numpy.arange(rows), "Value": object_array(["v{0}".format(i) for i in range(rows)])})
+    b.wheres = []
+    return b
+
+
+def test_read_columns_for_keys_batches():
+    b = keyed_table(10000)
+    keys = list(range(0, 3000, 2)) + [None, 2, 99999]
+    data = read_columns_for_keys(b, "t", "Key", ["Value"], keys)
+    # 1501 distinct keys -> one batch of 999 and one of 502, nulls and repeats dropped
+    assert len(b.wheres) == 2
+    assert [where.count(",") + 1 for where in b.wheres] == [999, 502]
+    assert all(where.startswith("Key IN (") for where in b.wheres)
+    assert data["Key"].tolist() == list(range(0, 3000, 2)) and list(data.keys()) == ["OID@", "Key", "Value"]
+    assert data["Value"].tolist() == ["v{0}".format(i) for i in range(0, 3000, 2)]
+
+    b.wheres = []
+    data = read_columns_for_keys(b, "t", "Key", ["Value"], [5, 1, 3], batch_size=2)
+    assert b.wheres == ["Key IN (1, 3)", "Key IN (5)"]
+    assert data["Key"].tolist() == [1, 3, 5]
+
+
+def test_read_columns_for_keys_full_scan():
+    b = keyed_table(100)
+    # more keys than 0.2 of the rows -> one unfiltered read, holding the other rows too
+    data = read_columns_for_keys(b, "t", "Key", ["Value"], range(21))
+    assert b.wheres == [None] and len(data["Key"]) == 100
+    b.wheres = []
+    read_columns_for_keys(b, "t", "Key", ["Value"], range(20))
+    assert len(b.wheres) == 1 and b.wheres[0].startswith("Key IN (")
+    b.wheres = []
+    read_columns_for_keys(b, "t", "Key", ["Value"], range(21), full_scan_fraction=0.5)
+    assert b.wheres[0] is not None
+
+
+def test_read_columns_for_keys_no_keys():
+    b = keyed_table(10)
+    data = read_columns_for_keys(b, "t", "Key", ["Value"], [None])
+    assert b.wheres == ["1 = 0"]
+    assert list(data.keys()) == ["OID@", "Key", "Value"] and len(data["Key"]) == 0
@@ -0,0 +1,79 @@
+import datetime
+import pytest
+from backends import ColumnarBackend, object_array
+from conditional import ConditionalUpdate
+from expressions import parse
+from BMP_tools import fillField_Conditional, fillFields_Conditional
+
+
+@pytest.fixture
+def backend():
+    b = ColumnarBackend()
+    b.create_table("bmps", [("Gen_Type", "TEXT", 20), ("MS4", "SHORT"), ("As_Built", "TEXT", 20), ("InstallDate", "DATE")],
+                   {"Gen_Type": object_array(["Swale", "Pond", "Swale", None, "Pond"]),
+                    "MS4": object_array([None, 5, None, None, None]),
+                    "As_Built": object_array([None, "yes", None, "no", None]),
+                    "InstallDate": object_array([datetime.datetime(1995, 1, 1), datetime.datetime(2005, 1, 1), None,
+                                                 datetime.datetime(1990, 6, 1), datetime.datetime(2010, 1, 1)])})
+    return b
+
+
+def column(b, field):
+    return b.read_columns("bmps", [field])[field].tolist()
+
+
+rules = [("Gen_Type = 'Swale'", "MS4", 1),
+         ("Gen_Type = 'Pond'", "MS4", 2),
+         (None, "MS4", 0)]
+
+
+def test_first_rule_wins(backend):
+    hits = ConditionalUpdate("bmps", rules, backend=backend).run()
+    assert column(backend, "MS4") == [1, 2, 1, 0, 2]
+    assert [(h["matched"], h["hits"]) for h in hits] == [(2, 2), (2, 2), (5, 1)]
+    assert hits[0]["where"] == "Gen_Type = 'Swale'" and hits[0]["field"] == "MS4"
+
+
+def test_last_rule_wins(backend):
+    hits = ConditionalUpdate("bmps", rules[::-1], mode="last", backend=backend).run()
+    assert column(backend, "MS4") == [1, 2, 1, 0, 2]
+    # hits stay in rule order - the catch all only sets the row no later rule does
+    assert [h["hits"] for h in hits] == [1, 2, 2]
+
+
+def test_only_null(backend):
+    hits = ConditionalUpdate("bmps", rules, only_null=True, backend=backend).run()
+    assert column(backend, "MS4") == [1, 5, 1, 0, 2]
+    assert [(h["matched"], h["hits"]) for h in hits] == [(2, 2), (1, 1), (4, 1)]
+
+
+def test_expressions_and_date_where(backend):
+    hits = fillFields_Conditional("bmps", [
+        ("InstallDate < date '2000-01-01'", "As_Built", parse("coalesce(!As_Built!, 'pre 2000')")),
+        ("InstallDate IS NULL", "As_Built", "unknown")], backend=backend)
+    assert column(backend, "As_Built") == ["pre 2000", "yes", "unknown", "no", None]
+    assert [h["hits"] for h in hits] == [2, 1]
+
+
+def test_rules_see_the_stored_table(backend):
+    # the second rule matches on the Gen_Type as stored, not the value the first rule sets
+    fillFields_Conditional("bmps", [("Gen_Type IS NULL", "Gen_Type", "Swale"),
+                                    ("Gen_Type = 'Swale'", "As_Built", "swale")], backend=backend)
+    assert column(backend, "Gen_Type") == ["Swale", "Pond", "Swale", "Swale", "Pond"]
+    assert column(backend, "As_Built") == ["swale", "yes", "swale", "no", None]
+
+
+def test_fillField_Conditional(backend):
+    assert fillField_Conditional("bmps", "MS4", 9, "Gen_Type = 'Pond'", backend=backend) == 1
+    assert column(backend, "MS4") == [None, 5, None, None, 9]
+    assert fillField_Conditional("bmps", "MS4", 8, "Gen_Type = 'Pond'", only_null=False, backend=backend) == 2
+    assert column(backend, "MS4") == [None, 8, None, None, 8]
+
+
+def test_bad_rules(backend):
+    with pytest.raises(ValueError):
+        ConditionalUpdate("bmps", rules, mode="any")
+    with pytest.raises(ValueError):
+        ConditionalUpdate("bmps", [("Gen_Type = 'Pond'", "MS4")])
+    with pytest.raises(ValueError):
+        ConditionalUpdate("bmps", [(None, "Nope", 1)], backend=backend).run()
@@ -0,0 +1,27 @@
+import numpy
+import pytest
+from backends import object_array
+from expressions import ExpressionError, parse
+
+
+@pytest.mark.parametrize("column", [numpy.array([numpy.nan, 1.0, 2.0]), object_array([None, 1, 2])])
+@pytest.mark.parametrize("text, expected", [
+    ("!A! == 1", [False, True, False]),
+    ("!A! != 1", [False, False, True]),
+    ("!A! < 2", [False, True, False]),
+    ("1 <= !A! < 3", [False, True, True]),
+    ("isnull(!A!)", [True, False, False]),
+])
+def test_comparisons_with_nulls_are_false(column, text, expected):
+    assert parse(text).evaluate({"A": column}, 3).tolist() == expected
+
+
+def test_nulls_carry_through_arithmetic():
+    result = parse("round(!A! * 2 + 1, 1)").evaluate({"A": object_array([None, 1.25])}, 2).tolist()
+    assert result[0] is None
+    assert result[1] == pytest.approx(3.5)
+
+
+def test_unsupported_syntax_is_refused():
+    with pytest.raises(ExpressionError):
+        parse("__import__('os')")
@@ -0,0 +1,96 @@
+import pytest
+from backends import ColumnarBackend, object_array
+from field_plan import FieldPlan
+
+
+class CountingBackend(ColumnarBackend):
+    # counts read / write passes over tables
+
+    def __init__(self):
+        ColumnarBackend.__init__(self)
+        self.reads = 0
+        self.writes = 0
+
+    def read_columns(self, table, fields, where=None):
+        self.reads += 1
+        return ColumnarBackend.read_columns(self, table, fields, where)
+
+    def write_columns(self, table, oids, columns):
+        self.writes += 1
+        return ColumnarBackend.write_columns(self, table, oids, columns)
+
+
+def make_table(backend):
+    columns = {"Type": object_array(["BIO", "POND", "OTHER", None]), "Gen_Type": object_array([None, "Pond", "old", None]),
+               "Original_Type": object_array([None] * 4), "Size": object_array([1.0, 2.0, 3.0, 4.0])}
+    return backend.create_table("t", [("Type", "TEXT", 10), ("Gen_Type", "TEXT", 20), ("Original_Type", "TEXT", 10),
+                                      ("Size", "DOUBLE")], columns)
+
+
+def column(backend, field):
+    return backend.read_columns("t", [field])[field].tolist()
+
+
+lookup = {"BIO": "Bioretention", "POND": "Pond"}
+
+
+def test_overwritten_fill_is_dropped():
+    b = CountingBackend()
+    make_table(b)
+    plan = FieldPlan("t", b).fill("Gen_Type", "x").calc("Gen_Type", "!Type!")
+    assert [step["kind"] for step in plan.optimize()] == ["calc"]
+    counts = plan.run()
+    assert counts["steps"] == 1 and counts["dropped"] == 1
+    assert column(b, "Gen_Type") == ["BIO", "POND", "OTHER", None]
+
+
+def test_write_read_later_is_kept():
+    b = ColumnarBackend()
+    make_table(b)
+    # the fill is read by the copy before the calc overwrites it, and a keep lookup only writes matched rows
+    plan = FieldPlan("t", b).fill("Gen_Type", "x").copy("Original_Type", "Gen_Type").calc("Gen_Type", "!Type!")
+    plan.fill("Size", 0.0).lookup("Size", "Type", {"BIO": 9.0})
+    assert [step["kind"] for step in plan.optimize()] == ["fill", "copy", "calc", "fill", "lookup"]
+    plan.run()
+    assert column(b, "Original_Type") == ["x"] * 4
+    assert column(b, "Size") == [9.0, 0.0, 0.0, 0.0]
+
+
+def test_steps_run_in_order():
+    b = ColumnarBackend()
+    make_table(b)
+    # the copy sees Gen_Type as stored, the lookup after it overwrites matched rows only
+    FieldPlan("t", b).copy("Original_Type", "Gen_Type").lookup("Gen_Type", "Type", lookup).run()
+    assert column(b, "Original_Type") == [None, "Pond", "old", None]
+    assert column(b, "Gen_Type") == ["Bioretention", "Pond", "old", None]
+    # the other way round the copy sees the lookup's values
+    make_table(b)
+    FieldPlan("t", b).lookup("Gen_Type", "Type", lookup, unmatched="null").copy("Original_Type", "Gen_Type").run()
+    assert column(b, "Original_Type") == ["Bioretention", "Pond", None, None]
+
+
+def test_single_pass_and_changed_rows_only():
+    b = CountingBackend()
+    make_table(b)
+    plan = FieldPlan("t", b).add_fields([("UID", "LONG"), ("MS4", "SHORT")])
+    plan.sequence("UID", sort_field="Size").fill("MS4", 1).lookup("Gen_Type", "Type", lookup)
+    plan.fill_where("Original_Type", "none", only_null=True).calc("Size", "!Size! * 2")
+    counts = plan.run()
+    assert (b.reads, b.writes) == (1, 1)
+    assert counts == {"rows": 4, "written": 4, "steps": 5, "dropped": 0}
+    assert column(b, "UID") == [1, 2, 3, 4]
+    assert column(b, "Size") == [2.0, 4.0, 6.0, 8.0]
+
+    b.reads = b.writes = 0
+    counts = FieldPlan("t", b).fill("MS4", 1).lookup("Gen_Type", "Type", lookup).run()
+    assert counts["written"] == 0
+
+
+def test_where_clause_on_written_field_is_refused():
+    b = ColumnarBackend()
+    make_table(b)
+    plan = FieldPlan("t", b).fill("Type", "BIO").fill_where("Gen_Type", "x", where="Type = 'BIO'")
+    with pytest.raises(ValueError):
+        plan.run()
+    FieldPlan("t", b).fill_where("Gen_Type", "x", where="Type = 'BIO'").run()
+    assert column(b, "Gen_Type") == ["x", "Pond", "old", None]
@@ -0,0 +1,68 @@
+import json, os, subprocess, sys
+import numpy
+import instrument
+from backends import ColumnarBackend
+
+
+def test_writes_are_buffered_until_flush(tmp_path):
+    path = str(tmp_path / "log.txt")
+    w = instrument.LogWriter(path, interval=60)
+    w.write("one\n")
+    w.write("two\n")
+    assert not os.path.exists(path)
+    w.flush()
+    with open(path) as f:
+        assert f.read() == "one\ntwo\n"
+
+
+def test_buffered_writes_are_flushed_at_exit(tmp_path):
+    path = str(tmp_path / "log.txt")
+    script = "import instrument\nw = instrument.writer({0!r})\nw.interval = 60\nw.write('last words\\n')\n".format(path)
+    subprocess.check_call([sys.executable, "-c", script], cwd=os.path.dirname(instrument.__file__))
+    with open(path) as f:
+        assert f.read() == "last words\n"
+
+
+def test_records_are_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setitem(instrument._settings, "records_path", None)
+    entry = instrument.record("message", text="hello")
+    assert entry["kind"] == "message" and entry["run"] == instrument.run_id()
+    with instrument.stage("quiet"):
+        pass
+    instrument.flush()
+    assert os.listdir(str(tmp_path)) == []
+    assert instrument.stage_records() == []
+
+    path = str(tmp_path / "records.jsonl")
+    instrument.configure(records_path=path)
+    instrument.record("message", text="hello")
+    with instrument.stage("loud", tool="test") as s:
+        s.rows = 5
+    records = instrument.stage_records()
+    assert [(r["name"], r["rows"], r["tool"]) for r in records] == [("loud", 5, "test")]
+    with open(path) as f:
+        assert [json.loads(line)["kind"] for line in f] == ["message", "stage"]
+
+
+def test_rows_counted_once_per_stage(tmp_path, monkeypatch):
+    monkeypatch.setitem(instrument._settings, "records_path", str(tmp_path / "records.jsonl"))
+    b = ColumnarBackend()
+    b.create_table("t", [("Value", "LONG")], {"Value": numpy.arange(10)})
+
+    @instrument.stage
+    def inner():
+        b.read_columns("t", ["Value"])
+
+    with instrument.stage("outer"):
+        b.read_columns("t", ["Value"], "Value < 3")
+        inner()
+        inner()
+    records = dict((r["name"], r) for r in reversed(instrument.stage_records()))
+    assert records["outer"]["rows"] == 3
+    assert records["inner"]["rows"] == 10
+    assert records["inner"]["parent"] == records["outer"]["id"]
+    summary = dict((row["name"], row) for row in instrument.summary())
+    # the outer stage's rows and self time leave out its children
+    assert (summary["outer"]["rows"], summary["inner"]["rows"], summary["inner"]["calls"]) == (3, 20, 2)
+    assert summary["outer"]["self"] <= summary["outer"]["wall"]
+    assert instrument.report()[0].startswith("Hot stages for run")
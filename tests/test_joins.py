@@ -0,0 +1,96 @@
+import pytest
+from backends import ColumnarBackend, object_array
+from BMP_tools import CopyFieldFromFeature, joinFields_fromFeature
+
+
+def make_tables(backend, source_rows, target_rows):
+    # source rows are (HANSEN_ID, PIPESIZE, MATERIAL), target rows (ID, Pipe_Dia)
+    backend.create_table("lines", [("HANSEN_ID", "TEXT", 10), ("PIPESIZE", "DOUBLE"), ("MATERIAL", "TEXT", 8)],
+                         {"HANSEN_ID": object_array([r[0] for r in source_rows]),
+                          "PIPESIZE": object_array([r[1] for r in source_rows]),
+                          "MATERIAL": object_array([r[2] for r in source_rows])})
+    backend.create_table("points", [("ID", "TEXT", 10), ("Pipe_Dia", "DOUBLE")],
+                         {"ID": object_array([r[0] for r in target_rows]),
+                          "Pipe_Dia": object_array([r[1] for r in target_rows])})
+
+
+def column(backend, field, table="points"):
+    return backend.read_columns(table, [field])[field].tolist()
+
+
+source = [("A", 12.0, "PVC"), ("B", 8.0, "RCP"), ("B", 10.0, None), ("C", None, "CMP"), (None, 99.0, "X")]
+target = [("A", None), ("B", 1.0), ("C", 5.0), ("D", 7.0), (None, 3.0)]
+
+
+@pytest.mark.parametrize("pushdown", [True, False])
+@pytest.mark.parametrize("duplicates, b_value", [("first", 8.0), ("last", 10.0), ("aggregate", 18.0)])
+def test_duplicate_policies(duplicates, b_value, pushdown):
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    counts = joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"],
+                                    duplicates=duplicates, pushdown=pushdown, backend=b)
+    # C's source value is null and skipped, D and the null ID have no match
+    assert column(b, "Pipe_Dia") == [12.0, b_value, 5.0, 7.0, 3.0]
+    assert counts == {"matched": 3, "unmatched": 2, "unchanged": 1, "written": 2}
+
+
+def test_aggregate_function():
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"],
+                           duplicates="aggregate", aggregate=max, backend=b)
+    assert column(b, "Pipe_Dia")[1] == 10.0
+
+
+def test_duplicate_error():
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    with pytest.raises(ValueError):
+        joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"],
+                               duplicates="error", backend=b)
+    # with pushdown only IDs in the target are checked (source padded so it is not read in full)
+    make_tables(b, source + [("P{0}".format(i), 1.0, None) for i in range(20)], [("A", None), ("C", 5.0)])
+    joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"],
+                           duplicates="error", backend=b)
+    assert column(b, "Pipe_Dia") == [12.0, 5.0]
+
+
+@pytest.mark.parametrize("nulls, fill_value, c_value", [("skip", None, 5.0), ("write", None, None), ("fill", -1.0, -1.0)])
+def test_null_policies(nulls, fill_value, c_value):
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"],
+                           nulls=nulls, fill_value=fill_value, backend=b)
+    assert column(b, "Pipe_Dia") == [12.0, 10.0, c_value, 7.0, 3.0]
+
+
+def test_creates_missing_target_fields():
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE", "MATERIAL"], "points", "ID", duplicates="first",
+                           backend=b)
+    fields = dict((f.name, f) for f in b.list_fields("points"))
+    assert (fields["PIPESIZE"].type, fields["MATERIAL"].type, fields["MATERIAL"].length) == ("DOUBLE", "TEXT", 8)
+    assert column(b, "PIPESIZE") == [12.0, 8.0, None, None, None]
+    assert column(b, "MATERIAL") == ["PVC", "RCP", "CMP", None, None]
+
+
+def test_bad_arguments():
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    with pytest.raises(ValueError):
+        joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"], nulls="drop", backend=b)
+    with pytest.raises(ValueError):
+        joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE"], "points", "ID", ["Pipe_Dia"], duplicates="any",
+                               backend=b)
+    with pytest.raises(ValueError):
+        joinFields_fromFeature("lines", "HANSEN_ID", ["PIPESIZE", "MATERIAL"], "points", "ID", ["Pipe_Dia"], backend=b)
+    with pytest.raises(ValueError):
+        joinFields_fromFeature("lines", "HANSEN_ID", ["NOPE"], "points", "ID", backend=b)
+
+
+def test_CopyFieldFromFeature():
+    b = ColumnarBackend()
+    make_tables(b, source, target)
+    CopyFieldFromFeature("lines", "HANSEN_ID", "PIPESIZE", "points", "ID", "Pipe_Dia", backend=b)
+    assert column(b, "Pipe_Dia") == [12.0, 10.0, 5.0, 7.0, 3.0]
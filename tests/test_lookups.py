@@ -0,0 +1,69 @@
+import pytest
+from backends import ColumnarBackend, object_array
+from BMP_tools import fillField_fromDict, fillField_fromLookup
+
+
+def make_table(backend, types, targets, type_field=("Type", "TEXT", 10)):
+    columns = {type_field[0]: object_array(types), "Gen_Type": object_array(targets)}
+    return backend.create_table("t", [type_field, ("Gen_Type", "TEXT", 20)], columns)
+
+
+def gen_types(backend):
+    return backend.read_columns("t", ["Gen_Type"])["Gen_Type"].tolist()
+
+
+lookup = {"BIO": "Bioretention", "POND": "Pond", "SWALE": "Swale"}
+
+
+def test_keep_leaves_unmatched_and_counts():
+    b = ColumnarBackend()
+    make_table(b, ["BIO", "POND", "OTHER", None, "SWALE"], [None, "Pond", "old", "old", "wrong"])
+    counts = fillField_fromLookup("t", lookup, "Type", "Gen_Type", backend=b)
+    assert gen_types(b) == ["Bioretention", "Pond", "old", "old", "Swale"]
+    # the null key is unmatched, POND already holds its value
+    assert counts == {"matched": 3, "unmatched": 2, "unchanged": 1, "written": 2}
+
+
+@pytest.mark.parametrize("unmatched, default, expected, written", [
+    ("default", "Unknown", ["Bioretention", "Pond", "Unknown", "Unknown", "Swale"], 4),
+    ("null", None, ["Bioretention", "Pond", None, None, "Swale"], 4),
+])
+def test_unmatched_policies(unmatched, default, expected, written):
+    b = ColumnarBackend()
+    make_table(b, ["BIO", "POND", "OTHER", None, "SWALE"], [None, "Pond", "old", "old", "wrong"])
+    counts = fillField_fromLookup("t", lookup, "Type", "Gen_Type", unmatched=unmatched, default=default, backend=b)
+    assert gen_types(b) == expected
+    assert counts["matched"] == 3 and counts["unmatched"] == 2
+    assert counts["written"] == written
+    assert counts["unchanged"] == 5 - written
+
+
+def test_unmatched_already_at_policy_value_is_not_written():
+    b = ColumnarBackend()
+    make_table(b, ["OTHER", None], [None, "old"])
+    counts = fillField_fromLookup("t", lookup, "Type", "Gen_Type", unmatched="null", backend=b)
+    assert gen_types(b) == [None, None]
+    assert counts == {"matched": 0, "unmatched": 2, "unchanged": 1, "written": 1}
+
+
+def test_bad_policy():
+    b = ColumnarBackend()
+    make_table(b, ["BIO"], [None])
+    with pytest.raises(ValueError):
+        fillField_fromLookup("t", lookup, "Type", "Gen_Type", unmatched="drop", backend=b)
+
+
+def test_numeric_keys_with_nulls():
+    b = ColumnarBackend()
+    make_table(b, [1, 2, None, 3, 1], [None] * 5, type_field=("Code", "LONG"))
+    counts = fillField_fromLookup("t", {1: "one", 3: "three"}, "Code", "Gen_Type", unmatched="default",
+                                  default="other", backend=b)
+    assert gen_types(b) == ["one", "other", "other", "three", "one"]
+    assert counts == {"matched": 3, "unmatched": 2, "unchanged": 0, "written": 5}
+
+
+def test_fromDict_keeps_unmatched():
+    b = ColumnarBackend()
+    make_table(b, ["BIO", "OTHER"], ["old", "old"])
+    fillField_fromDict("t", lookup, "Type", "Gen_Type", backend=b)
+    assert gen_types(b) == ["Bioretention", "old"]
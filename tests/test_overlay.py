@@ -0,0 +1,68 @@
+import math
+import pytest
+from backends import ColumnarBackend, object_array
+from overlay import Layer, intersection_area, overlap_areas, overlapping
+from BMP_tools import calcField_overlapArea
+
+
+def square(x0, y0, x1, y1):
+    # clockwise, as ESRI stores outer rings
+    return [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]
+
+
+def circle(cx, cy, r, n):
+    points = [(cx + r * math.cos(-2 * math.pi * i / n), cy + r * math.sin(-2 * math.pi * i / n)) for i in range(n)]
+    return points + points[:1]
+
+
+def polygons(backend, name, shapes, zones=None):
+    # shapes are outer rings - one single ring polygon each
+    columns = {"ZONE": object_array(zones or ["A"] * len(shapes)), "Acres": object_array([None] * len(shapes)),
+               "Shape": object_array([[ring] for ring in shapes])}
+    return backend.create_table(name, [("ZONE", "TEXT", 10), ("Acres", "DOUBLE"), ("Shape", "GEOMETRY")], columns,
+                                geometry_type="POLYGON")
+
+
+@pytest.mark.parametrize("a, b, area", [
+    ([square(0, 0, 10, 10)], [square(5, 5, 15, 15)], 25.0),
+    ([square(0, 0, 10, 10)], [square(0, 0, 10, 10)], 100.0),
+    ([square(0, 0, 10, 10)], [square(10, 0, 20, 10)], 0.0),                          # shared edge only
+    ([square(0, 0, 10, 10)], [square(20, 20, 30, 30)], 0.0),
+    ([square(0, 0, 10, 10), square(2, 2, 8, 8)[::-1]], [square(0, 0, 10, 10)], 64.0),  # hole
+    ([square(0, 0, 10, 10), square(2, 2, 8, 8)[::-1]], [square(3, 3, 7, 7)], 0.0),     # inside the hole
+    ([[(0, 0), (0, 6), (3, 6), (3, 3), (6, 3), (6, 0), (0, 0)]], [square(0, 0, 6, 6)], 27.0),  # L shape
+    ([[(0, 0), (0, 6), (3, 6), (3, 3), (6, 3), (6, 0), (0, 0)]], [square(2, 2, 5, 5)], 5.0),
+    ([square(0, 0, 4, 4), square(6, 0, 10, 4)], [square(2, 1, 8, 3)], 8.0),            # two parts
+])
+def test_intersection_area(a, b, area):
+    assert intersection_area(a, b) == pytest.approx(area)
+    assert intersection_area(b, a) == pytest.approx(area)
+
+
+def test_intersection_area_of_curved_polygons():
+    # two overlapping circles against the lens area of the polygons (their chords, not the arcs)
+    a, b = [circle(0, 0, 10, 360)], [circle(5, 0, 10, 360)]
+    r, d = 10.0, 5.0
+    lens = 2 * r * r * math.acos(d / (2 * r)) - d / 2 * math.sqrt(4 * r * r - d * d)
+    assert intersection_area(a, b) == pytest.approx(lens, rel=1e-3)
+
+
+def test_overlap_areas_and_overlapping():
+    b = ColumnarBackend()
+    polygons(b, "bounds", [square(0, 0, 10, 10), square(20, 0, 30, 10), square(50, 50, 60, 60)])
+    polygons(b, "zoning", [square(5, 0, 25, 10), square(0, 5, 10, 20), square(40, 40, 45, 45)])
+    targets, overlaps = Layer("bounds", backend=b), Layer("zoning", backend=b)
+    areas = overlap_areas(targets, overlaps)
+    assert [sorted(a) for a in areas] == [[0, 1], [0], []]
+    assert areas[0][0] == pytest.approx(50.0)
+    assert areas[0][1] == pytest.approx(50.0)
+    assert areas[1][0] == pytest.approx(50.0)
+    assert overlapping(targets, overlaps) == [[0, 1], [0], []]
+
+
+def test_calcField_overlapArea():
+    b = ColumnarBackend()
+    polygons(b, "bounds", [square(0, 0, 10, 10), square(20, 0, 30, 10)])
+    polygons(b, "zoning", [square(5, 0, 25, 10), square(0, 5, 10, 20)], ["IND", "RES"])
+    calcField_overlapArea("bounds", "Acres", "zoning", where="ZONE = 'IND'", factor=0.5, digits=1, backend=b)
+    assert b.read_columns("bounds", ["Acres"])["Acres"].tolist() == [25.0, 25.0]
@@ -0,0 +1,73 @@
+import math
+import numpy
+import pytest
+from backends import ColumnarBackend, object_array
+from overlay import Layer
+from proximity import GridIndex
+
+
+def segment_distance(point, a, b):
+    (px, py), (ax, ay), (bx, by) = point, a, b
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else min(max(((px - ax) * dx + (py - ay) * dy) / length, 0.0), 1.0)
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def brute_distances(point, lines):
+    # distance from point to each line, segment by segment
+    return [min(segment_distance(point, p, q) for part in line for p, q in zip(part[:-1], part[1:])) for line in lines]
+
+
+@pytest.fixture
+def layers():
+    # random points and short random walk polylines over the same 1000 x 1000 area
+    random = numpy.random.RandomState(7)
+    points = list(zip(random.uniform(0, 1000, 400).tolist(), random.uniform(0, 1000, 400).tolist()))
+    starts = random.uniform(0, 1000, (60, 2))
+    walks = random.uniform(-40, 40, (60, 5, 2)).cumsum(axis=1)
+    lines = [[[tuple(start)] + [tuple(p) for p in (start + walk).tolist()]] for start, walk in zip(starts.tolist(), walks)]
+    b = ColumnarBackend()
+    b.create_table("points", [("Shape", "GEOMETRY")], {"Shape": object_array(points)}, geometry_type="POINT")
+    b.create_table("pipes", [("Shape", "GEOMETRY")], {"Shape": object_array(lines)}, geometry_type="POLYLINE")
+    return points, lines, Layer("points", backend=b), Layer("pipes", backend=b)
+
+
+@pytest.mark.parametrize("distance", [0.0, 15.0, 60.0])
+def test_within_matches_brute_force(layers, distance):
+    points, lines, point_layer, line_layer = layers
+    hits = GridIndex(line_layer).within(point_layer, distance)
+    for point, found in zip(points, hits):
+        expected = [j for j, d in enumerate(brute_distances(point, lines)) if d <= distance]
+        assert list(found) == expected
+
+
+@pytest.mark.parametrize("cell_size", [None, 5.0, 500.0])
+def test_nearest_matches_brute_force(layers, cell_size):
+    points, lines, point_layer, line_layer = layers
+    positions, distances = GridIndex(line_layer, cell_size).nearest(point_layer, k=3)
+    for i, point in enumerate(points):
+        expected = sorted(brute_distances(point, lines))[:3]
+        assert distances[i].tolist() == pytest.approx(expected)
+        assert [brute_distances(point, [lines[j]])[0] for j in positions[i]] == pytest.approx(expected)
+
+
+def test_nearest_max_distance(layers):
+    points, lines, point_layer, line_layer = layers
+    positions, distances = GridIndex(line_layer).nearest(point_layer, k=1, max_distance=20.0)
+    for i, point in enumerate(points):
+        best = min(brute_distances(point, lines))
+        if best <= 20.0:
+            assert distances[i, 0] == pytest.approx(best)
+        else:
+            assert positions[i, 0] == -1 and numpy.isinf(distances[i, 0])
+
+
+def test_points_inside_polygons_are_within_zero():
+    b = ColumnarBackend()
+    ring = [(0.0, 0.0), (0.0, 100.0), (100.0, 100.0), (100.0, 0.0), (0.0, 0.0)]
+    b.create_table("zones", [("Shape", "GEOMETRY")], {"Shape": object_array([[ring]])}, geometry_type="POLYGON")
+    b.create_table("points", [("Shape", "GEOMETRY")], {"Shape": object_array([(50.0, 50.0), (105.0, 50.0), (150.0, 50.0)])},
+                   geometry_type="POINT")
+    hits = GridIndex(Layer("zones", backend=b)).within(Layer("points", backend=b), 10.0)
+    assert [list(h) for h in hits] == [[0], [0], []]
@@ -0,0 +1,149 @@
+import datetime, os
+from backends import ColumnarBackend, object_array
+from refcache import CachedBackend, ReferenceCache, main
+
+
+class SourceBackend(ColumnarBackend):
+    # the "network" backend - counts the reads that reach it
+
+    def __init__(self):
+        ColumnarBackend.__init__(self)
+        self.reads = []
+
+    def read_columns(self, table, fields, where=None):
+        self.reads.append(table)
+        return ColumnarBackend.read_columns(self, table, fields, where)
+
+    def max_value(self, table, field):
+        # a version probe, not a read of the layer
+        values = [v for v in ColumnarBackend.read_columns(self, table, [field])[field] if v is not None]
+        return max(values) if values else None
+
+
+def make_layer(backend, name, values, edited=datetime.datetime(2020, 1, 1)):
+    backend.create_table(name, [("ZONE", "TEXT", 10), ("Size", "LONG"), ("last_edited_date", "DATE")],
+                         {"ZONE": object_array(values), "Size": object_array(list(range(len(values)))),
+                          "last_edited_date": object_array([edited] * len(values))})
+
+
+def zones(cache, name="zoning", fields=("ZONE",), where=None):
+    return cache.read_columns(name, list(fields), where)["ZONE"].tolist()
+
+
+def test_reads_are_served_from_the_cache(tmp_path):
+    source = SourceBackend()
+    make_layer(source, "zoning", ["IG1", "R5", "IH"])
+    directory = str(tmp_path / "cache")
+    assert zones(ReferenceCache(directory, backend=source)) == ["IG1", "R5", "IH"]
+    assert source.reads == ["zoning"]
+
+    # a new cache object (next run) probes the version once and reuses the local copy
+    cache = ReferenceCache(directory, backend=source)
+    assert zones(cache) == ["IG1", "R5", "IH"]
+    assert zones(cache, where="ZONE IN ('IG1', 'IH')") == ["IG1", "IH"]
+    assert source.reads == ["zoning"]
+    # asking for a field not cached fetches again, keeping the fields already cached
+    assert cache.read_columns("zoning", ["Size"])["Size"].tolist() == [0, 1, 2]
+    assert source.reads == ["zoning", "zoning"]
+    assert sorted(cache.entry("zoning")["fields"]) == ["Size", "ZONE"]
+
+
+def test_changed_version_invalidates(tmp_path):
+    source = SourceBackend()
+    make_layer(source, "zoning", ["IG1", "R5"])
+    directory = str(tmp_path / "cache")
+    zones(ReferenceCache(directory, backend=source))
+
+    make_layer(source, "zoning", ["IG1", "R5"], edited=datetime.datetime(2021, 1, 1))
+    cache = ReferenceCache(directory, backend=source)
+    assert zones(cache) == ["IG1", "R5"]
+    assert source.reads == ["zoning", "zoning"]
+    assert cache.entry("zoning")["version"]["edited"].startswith("2021")
+
+    # the version is only probed once per cache object - later edits are seen by the next one
+    make_layer(source, "zoning", ["IH"], edited=datetime.datetime(2022, 1, 1))
+    assert zones(cache) == ["IG1", "R5"]
+    assert zones(ReferenceCache(directory, backend=source)) == ["IH"]
+
+
+def test_unversioned_layers_expire(tmp_path):
+    source = SourceBackend()
+    source.create_table("lines", [("ZONE", "TEXT", 10)], {"ZONE": object_array(["a"])})
+    directory = str(tmp_path / "cache")
+    zones(ReferenceCache(directory, backend=source), "lines")
+    zones(ReferenceCache(directory, backend=source), "lines")
+    assert source.reads == ["lines"]
+    zones(ReferenceCache(directory, max_age_hours=0, backend=source), "lines")
+    assert source.reads == ["lines", "lines"]
+
+
+def test_cache_hits_do_not_rewrite_the_entry(tmp_path):
+    source = SourceBackend()
+    make_layer(source, "zoning", ["IG1"])
+    cache = ReferenceCache(str(tmp_path / "cache"), backend=source)
+    zones(cache)
+    path = cache._path("zoning", ".json")
+    with open(path) as f:
+        text = f.read()
+    os.utime(path, (0, 0))
+    cache = ReferenceCache(cache.directory, backend=source)
+    zones(cache)
+    touched = os.path.getmtime(path)
+    assert touched > 0
+    os.utime(path, (0, 0))
+    zones(cache)
+    assert os.path.getmtime(path) == 0
+    with open(path) as f:
+        assert f.read() == text
+    assert cache.entries()[0]["last_used"] >= cache.entry("zoning")["last_used"]
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    source = SourceBackend()
+    for name in ("a", "b", "c"):
+        make_layer(source, name, ["x" * 50] * 200)
+    directory = str(tmp_path / "cache")
+    cache = ReferenceCache(directory, backend=source)
+    zones(cache, "a")
+    size = cache.entry("a")["bytes"]
+    cache.max_bytes = int(size * 2.5)
+    zones(cache, "b")
+    os.utime(cache._path("a", ".json"), (0, 0))
+    os.utime(cache._path("b", ".json"), None)
+    zones(cache, "c")
+    # a is the least recently used, so it goes to make room for c
+    assert sorted(e["source"] for e in cache.entries()) == ["b", "c"]
+    assert not os.path.exists(cache._path("a", ".sqlite"))
+
+
+def test_cached_backend_routes_sources(tmp_path):
+    source = SourceBackend()
+    make_layer(source, "zoning", ["IG1", "R5"])
+    make_layer(source, "bmps", ["B"])
+    b = CachedBackend(source, ReferenceCache(str(tmp_path / "cache")), ["zoning"])
+    assert b.count("zoning") == 2
+    assert b.select("zoning", "ZONE = 'R5'").tolist() == [2]
+    b.read_columns("bmps", ["ZONE"])
+    b.read_columns("bmps", ["ZONE"])
+    assert source.reads == ["zoning", "bmps", "bmps"]
+
+
+def test_list_and_clear(tmp_path, capsys):
+    source = SourceBackend()
+    make_layer(source, "zoning", ["IG1"])
+    make_layer(source, "lines", ["L"])
+    directory = str(tmp_path / "cache")
+    cache = ReferenceCache(directory, backend=source)
+    zones(cache, "zoning")
+    zones(cache, "lines")
+
+    assert main([directory, "list"]) == 0
+    out = capsys.readouterr().out
+    assert "zoning\n    fields: ZONE" in out and "2 layers" in out
+
+    main([directory, "clear", "zoning"])
+    assert [e["source"] for e in cache.entries()] == ["lines"]
+    main([directory, "clear"])
+    assert cache.entries() == []
+    main([directory, "list"])
+    assert "0 layers" in capsys.readouterr().out
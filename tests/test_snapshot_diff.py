@@ -0,0 +1,49 @@
+import numpy
+from backends import ColumnarBackend, object_array
+from archive import ArchiveStore
+from test_archive import archive_all, keyed_order, make_table, versions
+from snapshot_diff import diff_report, table_rows
+
+
+def test_rows_stream_in_small_chunks(tmp_path, versions):
+    b, store = archive_all(tmp_path, versions, max_delta_fraction=1.0)
+    names, rows = store.rows("DS", "s4", chunk_size=3)
+    assert names == ["Index_ID", "Name", "Shape"]
+    assert [(r[0], r[1], r[2][0]) for r in rows] == keyed_order(versions[3][1])
+    names, rows = store.rows("DS", "s4", chunk_size=3, unkeyed=False)
+    assert [r[0] for r in rows] == sorted(k for k, n, x in versions[3][1] if k not in (None, 50))
+
+
+def test_diff_report_against_archive(tmp_path, versions):
+    b, store = archive_all(tmp_path, versions)
+    new = [(k, "renamed" if k == 5 else n, x) for k, n, x in versions[-1][1] if k != 6] + [(99, "new", 99), (None, "x", 0)]
+    make_table(b, new, "new")
+    summary = diff_report("new", store, "DS", backend=b, chunk_size=4, csv_path=str(tmp_path / "diff.csv"))
+    assert (summary["added"], summary["removed"], summary["changed"]) == (1, 1, 1)
+    assert summary["unkeyed"] == 4
+    assert summary["field_changes"] == {"Name": 1}
+
+
+def test_rows_does_not_load_version_tables(tmp_path, versions, monkeypatch):
+    b, store = archive_all(tmp_path, versions, max_delta_fraction=1.0)
+    loaded = []
+    original = ColumnarBackend._load
+    monkeypatch.setattr(ColumnarBackend, "_load", lambda self, name: loaded.append(name) or original(self, name))
+    names, rows = store.rows("DS", "s5", chunk_size=4)
+    assert len(list(rows)) == len(versions[-1][1])
+    assert [name for name in loaded if name.startswith("v")] == []
+
+
+def test_text_keys_chunked_in_key_order(tmp_path):
+    # mixed case text keys across several chunks - each row once, in the same order as the archive
+    b = ColumnarBackend()
+    keys = ["b", "B", "a", "A", "aa", "Z", "z", "m", "M", "_"]
+    b.create_table("t", [("Code", "TEXT", 5), ("Value", "LONG")],
+                   {"Code": object_array(keys), "Value": object_array(list(range(len(keys))))})
+    rows = list(table_rows("t", "Code", ["Code", "Value"], b, chunk_size=3))
+    assert [k for k, values in rows] == sorted(keys)
+    store = ArchiveStore(str(tmp_path / "store"), key="Code")
+    store.archive("t", "codes", "s1", backend=b)
+    b.write_columns("t", numpy.array([1]), {"Value": 99})
+    summary = diff_report("t", store, "codes", key="Code", backend=b, chunk_size=3)
+    assert (summary["added"], summary["removed"], summary["changed"], summary["unchanged"]) == (0, 0, 1, 9)
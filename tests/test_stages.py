@@ -0,0 +1,122 @@
+import datetime
+import pytest
+from backends import ColumnarBackend, object_array
+from stages import Pipeline, dataset_fingerprint
+
+
+def make_source(backend, name="src", edited=datetime.datetime(2020, 1, 1), values=(1, 2, 3)):
+    fields = [("Value", "LONG")]
+    columns = {"Value": object_array(list(values))}
+    if edited is not None:
+        fields.append(("last_edited_date", "DATE"))
+        columns["last_edited_date"] = object_array([edited] * len(values))
+    return backend.create_table(name, fields, columns)
+
+
+def copy_stage(backend, calls):
+    # stage func copying a table (and counting its calls by output name)
+    def copy(source, out, note=None):
+        calls.append(out)
+        data = backend.read_columns(source, ["Value"])
+        backend.create_table(out, [("Value", "LONG")], {"Value": data["Value"]})
+    return copy
+
+
+def two_stages(backend, calls, cache, note="a", edited=datetime.datetime(2020, 1, 1)):
+    # src -> first -> second
+    pipeline = Pipeline(cache, backend)
+    copy = copy_stage(backend, calls)
+    pipeline.stage("first", copy, {"source": "src", "out": "first", "note": note}, sources=["src"], outputs=["first"])
+    pipeline.stage("second", copy, {"source": "first", "out": "second"}, depends=["first"], outputs=["second"])
+    return pipeline
+
+
+@pytest.fixture
+def setup(tmp_path):
+    b = ColumnarBackend()
+    make_source(b)
+    return b, str(tmp_path / "stages.json"), []
+
+
+def test_unchanged_stages_are_skipped(setup):
+    b, cache, calls = setup
+    assert two_stages(b, calls, cache).run() == {"first": "ran", "second": "ran"}
+    # a new Pipeline reads the fingerprints back from the cache file
+    assert two_stages(b, calls, cache).run() == {"first": "cached", "second": "cached"}
+    assert calls == ["first", "second"]
+
+
+def test_changed_params_and_sources_rerun_downstream(setup):
+    b, cache, calls = setup
+    two_stages(b, calls, cache).run()
+    assert two_stages(b, calls, cache, note="b").run() == {"first": "ran", "second": "ran"}
+    make_source(b, edited=datetime.datetime(2021, 1, 1))
+    assert two_stages(b, calls, cache, note="b").run() == {"first": "ran", "second": "ran"}
+    assert two_stages(b, calls, cache, note="b").run() == {"first": "cached", "second": "cached"}
+
+
+def test_missing_output_reruns_stage(setup):
+    b, cache, calls = setup
+    two_stages(b, calls, cache).run()
+    b.delete("second")
+    assert two_stages(b, calls, cache).run() == {"first": "cached", "second": "ran"}
+
+
+def test_unversioned_source_always_runs(tmp_path):
+    b = ColumnarBackend()
+    make_source(b, edited=None)
+    calls = []
+    cache = str(tmp_path / "stages.json")
+    two_stages(b, calls, cache).run()
+    assert two_stages(b, calls, cache).run() == {"first": "ran", "second": "ran"}
+
+
+def test_force(setup):
+    b, cache, calls = setup
+    two_stages(b, calls, cache).run()
+    assert two_stages(b, calls, cache).run(force=["second"]) == {"first": "cached", "second": "ran"}
+    assert two_stages(b, calls, cache).run(force=True) == {"first": "ran", "second": "ran"}
+
+
+def test_done_stages_are_not_checked_or_run(setup):
+    b, cache, calls = setup
+    first = two_stages(b, calls, cache)
+    first.run(["first"])
+    done = {"first": first.fingerprints["first"]}
+    del calls[:]
+    pipeline = two_stages(b, calls, cache)
+    assert pipeline.run(done=done) == {"second": "ran"}
+    assert calls == ["second"]
+    assert pipeline.fingerprints["first"] == done["first"]
+
+
+def test_required_order_and_targets(tmp_path):
+    pipeline = Pipeline(str(tmp_path / "stages.json"), ColumnarBackend())
+    noop = lambda: None
+    pipeline.stage("a", noop)
+    pipeline.stage("b", noop, depends=["a"])
+    pipeline.stage("c", noop)
+    pipeline.stage("d", noop, depends=["c", "b"])
+    assert pipeline.required() == ["a", "b", "c", "d"]
+    assert pipeline.required(["d"]) == ["c", "a", "b", "d"]
+    assert pipeline.required(["b"]) == ["a", "b"]
+    with pytest.raises(ValueError):
+        pipeline.required(["e"])
+    with pytest.raises(ValueError):
+        pipeline.stage("e", noop, depends=["missing"])
+    with pytest.raises(ValueError):
+        pipeline.stage("a", noop)
+
+
+def test_dataset_fingerprint_ignores_row_order_and_oids():
+    b = ColumnarBackend()
+    make_source(b, "one", values=(1, 2, 3))
+    b.create_table("two", [("Value", "LONG"), ("last_edited_date", "DATE")],
+                   {"Value": object_array([3, 1, 2]), "last_edited_date": object_array([datetime.datetime(2020, 1, 1)] * 3)},
+                   oids=[10, 20, 30])
+    make_source(b, "three", values=(1, 2, 4))
+    one, two, three = [dataset_fingerprint(name, b) for name in ("one", "two", "three")]
+    assert one == two
+    assert one["rows"] == 3
+    assert three["content"] != one["content"]
+    assert three["schema"] == one["schema"]
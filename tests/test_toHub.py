@@ -0,0 +1,159 @@
+import os
+import pytest
+from backends import ColumnarBackend, object_array
+import MS4_toHub
+from MS4_toHub import plan_publish, load_manifest, publish, swap_layers, transfer
+
+
+class FlakyBackend(ColumnarBackend):
+    # copies to the listed outputs fail copy_failures times, the listed (table, new name) renames always fail
+
+    def __init__(self, copy_failures=0, failing_copies=(), failing_renames=()):
+        ColumnarBackend.__init__(self)
+        self.copy_failures = copy_failures
+        self.failing_copies = set(failing_copies)
+        self.failing_renames = set(failing_renames)
+        self.copies = []
+
+    def copy(self, table, out_table):
+        self.copies.append(out_table)
+        if out_table in self.failing_copies and self.copy_failures:
+            self.copy_failures -= 1
+            raise IOError("lost connection")
+        return ColumnarBackend.copy(self, table, out_table)
+
+    def rename(self, table, new_name):
+        if (table, new_name) in self.failing_renames:
+            raise IOError("layer locked")
+        ColumnarBackend.rename(self, table, new_name)
+
+
+@pytest.fixture(autouse=True)
+def locations(monkeypatch):
+    monkeypatch.setattr(MS4_toHub, "input", "current")
+    monkeypatch.setattr(MS4_toHub, "output", "dock")
+
+
+def src(fc):
+    return os.path.join("current", fc)
+
+
+def dock(fc):
+    return os.path.join("dock", fc)
+
+
+def make_fc(backend, path, values, extra=False, xs=None):
+    fields = [("Name", "TEXT", 10)] + ([("Extra", "LONG")] if extra else []) + [("Shape", "GEOMETRY")]
+    xs = range(len(values)) if xs is None else xs
+    columns = {"Name": object_array(values), "Extra": object_array([1] * len(values)),
+               "Shape": object_array([(float(x), 1.0) for x in xs])}
+    backend.create_table(path, fields, columns, geometry_type="POINT")
+
+
+def names(backend, path):
+    return backend.read_columns(path, ["Name"])["Name"].tolist()
+
+
+def current(backend, fcs=("points", "bounds")):
+    for fc in fcs:
+        make_fc(backend, src(fc), [fc + "1", fc + "2"])
+    return list(fcs)
+
+
+def test_plan_detects_changes(tmp_path):
+    b = ColumnarBackend()
+    fcs = current(b)
+    fingerprints, to_copy, reasons = plan_publish(fcs, {"feature_classes": {}}, backend=b)
+    assert to_copy == fcs and set(reasons.values()) == {"not published before"}
+
+    manifest = {"feature_classes": fingerprints}
+    for fc in fcs:
+        b.copy(src(fc), dock(fc))
+    assert plan_publish(fcs, manifest, backend=b)[1] == []
+    assert plan_publish(fcs, manifest, copy_all=True, backend=b)[2] == dict((fc, "copy all requested") for fc in fcs)
+
+    make_fc(b, src("points"), ["points2", "points1"], xs=[1, 0])  # same rows in another order
+    assert plan_publish(fcs, manifest, backend=b)[1] == []
+    make_fc(b, src("points"), ["points1", "points2", "points3"])
+    assert plan_publish(fcs, manifest, backend=b)[2] == {"points": "rows changed (2 -> 3 rows)"}
+    make_fc(b, src("points"), ["points1", "points2"], extra=True)
+    assert plan_publish(fcs, manifest, backend=b)[2] == {"points": "schema changed"}
+    make_fc(b, src("points"), ["points1", "points2"])
+    b.delete(dock("bounds"))
+    assert plan_publish(fcs, manifest, backend=b)[2] == {"bounds": "missing from GIS_TRANSFER10"}
+
+
+def test_dry_run_estimates_without_copying(tmp_path, capsys):
+    b = ColumnarBackend()
+    fcs = current(b)
+    manifest_file = str(tmp_path / "manifest.json")
+    assert publish(fcs, manifest_file, dry_run=True, backend=b) == fcs
+    out = capsys.readouterr().out
+    fingerprints = plan_publish(fcs, {"feature_classes": {}}, backend=b)[0]
+    total = sum(f["bytes"] for f in fingerprints.values())
+    assert "2 of 2 feature classes to copy, about {0:,} bytes of row data".format(total) in out
+    assert "...points : not published before, about {0:,} bytes".format(fingerprints["points"]["bytes"]) in out
+    assert not os.path.exists(manifest_file)
+    assert not any(b.exists(dock(fc)) for fc in fcs)
+
+
+def test_publish_copies_changes_only(tmp_path):
+    b = FlakyBackend()
+    fcs = current(b)
+    manifest_file = str(tmp_path / "manifest.json")
+    assert publish(fcs, manifest_file, workers=1, backend=b) == fcs
+    assert sorted(load_manifest(manifest_file)["feature_classes"]) == ["bounds", "points"]
+    assert names(b, dock("points")) == ["points1", "points2"]
+
+    make_fc(b, src("bounds"), ["new"])
+    del b.copies[:]
+    assert publish(fcs, manifest_file, workers=1, backend=b) == ["bounds"]
+    assert b.copies == [dock("bounds_staging")]
+    assert names(b, dock("bounds")) == ["new"]
+    assert publish(fcs, manifest_file, workers=1, backend=b) == []
+    assert sorted(b.list_tables()) == sorted([src(fc) for fc in fcs] + [dock(fc) for fc in fcs])
+
+
+def test_copy_is_retried():
+    b = FlakyBackend(copy_failures=2, failing_copies=[dock("points_staging")])
+    fcs = current(b)
+    result = transfer(fcs, workers=1, retries=3, delay=0, backend=b)
+    assert result["points"][0] == 3 and result["bounds"][0] == 1
+    assert names(b, dock("points")) == ["points1", "points2"]
+
+
+def test_failed_copy_changes_nothing(tmp_path):
+    b = FlakyBackend(copy_failures=5, failing_copies=[dock("points_staging")])
+    fcs = current(b)
+    make_fc(b, dock("bounds"), ["published"])
+    manifest_file = str(tmp_path / "manifest.json")
+    with pytest.raises(RuntimeError):
+        publish(fcs, manifest_file, workers=1, retries=2, delay=0, backend=b)
+    assert b.copies.count(dock("points_staging")) == 2
+    assert names(b, dock("bounds")) == ["published"]
+    assert not b.exists(dock("bounds_staging")) and not b.exists(dock("points"))
+    assert not os.path.exists(manifest_file)
+
+
+def test_failed_swap_rolls_back():
+    b = FlakyBackend(failing_renames=[(dock("points_staging"), dock("points"))])
+    fcs = current(b, ("bounds", "points"))
+    for fc in fcs:
+        make_fc(b, dock(fc), ["published " + fc])
+    with pytest.raises(IOError):
+        transfer(fcs, workers=1, delay=0, backend=b)
+    # bounds had already been swapped in - it is put back along with points
+    assert names(b, dock("bounds")) == ["published bounds"]
+    assert names(b, dock("points")) == ["published points"]
+    assert sorted(b.list_tables()) == sorted([src(fc) for fc in fcs] + [dock(fc) for fc in fcs])
+
+
+def test_swap_replaces_and_drops_old():
+    b = ColumnarBackend()
+    make_fc(b, dock("points"), ["old"])
+    make_fc(b, dock("points_staging"), ["new"])
+    make_fc(b, dock("bounds_staging"), ["first"])
+    make_fc(b, dock("points_old"), ["stale"])
+    swap_layers(["points", "bounds"], b)
+    assert names(b, dock("points")) == ["new"] and names(b, dock("bounds")) == ["first"]
+    assert sorted(b.list_tables()) == [dock("bounds"), dock("points")]
@@ -0,0 +1,60 @@
+import datetime
+import pytest
+from backends import ColumnarBackend, object_array
+from utilities import transform_fields
+
+
+@pytest.fixture
+def backend():
+    b = ColumnarBackend()
+    b.create_table("wsheds", [("Watershed_", "SHORT"), ("Basin_", "TEXT", 10), ("Area", "DOUBLE"), ("Junk", "TEXT", 5),
+                              ("Built", "DATE"), ("Shape", "GEOMETRY")],
+                   {"Watershed_": object_array([1, 2, None, 9]), "Basin_": object_array(["a", "b", "c", "d"]),
+                    "Area": object_array([1.5, 2.5, 3.5, 4.5]), "Junk": object_array(["x"] * 4),
+                    "Built": object_array([datetime.datetime(2001, 1, 1)] * 4),
+                    "Shape": object_array([(float(i), 0.0) for i in range(4)])}, geometry_type="POINT")
+    return b
+
+
+def names(b, table):
+    return [(f.name, f.type, f.length) for f in b.list_fields(table) if f.type not in ("OID", "GEOMETRY")]
+
+
+def test_cast_lookup_rename_order(backend):
+    transform_fields("wsheds", "out", drop=["Junk"], rename={"Watershed_": "Watershed", "Basin_": "Basin"},
+                     order=["Basin", "Watershed"], casts={"Watershed_": ("TEXT", 25)},
+                     values={"Watershed_": {1: "Columbia Slough", 2: "Johnson Creek"}}, backend=backend)
+    assert names(backend, "out") == [("Basin", "TEXT", 10), ("Watershed", "TEXT", 25), ("Area", "DOUBLE", None),
+                                     ("Built", "DATE", None)]
+    data = backend.read_columns("out", ["Basin", "Watershed", "Area", "SHAPE@"])
+    # unmatched values (and nulls) become null
+    assert data["Watershed"].tolist() == ["Columbia Slough", "Johnson Creek", None, None]
+    assert data["Basin"].tolist() == ["a", "b", "c", "d"]
+    assert data["SHAPE@"].tolist()[1] == (1.0, 0.0)
+
+
+def test_keep_cast_without_lookup_and_no_extra_fields(backend):
+    transform_fields("wsheds", "out", keep=["Watershed_", "Area"], order=["Area", "Watershed_"],
+                     casts={"Area": "LONG", "Watershed_": ("TEXT", 5)}, backend=backend)
+    assert names(backend, "out") == [("Area", "LONG", None), ("Watershed_", "TEXT", 5)]
+    data = backend.read_columns("out", ["Area", "Watershed_"])
+    assert data["Watershed_"].tolist() == ["1", "2", None, "9"]
+
+    transform_fields("wsheds", "out2", order=["Area"], add_missing=False, backend=backend)
+    assert names(backend, "out2") == [("Area", "DOUBLE", None)]
+
+
+@pytest.mark.parametrize("spec", [
+    {"drop": ["Nope"]},
+    {"keep": ["Area", "Nope"]},
+    {"rename": {"Nope": "X"}},
+    {"casts": {"Nope": "LONG"}},
+    {"values": {"Nope": {}}},
+    {"order": ["Watershed_", "Nope"]},
+    {"drop": ["Basin_"], "order": ["Basin_"]},
+    {"rename": {"Basin_": "Area"}},
+])
+def test_bad_spec_is_refused_before_writing(backend, spec):
+    with pytest.raises(Exception):
+        transform_fields("wsheds", "out", backend=backend, **spec)
+    assert not backend.exists("out")
@@ -0,0 +1,121 @@
+import datetime, json, os
+import numpy
+from backends import ColumnarBackend, object_array
+from uids import UidAllocator, default_state_path, normalize_key
+from BMP_tools import incrementField
+
+
+def make_table(backend, uids, keys, sort=None):
+    fields = [("UID", "LONG"), ("Original_ID", "LONG"), ("InstallYear", "LONG")]
+    columns = {"UID": object_array(uids), "Original_ID": object_array(keys),
+               "InstallYear": object_array(sort if sort is not None else [None] * len(uids))}
+    return backend.create_table("bmps", fields, columns)
+
+
+def uids(backend):
+    return backend.read_columns("bmps", ["UID"])["UID"].tolist()
+
+
+def test_only_null_uids_are_filled_from_the_high_water_mark(tmp_path):
+    b = ColumnarBackend()
+    make_table(b, [7, None, 3, None], [1, 2, 3, 4])
+    result = UidAllocator(str(tmp_path / "uids.json")).allocate("bmps", backend=b)
+    assert uids(b) == [7, 8, 3, 9]
+    assert result == {"new": 2, "reused": 0, "high_water": 9}
+
+
+def test_new_rows_numbered_in_sort_order(tmp_path):
+    b = ColumnarBackend()
+    make_table(b, [None] * 4, [1, 2, 3, 4], [2005, None, 1999, 2005])
+    UidAllocator().allocate("bmps", sort_field="InstallYear", backend=b)
+    assert uids(b) == [2, 4, 1, 3]
+
+
+def test_deleted_uids_are_never_handed_out_again(tmp_path):
+    path = str(tmp_path / "uids.json")
+    b = ColumnarBackend()
+    make_table(b, [None] * 3, [1, 2, 3])
+    UidAllocator(path).allocate("bmps", backend=b)
+    make_table(b, [1, 2, None], [1, 2, 4]) # the row with UID 3 was deleted
+    UidAllocator(path).allocate("bmps", backend=b)
+    assert uids(b) == [1, 2, 4]
+    with open(path) as f:
+        assert json.load(f)["high_water"] == 4
+
+
+def test_reloaded_key_gets_its_uid_back(tmp_path):
+    path = str(tmp_path / "uids.json")
+    b = ColumnarBackend()
+    make_table(b, [None] * 3, [10, 20, 30])
+    UidAllocator(path).allocate("bmps", key_field="Original_ID", backend=b)
+    make_table(b, [None] * 4, [30, 40, 10, 20]) # table rebuilt from its source
+    result = UidAllocator(path).allocate("bmps", key_field="Original_ID", backend=b)
+    assert uids(b) == [3, 4, 1, 2]
+    assert (result["new"], result["reused"]) == (1, 3)
+
+
+def test_mapped_uid_still_held_is_not_reused(tmp_path):
+    b = ColumnarBackend()
+    make_table(b, [1, 2, None, None], [10, 20, 20, 30])
+    UidAllocator(str(tmp_path / "uids.json")).allocate("bmps", key_field="Original_ID", backend=b)
+    assert uids(b) == [1, 2, 3, 4]
+
+
+def test_repeated_key_in_one_batch_gets_new_uids(tmp_path):
+    path = str(tmp_path / "uids.json")
+    b = ColumnarBackend()
+    make_table(b, [None, None], [10, 20])
+    UidAllocator(path).allocate("bmps", key_field="Original_ID", backend=b)
+    make_table(b, [None, None, None], [10, 10, 20])
+    UidAllocator(path).allocate("bmps", key_field="Original_ID", backend=b)
+    assert uids(b) == [1, 3, 2]
+    assert len(set(uids(b))) == 3
+
+
+def test_default_state_path_is_beside_the_geodatabase(tmp_path):
+    gdb = os.path.join(str(tmp_path), "MS4.gdb")
+    assert default_state_path(os.path.join(gdb, "bmps")) == os.path.join(str(tmp_path), "MS4_bmps_uids.json")
+    assert default_state_path(os.path.join(gdb, "Stormwater", "bmps")) == os.path.join(str(tmp_path), "MS4_bmps_uids.json")
+    assert default_state_path("bmps") == os.path.join(str(tmp_path), "bmps_uids.json")
+
+
+def test_incrementField_keeps_its_high_water_mark_by_default(tmp_path):
+    b = ColumnarBackend()
+    make_table(b, [None] * 3, [1, 2, 3])
+    incrementField("bmps", backend=b)
+    make_table(b, [1, 2, None], [1, 2, 4]) # the row with UID 3 was deleted
+    incrementField("bmps", backend=b)
+    assert uids(b) == [1, 2, 4]
+    with open(str(tmp_path / "bmps_uids.json")) as f:
+        assert json.load(f)["high_water"] == 4
+
+
+def test_keys_are_normalized():
+    assert normalize_key(numpy.int64(5)) == 5 and type(normalize_key(numpy.int64(5))) is int
+    assert normalize_key(10.0) == 10 and type(normalize_key(10.0)) is int
+    assert normalize_key(numpy.float64(2.5)) == 2.5
+    assert normalize_key(datetime.datetime(2001, 2, 3, 4, 5)) == "2001-02-03T04:05:00"
+    assert normalize_key(datetime.date(2001, 2, 3)) == "2001-02-03"
+    assert normalize_key("A1") == "A1" and normalize_key(None) is None
+
+
+def test_date_and_float_keys_round_trip(tmp_path):
+    path = str(tmp_path / "uids.json")
+    b = ColumnarBackend()
+    days = [datetime.datetime(2001, 1, d) for d in (1, 2, 3)]
+    b.create_table("bmps", [("UID", "LONG"), ("Built", "DATE")], {"UID": object_array([None] * 3), "Built": object_array(days)})
+    UidAllocator(path).allocate("bmps", key_field="Built", backend=b)
+    b.create_table("bmps", [("UID", "LONG"), ("Built", "DATE")],
+                   {"UID": object_array([None] * 3), "Built": object_array(days[::-1])})
+    UidAllocator(path).allocate("bmps", key_field="Built", backend=b)
+    assert uids(b) == [3, 2, 1]
+
+    # float keys match the same keys read back as int
+    path = str(tmp_path / "index_uids.json")
+    b.create_table("bmps", [("UID", "LONG"), ("Index_ID", "DOUBLE")],
+                   {"UID": object_array([None] * 3), "Index_ID": object_array([1.0, 2.0, 3.5])})
+    UidAllocator(path).allocate("bmps", key_field="Index_ID", backend=b)
+    b.create_table("bmps", [("UID", "LONG"), ("Index_ID", "LONG")],
+                   {"UID": object_array([None] * 2), "Index_ID": object_array([2, 1])})
+    UidAllocator(path).allocate("bmps", key_field="Index_ID", backend=b)
+    assert uids(b) == [2, 1]
@@ -0,0 +1,153 @@
+#-------------------------------------------------------------------------------
+# Name:        uids
+# Purpose:     stable UID allocation - only rows without a UID get one, numbered on from a saved high-water mark
+#
+# incrementField used to renumber every row from 1 in OID order each run, so a feature's UID changed whenever
+# a feature before it was added or removed. Now UIDs, once given, are kept:
+#   - only rows with a null UID are read and written
+#   - new UIDs continue from the high-water mark (the highest UID ever handed out for the table), so the UID of
+#     a deleted feature is never given to another one
+#   - new rows are numbered in sort_field order (ties, and everything without sort_field, in OID order)
+#   - with key_field (e.g. Original_ID) a source key -> UID map is kept, so a feature that is deleted and
+#     loaded again, or a table rebuilt from its source, gets back the UID its key had before - unless a row
+#     of the table still holds that UID (a repeated key), which then gets a new one, so UIDs stay unique
+# The high-water mark and the key map are saved as JSON at path - without a path the mark is read from the table
+# (so is lost with the highest UID); default_state_path gives each table a state file next to its geodatabase.
+# Keys are normalized before they are mapped or saved - numpy values to python ones, whole floats to int
+# (10.0 and 10 are the same key), dates to ISO text and anything else JSON cannot hold to text.
+#
+#   allocator = UidAllocator(r"C:\temp\bmp_uids.json")
+#   allocator.allocate(bmps, "UID", key_field="Original_ID", sort_field="InstallDate")
+#-------------------------------------------------------------------------------
+
+import datetime, json, numbers, os
+import numpy
+from utilities import addMessage
+from backends import get_backend, is_null, read_columns_for_keys
+
+workspace_extensions = (".gdb", ".sde", ".mdb")
+
+
+def default_state_path(table):
+
+    # -> <folder holding the workspace>\<workspace name>_<table name>_uids.json - a .gdb / .sde cannot hold it
+    # (<table>_uids.json beside the table when the path has no geodatabase in it)
+    path = os.path.abspath(str(table))
+    name = os.path.basename(path)
+    head = path
+    while True:
+        parent, part = os.path.split(head)
+        stem, extension = os.path.splitext(part)
+        if extension.lower() in workspace_extensions:
+            return os.path.join(parent, "{0}_{1}_uids.json".format(stem, name))
+        if parent == head or not part:
+            return path + "_uids.json"
+        head = parent
+
+
+def normalize_key(key):
+
+    # -> key as it is mapped and saved (see above), None stays None
+    if hasattr(key, "item"):
+        key = key.item()
+    if key is None or isinstance(key, (bool, str, type(u""))):
+        return key
+    if isinstance(key, numbers.Integral):
+        return int(key)
+    if isinstance(key, numbers.Real):
+        key = float(key)
+        return int(key) if key.is_integer() else key
+    if hasattr(key, "isoformat"):
+        return key.isoformat()
+    return str(key)
+
+
+class UidAllocator(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.state = self._load()
+
+    def _load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                return json.load(f)
+        return {"high_water": 0, "key_field": None, "keys": []}
+
+    def save(self):
+        if not self.path:
+            return
+        self.state["updated"] = datetime.datetime.now().isoformat()
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f, sort_keys=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path + ".tmp", self.path)
+
+    def key_map(self):
+        # -> {normalized source key: UID} (kept as [key, UID] pairs in the file so keys keep their type)
+        return dict((normalize_key(key), uid) for key, uid in self.state["keys"])
+
+    def _seed(self, b, table, uid_field, key_field):
+        # first run with a key field - the UIDs the table already has become the map
+        data = b.read_columns(table, [uid_field, key_field])
+        keys = self.key_map()
+        for key, uid in zip(data[key_field].tolist(), data[uid_field].tolist()):
+            key = normalize_key(key)
+            if key is not None and uid is not None and key not in keys:
+                keys[key] = int(uid)
+        return keys
+
+    def allocate(self, table, uid_field="UID", key_field=None, sort_field=None, backend=None):
+
+        # gives every row of table with a null uid_field a UID, writing only those rows, and saves the state
+        # -> {"new": UIDs handed out, "reused": UIDs given back from the key map, "high_water": mark after}
+        b = get_backend(backend)
+        if key_field and self.state.get("key_field") not in (None, key_field):
+            raise ValueError("{0} holds UIDs keyed on {1}, not {2}".format(self.path, self.state["key_field"], key_field))
+        keys = self._seed(b, table, uid_field, key_field) if key_field and not self.state["keys"] else self.key_map()
+        highest = b.max_value(table, uid_field)
+        high_water = max(self.state["high_water"], int(highest) if highest is not None else 0, max(keys.values()) if keys else 0)
+
+        fields = [uid_field] + [f for f in (key_field, sort_field) if f]
+        data = b.read_columns(table, fields, "{0} IS NULL".format(uid_field))
+        oids = data["OID@"]
+        missing = numpy.nonzero(is_null(data[uid_field]))[0] # (in case the backend ignored the where clause)
+        if sort_field:
+            sort = data[sort_field].tolist()
+            missing = sorted(missing.tolist(), key=lambda i: (sort[i] is None, sort[i], oids[i]))
+        else:
+            missing = sorted(missing.tolist(), key=lambda i: oids[i])
+
+        row_keys = [None] * len(missing)
+        if key_field:
+            row_keys = [normalize_key(data[key_field][i]) for i in missing]
+        # a mapped UID is only given back if no row of the table still holds it (and only once per batch) -
+        # a repeated key gets a new UID instead
+        mapped = set(keys[k] for k in row_keys if k is not None and k in keys)
+        held = set()
+        if mapped:
+            found = read_columns_for_keys(b, table, uid_field, [], sorted(mapped))[uid_field].tolist()
+            held = set(int(uid) for uid in found if uid is not None and uid in mapped)
+
+        uids = numpy.zeros(len(missing), dtype=numpy.int64)
+        reused = 0
+        for n, key in enumerate(row_keys):
+            if key is not None and key in keys and keys[key] not in held:
+                uids[n] = keys[key]
+                held.add(keys[key])
+                reused += 1
+                continue
+            high_water += 1
+            uids[n] = high_water
+            if key is not None and key not in keys:
+                keys[key] = high_water
+        b.write_columns(table, oids[numpy.array(missing, dtype=numpy.int64)], {uid_field: uids})
+
+        self.state.update(high_water=high_water, table=str(table), uid_field=uid_field,
+                          key_field=key_field or self.state.get("key_field"),
+                          keys=sorted(([k, v] for k, v in keys.items()), key=lambda pair: pair[1]))
+        self.save()
+        addMessage("{0}: {1} new UIDs, {2} reused from {3}, high-water mark {4}".format(
+            table, len(missing) - reused, reused, key_field or "-", high_water))
+        return {"new": len(missing) - reused, "reused": reused, "high_water": high_water}
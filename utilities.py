@@ -9,105 +9,141 @@
 #-------------------------------------------------------------------------------
 
 
-import arcpy, os, datetime, platform
+import os, datetime, platform
+try:
+    import arcpy
+except ImportError: # reorder/rename still work through backends.ColumnarBackend
+    arcpy = None
+from backends import get_backend, Field
+import instrument
 
 
-def reorder_fields(table, out_table, field_order, add_missing=True):
+@instrument.stage
+def reorder_fields(table, out_table, field_order, add_missing=True, backend=None):
     """
     Reorders fields in input featureclass/table
     :table:         input table (fc, table, layer, etc)
     :out_table:     output table (fc, table, layer, etc)
     :field_order:   order of fields (objectid, shape not necessary)
     :add_missing:   add missing fields (that were not specified in field_order) to end if True (leave out if False) - good way to delete a bunch of fields if you need to
+    :backend:       backends.TableBackend to use (arcpy if not given)
     -> path to output table
     """
-    existing_fields = arcpy.ListFields(table)
-    existing_field_names = [field.name for field in existing_fields]
-
-    existing_mapping = arcpy.FieldMappings()
-    existing_mapping.addTable(table)
-
-    new_mapping = arcpy.FieldMappings()
-
-    def add_mapping(field_name):
-        mapping_index = existing_mapping.findFieldMapIndex(field_name)
-
-        # required fields (OBJECTID, etc) will not be in existing mappings
-        # they are added automatically
-        if mapping_index != -1:
-            field_map = existing_mapping.fieldMappings[mapping_index]
-            new_mapping.addFieldMap(field_map)
+    backend = get_backend(backend)
+    existing_field_names = [field.name for field in backend.list_fields(table)]
 
     # add user fields from field_order
     for field_name in field_order:
         if field_name not in existing_field_names:
             raise Exception("Field: {0} not in {1}".format(field_name, table))
 
-        add_mapping(field_name)
+    field_names = list(field_order)
 
     # add missing fields at end
     if add_missing:
-        missing_fields = [f for f in existing_field_names if f not in field_order]
-        for field_name in missing_fields:
-            add_mapping(field_name)
+        field_names += [f for f in existing_field_names if f not in field_order]
 
-    # use merge with single input just to use new field_mappings
-    arcpy.Merge_management(table, out_table, new_mapping)
-    return out_table
+    # required fields (OBJECTID, etc) are added automatically by the backend
+    return backend.copy_table(table, out_table, [(field_name, field_name) for field_name in field_names])
 
 
-def rename_fields(table, out_table, new_name_by_old_name):
+@instrument.stage
+def rename_fields(table, out_table, new_name_by_old_name, backend=None):
     """ Renames specified fields in input feature class/table
     :table:                 input table (fc, table, layer, etc)
     :out_table:             output table (fc, table, layer, etc)
     :new_name_by_old_name:  {'old_field_name':'new_field_name',...}
+    :backend:               backends.TableBackend to use (arcpy if not given)
     ->  out_table
     """
-    existing_field_names = [field.name for field in arcpy.ListFields(table)]
-
-    field_mappings = arcpy.FieldMappings()
-    field_mappings.addTable(table)
+    backend = get_backend(backend)
+    existing_field_names = [field.name for field in backend.list_fields(table)]
 
-    for old_field_name, new_field_name in new_name_by_old_name.iteritems():
+    for old_field_name in new_name_by_old_name:
         if old_field_name not in existing_field_names:
             message = "Field: {0} not in {1}".format(old_field_name, table)
             raise Exception(message)
 
-        mapping_index = field_mappings.findFieldMapIndex(old_field_name)
-        field_map = field_mappings.fieldMappings[mapping_index]
-        output_field = field_map.outputField
-        output_field.name = new_field_name
-        output_field.aliasName = new_field_name
-        field_map.outputField = output_field
-        field_mappings.replaceFieldMap(mapping_index, field_map)
+    field_map = [(field_name, new_name_by_old_name.get(field_name, field_name)) for field_name in existing_field_names]
+    return backend.copy_table(table, out_table, field_map)
 
-    # use merge with single input just to use new field_mappings
-    arcpy.Merge_management(table, out_table, field_mappings)
-    return out_table
+@instrument.stage
+def transform_fields(table, out_table, keep=None, drop=(), rename=None, order=None, casts=None, values=None,
+                     add_missing=True, backend=None):
+    """ Deletes, renames, reorders and casts fields in one copy (instead of DeleteField + rename_fields + reorder_fields)
+    :table:         input table (fc, table, layer, etc)
+    :out_table:     output table (fc, table, layer, etc)
+    :keep:          source fields to carry over (all if None)
+    :drop:          source fields to leave out
+    :rename:        {'old_field_name':'new_field_name',...}
+    :order:         order of output fields (new names) - objectid, shape not necessary
+    :casts:         {'old_field_name': type or (type, length),...} e.g. {'Watershed': ('TEXT', 25)}
+    :values:        {'old_field_name': {old value: new value,...},...} applied before the cast - unmatched values become null
+    :add_missing:   add fields not in order to the end if True (leave out if False)
+    :backend:       backends.TableBackend to use (arcpy if not given)
+    -> path to output table
+    The whole spec is checked against the input before anything is written.
+    """
+    backend = get_backend(backend)
+    rename = rename or {}
+    casts = casts or {}
+    values = values or {}
+    existing = [field for field in backend.list_fields(table) if field.type not in ("OID", "GEOMETRY")]
+    existing_field_names = [field.name for field in existing]
+
+    # every field the spec names has to exist
+    named = list(keep or []) + list(drop) + list(rename) + list(casts) + list(values)
+    missing = [field_name for field_name in named if field_name not in existing_field_names]
+    if missing:
+        raise Exception("Field: {0} not in {1}".format(", ".join(sorted(set(missing))), table))
+
+    carried = [f for f in existing if (keep is None or f.name in keep) and f.name not in drop]
+    new_names = [rename.get(f.name, f.name) for f in carried]
+    duplicates = sorted(set(n for n in new_names if [m.upper() for m in new_names].count(n.upper()) > 1))
+    if duplicates:
+        raise Exception("Field: {0} appears more than once in the output of {1}".format(", ".join(duplicates), table))
+    if order is not None:
+        not_carried = [field_name for field_name in order if field_name not in new_names]
+        if not_carried:
+            raise Exception("Field: {0} not in output of {1}".format(", ".join(not_carried), table))
+        positions = dict((name, i) for i, name in enumerate(order))
+        carried = sorted(carried, key=lambda f: positions.get(rename.get(f.name, f.name), len(order)))
+        if not add_missing:
+            carried = [f for f in carried if rename.get(f.name, f.name) in positions]
+
+    fields = []
+    for field in carried:
+        cast = casts.get(field.name)
+        if cast is None:
+            field_type, length = field.type, field.length
+        else:
+            field_type, length = (cast, None) if isinstance(cast, str) else tuple(cast)
+        fields.append((field.name, Field(rename.get(field.name, field.name), field_type, length), values.get(field.name)))
+    return backend.transform_table(table, out_table, fields)
+
+
+# Hack to get rawq scripts to output to build log without having to pass through logfile name
+# (checked once - the machine and script location do not change during a run)
+_build_log = None
+if platform.node() == 'WS18325' and os.path.dirname(os.path.abspath(__file__)).lower() == r'c:\swsp\scripts':
+    _build_log = r'C:\SWSP\Build\Swsp.Build.log'
 
 def addMessage(message, log_file_path = None):
 
-    if len(message) < 1000:
+    # log lines are buffered and written by a background thread (instrument.LogWriter) - a JSON lines
+    # record of each message goes to the run records too
+    if len(message) < 1000 and arcpy is not None:
         arcpy.AddMessage(message)
 
     time_stamp = datetime.datetime.now().strftime('%x %X')
     full_message = "{0} - {1}".format(time_stamp, message)
-    print full_message[0:min(len(full_message), 1000)]
-
-    # Hack to get rawq scripts to output to build log without having to pass through logfile name
-    if log_file_path is None and platform.node() == 'WS18325':
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        if script_dir.lower() == r'c:\swsp\scripts':
-            log_file_path = r'C:\SWSP\Build\Swsp.Build.log'
+    print(full_message[0:min(len(full_message), 1000)])
 
     if log_file_path is None:
-        script_dir = os.path.curdir
-        log_file_path = os.path.join(script_dir, "Script_Log.log")
+        log_file_path = _build_log or os.path.join(os.path.curdir, "Script_Log.log")
 
-    if not log_file_path is None:
-        log_file = open(log_file_path, 'a')
-        log_file.write(full_message + "\n")
-        log_file.close()
+    instrument.writer(log_file_path).write(full_message + "\n")
+    instrument.record("message", message=message)
 
     return
 